@@ -0,0 +1,129 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""
+Simulates the queue deletions of a bulk install against a broker
+stand-in, once with a new client connection per agent, as installs used
+to, and once through the shared broker channel, and compares the broker
+connections, the round trips waited for and the time taken.
+
+    python benchmarks/broker_benchmark.py --agents 200 --concurrency 50 \\
+        --latency 2
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+import Queue
+
+import pika
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from worker_installer.broker import BrokerChannel  # NOQA
+from worker_installer.broker import delete_worker_queues  # NOQA
+from worker_installer.broker import worker_queues  # NOQA
+from worker_installer.tests.amqp_server import LocalAMQPServer  # NOQA
+
+
+def connect(port):
+    return pika.BlockingConnection(pika.ConnectionParameters(
+        host='127.0.0.1', port=port))
+
+
+def delete_with_new_client(port, worker_name):
+    """what installs used to do: a whole amqp_client per agent"""
+    connection = connect(port)
+    try:
+        # amqp_client.AMQPClient declares its logs queue on two channels
+        for _ in range(2):
+            connection.channel().queue_declare(
+                queue='cloudify-logs', auto_delete=True, durable=True,
+                exclusive=False)
+        channel = connection.channel()
+        for queue in worker_queues(worker_name):
+            channel.queue_delete(queue=queue)
+    finally:
+        connection.close()
+
+
+def simulate(delete, agents, concurrency):
+    names = Queue.Queue()
+    for i in range(agents):
+        names.put('agent{0}'.format(i))
+    errors = []
+
+    def worker():
+        while True:
+            try:
+                name = names.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                delete(name)
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.time() - start, errors
+
+
+def report(name, server, elapsed, errors):
+    print '{0:>8}: total {1:7.2f}s  connections {2:5d}  ' \
+          'confirmed deletions {3:5d}  deleted queues {4:5d}  ' \
+          'errors {5}'.format(name, elapsed, server.connections,
+                              server.confirmed_deletions,
+                              len(server.deleted), len(errors))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--agents', type=int, default=100,
+                        help='number of agents installed')
+    parser.add_argument('--concurrency', type=int, default=20,
+                        help='number of agents installed concurrently')
+    parser.add_argument('--latency', type=float, default=1,
+                        help='broker round trip latency in milliseconds')
+    options = parser.parse_args()
+    latency = options.latency / 1000.0
+
+    server = LocalAMQPServer(latency=latency)
+    server.start()
+    elapsed, errors = simulate(
+        lambda name: delete_with_new_client(server.port, name),
+        options.agents, options.concurrency)
+    report('clients', server, elapsed, errors)
+    server.stop()
+
+    server = LocalAMQPServer(latency=latency)
+    server.start()
+    broker = BrokerChannel(connect=lambda: connect(server.port))
+    elapsed, errors = simulate(
+        lambda name: delete_worker_queues([name], broker=broker),
+        options.agents, options.concurrency)
+    report('shared', server, elapsed, errors)
+    broker.close()
+    server.stop()
+
+
+if __name__ == '__main__':
+    main()
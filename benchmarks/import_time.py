@@ -0,0 +1,145 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""
+Measures the cold import of a module (``worker_installer.tasks`` by
+default), the way a celery worker loading the plugin's tasks pays for it:
+every run imports it in a fresh interpreter.
+
+Reports the median wall time and resident memory added by the import, and
+the modules whose first import cost the most, cumulatively (including the
+modules they imported themselves). Exits with 1 when the median is above
+``--max-ms`` or when one of the ``--forbid`` modules was imported, so that
+regressions can be caught by a CI job.
+
+    python benchmarks/import_time.py --runs 10 --top 15 \\
+        --forbid jinja2,paramiko
+
+celery cannot be forbidden, ``cloudify.decorators`` imports it along with
+the manager's celery app.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# runs in the fresh interpreter, and prints its measures as json
+MEASURE = r'''
+import __builtin__
+import json
+import sys
+import time
+
+def resident_kb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except IOError:
+        return 0
+
+cumulative = {}
+original_import = __builtin__.__import__
+
+def timed_import(name, *args, **kwargs):
+    first = name not in sys.modules
+    started_at = time.time()
+    try:
+        return original_import(name, *args, **kwargs)
+    finally:
+        if first and name in sys.modules and name not in cumulative:
+            cumulative[name] = time.time() - started_at
+
+module = sys.argv[1]
+rss_before = resident_kb()
+modules_before = set(sys.modules)
+__builtin__.__import__ = timed_import
+started_at = time.time()
+__import__(module)
+duration = time.time() - started_at
+__builtin__.__import__ = original_import
+print(json.dumps({
+    'duration': duration,
+    'rss_kb': resident_kb() - rss_before,
+    'cumulative': cumulative,
+    'modules': sorted(set(name for name in sys.modules
+                          if sys.modules[name] is not None) -
+                      modules_before)}))
+'''
+
+
+def measure(module):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [ROOT] + [p for p in [env.get('PYTHONPATH')] if p])
+    output = subprocess.check_output([sys.executable, '-c', MEASURE, module],
+                                     env=env, cwd=ROOT)
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--module', default='worker_installer.tasks')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10,
+                        help='number of costliest modules to show')
+    parser.add_argument('--max-ms', type=float,
+                        help='fail when the median import takes longer')
+    parser.add_argument('--forbid', default='',
+                        help='comma separated top level packages that must '
+                             'not be imported')
+    args = parser.parse_args()
+
+    runs = [measure(args.module) for _ in range(args.runs)]
+    duration_ms = median([run['duration'] for run in runs]) * 1000
+    rss_kb = median([run['rss_kb'] for run in runs])
+    print('import {0}: {1:.1f}ms (median of {2}), +{3}KB resident, '
+          '{4} modules'.format(args.module, duration_ms, args.runs, rss_kb,
+                               len(runs[-1]['modules'])))
+
+    costs = {}
+    for run in runs:
+        for name, seconds in run['cumulative'].items():
+            costs.setdefault(name, []).append(seconds)
+    print('\ncumulative first import (median ms):')
+    top = sorted(costs.items(), key=lambda item: -median(item[1]))
+    for name, seconds in top[:args.top]:
+        print('  {0:9.1f}  {1}'.format(median(seconds) * 1000, name))
+
+    failures = []
+    if args.max_ms is not None and duration_ms > args.max_ms:
+        failures.append('import took {0:.1f}ms, more than {1}ms'.format(
+            duration_ms, args.max_ms))
+    imported = set(name.split('.')[0] for name in runs[-1]['modules'])
+    for name in [n.strip() for n in args.forbid.split(',') if n.strip()]:
+        if name in imported:
+            failures.append('{0} was imported'.format(name))
+    for failure in failures:
+        print('FAILED: {0}'.format(failure))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,199 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""
+Simulates many hosts downloading the agent package at once, directly from
+a file server stand-in and through the package relay, and compares the
+load put on the file server and the download times.
+
+The file server stand-in shares a fixed bandwidth between all of its
+transfers, like a manager's network link does.
+
+    python benchmarks/relay_benchmark.py --hosts 200 --size 20 \\
+        --bandwidth 200
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+import BaseHTTPServer
+import SocketServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from worker_installer.relay import PackageRelay  # NOQA
+from worker_installer.relay import RelayServer  # NOQA
+
+PACKAGE_PATH = '/packages/agents/Ubuntu-trusty-agent.tar.gz'
+CHUNK_SIZE = 64 * 1024
+
+
+class Bandwidth(object):
+    """a token bucket shared by all transfers of the file server"""
+
+    def __init__(self, bytes_per_second):
+        self.rate = float(bytes_per_second)
+        self.available = 0.0
+        self.updated_at = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, size):
+        while True:
+            with self.lock:
+                now = time.time()
+                self.available = min(
+                    self.rate, self.available +
+                    (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.available >= size:
+                    self.available -= size
+                    return
+                wait = (size - self.available) / self.rate
+            time.sleep(wait)
+
+
+class FileServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, content, bandwidth):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           FileServerHandler)
+        self.content = content
+        self.bandwidth = bandwidth
+        self.requests = 0
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+
+
+class FileServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+        etag = '"{0}"'.format(len(server.content))
+        if self.headers.getheader('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(server.content)))
+        self.end_headers()
+        for offset in range(0, len(server.content), CHUNK_SIZE):
+            chunk = server.content[offset:offset + CHUNK_SIZE]
+            server.bandwidth.consume(len(chunk))
+            self.wfile.write(chunk)
+            with server.lock:
+                server.bytes_sent += len(chunk)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(server):
+    thread = threading.Thread(target=server.serve_forever,
+                              kwargs={'poll_interval': 0.05})
+    thread.daemon = True
+    thread.start()
+    return 'http://127.0.0.1:{0}'.format(server.server_address[1])
+
+
+def download(url, durations, errors):
+    start = time.time()
+    try:
+        response = urllib2.urlopen(url, timeout=600)
+        while response.read(CHUNK_SIZE):
+            pass
+        durations.append(time.time() - start)
+    except Exception as e:
+        errors.append(e)
+
+
+def simulate(url, hosts):
+    durations = []
+    errors = []
+    threads = [threading.Thread(target=download,
+                                args=(url, durations, errors))
+               for _ in range(hosts)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.time() - start, sorted(durations), errors
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def report(name, file_server, elapsed, durations, errors):
+    print '{0:>8}: total {1:7.2f}s  p50 {2:7.2f}s  p95 {3:7.2f}s  ' \
+          'file server requests {4:4d}  file server MB {5:8.1f}  ' \
+          'errors {6}'.format(name, elapsed, percentile(durations, 0.5),
+                              percentile(durations, 0.95),
+                              file_server.requests,
+                              file_server.bytes_sent / 1024.0 / 1024.0,
+                              len(errors))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--hosts', type=int, default=100,
+                        help='number of concurrently downloading hosts')
+    parser.add_argument('--size', type=float, default=10,
+                        help='agent package size in MB')
+    parser.add_argument('--bandwidth', type=float, default=100,
+                        help='file server bandwidth in MB/s')
+    parser.add_argument('--max-transfers', type=int, default=50,
+                        help='concurrent transfers admitted by the relay')
+    options = parser.parse_args()
+
+    content = os.urandom(int(options.size * 1024 * 1024))
+    bandwidth = options.bandwidth * 1024 * 1024
+
+    direct_server = FileServer(content, Bandwidth(bandwidth))
+    direct_url = serve(direct_server) + PACKAGE_PATH
+    elapsed, durations, errors = simulate(direct_url, options.hosts)
+    report('direct', direct_server, elapsed, durations, errors)
+    direct_server.shutdown()
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        relayed_server = FileServer(content, Bandwidth(bandwidth))
+        relay = PackageRelay(serve(relayed_server), cache_dir)
+        relay_server = RelayServer(('127.0.0.1', 0), relay,
+                                   max_transfers=options.max_transfers)
+        relay_url = serve(relay_server) + PACKAGE_PATH
+        elapsed, durations, errors = simulate(relay_url, options.hosts)
+        report('relay', relayed_server, elapsed, durations, errors)
+        relay_server.shutdown()
+        relayed_server.shutdown()
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+if __name__ == '__main__':
+    main()
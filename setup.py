@@ -26,7 +26,7 @@ setup(
     description='Plugin for installing a Cloudify agent on a machine',
     install_requires=[
         'cloudify-plugins-common==3.2.1',
-        'fabric==1.8.3',
+        'paramiko==1.12.4',
         'jinja2==2.7.2'
     ],
     tests_require=[
@@ -16,12 +16,30 @@
 
 import os
 from functools import wraps
-import json
 
 from cloudify import context
+from cloudify.utils import get_manager_ip
 from cloudify.exceptions import NonRecoverableError
 
-from worker_installer.utils import (FabricRunner,
+from worker_installer import agent_package
+from worker_installer import profiling
+from worker_installer.async_runner import AsyncRunner
+from worker_installer.broker import DEFAULT_BROKER_PASSWORD
+from worker_installer.broker import DEFAULT_BROKER_USER
+from worker_installer.broker import broker_management_url
+from worker_installer.event_loop import Return
+from worker_installer.facts import HostFacts
+from worker_installer.metrics import METRICS_DIR_ENV
+from worker_installer.metrics import METRICS_STATSD_ENV
+from worker_installer.metrics import OUTCOME_FAILURE
+from worker_installer.metrics import OUTCOME_SUCCESS
+from worker_installer.metrics import PhaseTimer
+from worker_installer.metrics import phase
+from worker_installer.tracing import CommandTrace
+from worker_installer.tracing import DEFAULT_TRACE_DIR
+from worker_installer.tracing import trace_path
+from worker_installer.utils import (FabricRunner,  # NOQA
+                                    create_runner,
                                     is_on_management_worker)
 
 DEFAULT_MIN_WORKERS = 2
@@ -29,6 +47,13 @@ DEFAULT_MAX_WORKERS = 5
 DEFAULT_REMOTE_EXECUTION_PORT = 22
 DEFAULT_WAIT_STARTED_TIMEOUT = 15
 DEFAULT_WAIT_STARTED_INTERVAL = 1
+# relative to the home dir of the agent's user
+DEFAULT_AGENT_PACKAGE_CACHE_DIR = '.cloudify/agent-packages'
+
+# runtime property holding the agent configuration resolved by previous
+# operations. the version is bumped whenever its structure changes.
+RESOLVED_CONFIG_KEY = 'cloudify_agent_resolved_config'
+RESOLVED_CONFIG_VERSION = 1
 
 
 def _find_type_in_kwargs(cls, all_args):
@@ -67,58 +92,215 @@ def init_worker_installer(func):
             else:
                 agent_config = {}
         prepare_connection_configuration(ctx, agent_config)
-        runner = FabricRunner(ctx, agent_config)
-        try:
-            prepare_additional_configuration(ctx, agent_config, runner)
-
-            kwargs['runner'] = runner
-            kwargs['agent_config'] = agent_config
-
-            if not (agent_config.get('distro') and
-                    agent_config.get('distro_codename')):
-                distro_info = get_machine_distro(runner)
-                if not agent_config.get('distro'):
-                    agent_config['distro'] = distro_info[0]
-                if not agent_config.get('distro_codename'):
-                    agent_config['distro_codename'] = distro_info[2]
-            return func(*args, **kwargs)
-        finally:
-            # Fixes CFY-1741 (clear fabric connection cache)
-            runner.close()
+        modes = _get_profiling_modes(agent_config)
+        if not modes:
+            return run_with_agent_config(ctx, agent_config, func, *args,
+                                         **kwargs)
+        # the name of the agent is the id of its node instance, or of its
+        # deployment for deployment workers
+        with profiling.profiled(
+                modes,
+                agent_config.get('profile_dir') or
+                os.environ.get(profiling.PROFILE_DIR_ENV) or
+                profiling.DEFAULT_PROFILE_DIR,
+                agent_config['name'], ctx.operation.name,
+                max_bytes=_get_profile_max_bytes(agent_config)):
+            return run_with_agent_config(ctx, agent_config, func, *args,
+                                         **kwargs)
     return wrapper
 
 
-def get_machine_distro(runner):
-    """retrieves the distribution information of the machine"""
+def _get_profiling_modes(agent_config):
+    value = agent_config['profile'] if 'profile' in agent_config \
+        else os.environ.get(profiling.PROFILE_ENV)
+    try:
+        return profiling.parse_modes(value)
+    except ValueError as e:
+        raise NonRecoverableError(
+            'Value for profile property should be true/false or a comma '
+            'separated list of {0}, but is: {1} ({2})'.format(
+                '/'.join(profiling.MODES), value, e))
+
 
-    stdout = _run_py_cmd_with_output(runner,
-                                     'import platform, json',
-                                     'json.dumps(platform.dist())')
-    return json.loads(stdout)
+def _get_profile_max_bytes(agent_config):
+    max_bytes = agent_config.get('profile_max_bytes',
+                                 profiling.DEFAULT_MAX_BYTES)
+    if not str(max_bytes).isdigit():
+        raise NonRecoverableError('profile_max_bytes is supposed to be a '
+                                  'number but is: {0}'.format(max_bytes))
+    return int(max_bytes)
 
 
-def _run_py_cmd_with_output(runner, imports_line, command):
+def run_with_agent_config(ctx, agent_config, func, *args, **kwargs):
     """
-    To overcome the situation where additional info is printed
-    to stdout when a command execution occurs, a string is
-    appended to the output. This will then search for the string
-    and the following closing brackets to retrieve the original output.
+    Completes the configuration of an agent whose connection configuration
+    is already prepared, and invokes ``func`` with the ``runner``,
+    ``agent_config`` and ``host_facts`` keyword arguments.
+
+    Pass ``persist_resolved_config=False`` when ``agent_config`` does not
+    describe the agent of the node instance in ``ctx``.
     """
+    persist_resolved_config = kwargs.pop('persist_resolved_config', True)
+    runner = create_runner(ctx, agent_config)
+    _start_trace(runner, agent_config)
+    runner.phases = _phase_timer(ctx, agent_config)
+    try:
+        with phase(runner, 'prepare'):
+            # a single probe gathers home dir, distro and the rest of the
+            # host facts, and only if any of them is actually needed
+            known_facts = _load_resolved_config(ctx, agent_config) \
+                if persist_resolved_config else None
+            host_facts = HostFacts(runner, agent_config,
+                                   known_facts=known_facts)
+            prepare_additional_configuration(ctx, agent_config, runner,
+                                             host_facts)
+
+        kwargs['runner'] = runner
+        kwargs['agent_config'] = agent_config
+        kwargs['host_facts'] = host_facts
+
+        _set_distro(host_facts, agent_config)
+        result = func(*args, **kwargs)
+        if persist_resolved_config:
+            _store_resolved_config(ctx, agent_config, host_facts)
+    except Exception:
+        _publish_phases(runner, agent_config, OUTCOME_FAILURE)
+        raise
+    else:
+        _publish_phases(runner, agent_config)
+        return result
+    finally:
+        # releases the runner, pooled connections stay open for reuse
+        runner.close()
+        _finish_trace(ctx, agent_config, runner.trace)
 
-    delim_start = '###CLOUDIFYDISTROOPEN'
-    delim_end = 'CLOUDIFYDISTROCLOSE###'
 
-    stdout = runner.run('python -c "import sys; {0}; '
-                        'sys.stdout.write(\'{1}{2}{3}\\n\''
-                        '.format({4}))"'
-                        .format(imports_line,
-                                delim_start,
-                                '{0}',
-                                delim_end,
-                                command))
-    result = stdout[stdout.find(delim_start) + len(delim_start):
-                    stdout.find(delim_end)]
-    return result
+def run_with_agent_config_async(ctx, loop, agent_config, func, *args,
+                                **kwargs):
+    """
+    The event loop counterpart of `run_with_agent_config`, for coroutines
+    running with an `AsyncRunner` on ``loop``. The host is always probed,
+    in a single command or in process for local agents, before ``func``
+    is invoked. Nothing is remembered
+    in runtime properties.
+    """
+    runner = AsyncRunner(ctx, agent_config, loop)
+    _start_trace(runner, agent_config)
+    runner.phases = _phase_timer(ctx, agent_config)
+    try:
+        with phase(runner, 'prepare'):
+            host_facts = HostFacts(runner, agent_config)
+            if host_facts.local:
+                host_facts.probe()
+            else:
+                host_facts.load(
+                    (yield runner.run(host_facts.probe_command())))
+            prepare_additional_configuration(ctx, agent_config, runner,
+                                             host_facts)
+
+        kwargs['runner'] = runner
+        kwargs['agent_config'] = agent_config
+        kwargs['host_facts'] = host_facts
+        _set_distro(host_facts, agent_config)
+        result = yield func(*args, **kwargs)
+    except Exception:
+        _publish_phases(runner, agent_config, OUTCOME_FAILURE)
+        raise
+    else:
+        _publish_phases(runner, agent_config)
+        raise Return(result)
+    finally:
+        runner.close()
+        _finish_trace(ctx, agent_config, runner.trace)
+
+
+def _start_trace(runner, agent_config):
+    # tracing is decided before anything runs, the host probe included
+    if _get_bool(agent_config, 'trace_commands', False):
+        runner.trace = CommandTrace()
+
+
+def _phase_timer(ctx, agent_config):
+    """a `PhaseTimer` for the operation, if metrics are exported at all"""
+    metrics_dir = agent_config.get('metrics_dir') or \
+        os.environ.get(METRICS_DIR_ENV)
+    statsd_address = agent_config.get('metrics_statsd') or \
+        os.environ.get(METRICS_STATSD_ENV)
+    if not metrics_dir and not statsd_address:
+        return None
+    operation = (ctx.operation.name or 'unknown').split('.')[-1]
+    return PhaseTimer(operation, metrics_dir=metrics_dir,
+                      statsd_address=statsd_address)
+
+
+def _publish_phases(runner, agent_config, outcome=OUTCOME_SUCCESS):
+    if runner.phases is not None:
+        runner.phases.publish(agent_config.get('distro'), outcome)
+
+
+def _finish_trace(ctx, agent_config, trace):
+    """dumps the trace of an operation and logs its slowest steps"""
+    if trace is None:
+        return
+    name = agent_config.get('name')
+    path = trace_path(agent_config.get('trace_dir') or DEFAULT_TRACE_DIR,
+                      name, ctx.operation.name)
+    try:
+        trace.dump(path, operation=ctx.operation.name, agent=name)
+    except (IOError, OSError) as e:
+        ctx.logger.warning('Could not write the command trace to {0}: {1}'
+                           .format(path, e))
+    ctx.logger.info('Command trace of agent {0} ({1}): {2}'.format(
+        name, path, trace.summary()))
+
+
+def _resolved_config_fingerprint(agent_config):
+    return {
+        'host': agent_config.get('host'),
+        'port': agent_config.get('port'),
+        'user': agent_config.get('user'),
+        'name': agent_config.get('name')
+    }
+
+
+def _load_resolved_config(ctx, agent_config):
+    """
+    Returns the host facts resolved by a previous operation on this node
+    instance, or None if there are none or they belong to another host.
+    """
+    if ctx.type != context.NODE_INSTANCE:
+        return None
+    resolved = ctx.instance.runtime_properties.get(RESOLVED_CONFIG_KEY)
+    if not resolved or resolved.get('version') != RESOLVED_CONFIG_VERSION:
+        return None
+    if resolved.get('fingerprint') != \
+            _resolved_config_fingerprint(agent_config):
+        ctx.logger.debug('Ignoring resolved agent configuration of another '
+                         'host: {0}'.format(resolved.get('fingerprint')))
+        return None
+    return resolved.get('facts')
+
+
+def _store_resolved_config(ctx, agent_config, host_facts):
+    if ctx.type != context.NODE_INSTANCE:
+        return
+    runtime_properties = ctx.instance.runtime_properties
+    if host_facts.forgotten:
+        runtime_properties.pop(RESOLVED_CONFIG_KEY, None)
+        return
+    facts = host_facts.stable_facts()
+    for key in ['home_dir', 'distro', 'distro_codename']:
+        if agent_config.get(key):
+            facts[key] = agent_config[key]
+    # the agent's paths are not kept, they are derived from the home dir
+    # and the agent's name anyway
+    resolved = {
+        'version': RESOLVED_CONFIG_VERSION,
+        'fingerprint': _resolved_config_fingerprint(agent_config),
+        'facts': facts
+    }
+    if runtime_properties.get(RESOLVED_CONFIG_KEY) != resolved:
+        runtime_properties[RESOLVED_CONFIG_KEY] = resolved
 
 
 def get_machine_ip(ctx):
@@ -205,16 +387,54 @@ def _set_wait_started_config(config):
         config['wait_started_timeout'] = DEFAULT_WAIT_STARTED_TIMEOUT
     if 'wait_started_interval' not in config:
         config['wait_started_interval'] = DEFAULT_WAIT_STARTED_INTERVAL
+    # when set, start returns an operation retry instead of blocking a
+    # worker slot while the agent boots
+    config['wait_started_retry'] = _get_bool(config, 'wait_started_retry',
+                                             False)
 
 
-def _set_home_dir(runner, config):
+def _set_home_dir(host_facts, config):
     if 'home_dir' not in config:
-        home_dir = _run_py_cmd_with_output(
-            runner,
-            'import pwd',
-            'pwd.getpwnam(\'{0}\').pw_dir'.format(config['user']))
-
-        config['home_dir'] = home_dir
+        config['home_dir'] = host_facts.home_dir
+
+
+def _set_distro(host_facts, config):
+    if not config.get('distro'):
+        config['distro'] = host_facts.distro
+    if not config.get('distro_codename'):
+        config['distro_codename'] = host_facts.distro_codename
+
+
+def _set_agent_package_cache(config):
+    config['agent_package_cache'] = _get_bool(config, 'agent_package_cache',
+                                              False)
+    if not config.get('agent_package_cache_dir'):
+        config['agent_package_cache_dir'] = '{0}/{1}'.format(
+            config['home_dir'], DEFAULT_AGENT_PACKAGE_CACHE_DIR)
+    max_size = config.get('agent_package_cache_max_size',
+                          agent_package.DEFAULT_CACHE_MAX_SIZE)
+    if not str(max_size).isdigit():
+        raise NonRecoverableError('agent_package_cache_max_size is supposed '
+                                  'to be a number but is: {0}'
+                                  .format(max_size))
+    config['agent_package_cache_max_size'] = int(max_size)
+
+
+def _set_queue_expiry(config):
+    expires = config.get('queue_expires')
+    if expires is None:
+        return
+    if not str(expires).isdigit() or int(expires) < 1:
+        raise NonRecoverableError('queue_expires is supposed to be a '
+                                  'positive number but is: {0}'
+                                  .format(expires))
+    config['queue_expires'] = int(expires)
+    if not config.get('broker_management_url'):
+        # the management API takes the credentials of the broker's users
+        config['broker_management_url'] = broker_management_url(
+            get_manager_ip(),
+            config.get('broker_user', DEFAULT_BROKER_USER),
+            config.get('broker_password', DEFAULT_BROKER_PASSWORD))
 
 
 def _get_bool(config, key, default):
@@ -254,11 +474,31 @@ def prepare_connection_configuration(ctx, agent_config):
         agent_config['name'] = ctx.instance.id
 
 
-def prepare_additional_configuration(ctx, agent_config, runner):
+def prepare_bulk_connection_configuration(ctx, agent_config):
+    """
+    Prepares the connection configuration of one of the agents handled
+    by a bulk operation. Unlike `prepare_connection_configuration`, host
+    and name come from the agent configuration itself rather than from
+    the node instance in ``ctx``.
+    """
+    for key in ['host', 'name']:
+        if not agent_config.get(key):
+            raise NonRecoverableError(
+                '{0} is mandatory for every agent of a bulk operation '
+                '[cloudify_agent={1}]'.format(key, agent_config))
+    _set_auth(ctx, agent_config)
+    _set_user(ctx, agent_config)
+    _set_remote_execution_port(ctx, agent_config)
+
+
+def prepare_additional_configuration(ctx, agent_config, runner,
+                                     host_facts=None):
 
     _set_wait_started_config(agent_config)
 
-    _set_home_dir(runner, agent_config)
+    if host_facts is None:
+        host_facts = HostFacts(runner, agent_config)
+    _set_home_dir(host_facts, agent_config)
 
     home_dir = agent_config['home_dir']
     agent_config['celery_base_dir'] = home_dir
@@ -278,4 +518,11 @@ def prepare_additional_configuration(ctx, agent_config, runner):
     agent_config['delete_amqp_queues'] = _get_bool(agent_config,
                                                    'delete_amqp_queues',
                                                    True)
+    agent_config['stream_agent_package'] = _get_bool(agent_config,
+                                                     'stream_agent_package',
+                                                     True)
+    agent_config['agent_package_checksum'] = agent_package.normalize_checksum(
+        agent_config.get('agent_package_checksum'))
+    _set_agent_package_cache(agent_config)
+    _set_queue_expiry(agent_config)
     _prepare_and_validate_autoscale_params(ctx, agent_config)
@@ -0,0 +1,275 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+
+import re
+
+from cloudify.exceptions import NonRecoverableError
+
+from worker_installer.utils import download_resource_command
+
+# number of leading path components stripped from the package's entries
+PACKAGE_STRIP_COMPONENTS = 2
+
+_SHA256_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+DEFAULT_CACHE_MAX_SIZE = 512 * 1024 * 1024
+
+# prints the sha256 of the file given as the first argument, or of its
+# input, for hosts without sha256sum
+_PYTHON_SHA256 = ("python -c 'import hashlib, sys; f = open(sys.argv[1], "
+                  "\"rb\") if len(sys.argv) > 1 else getattr(sys.stdin, "
+                  "\"buffer\", sys.stdin); "
+                  "print(hashlib.sha256(f.read()).hexdigest())'")
+
+# installs the package through a cache directory on the host. entries
+# are named after the package checksum, or after the url and ETag of the
+# package when there is no checksum, and carry the sha256 of their
+# content in a .sha256 file so that hits are verified before use. the
+# modification time of an entry is its last use, entries beyond the size
+# cap are evicted least recently used first.
+_CACHED_EXTRACT_SCRIPT = '''set -o pipefail
+cache={cache_dir}
+url={url}
+dest={destination_dir}
+expected={checksum}
+digest() {{ {digest} "$@" | cut -d' ' -f1; }}
+key=
+if ! mkdir -p "$cache" 2> /dev/null; then
+echo "cannot create agent package cache $cache, not caching"
+elif [ -n "$expected" ]; then
+key=sha256-$expected
+else
+etag=$({head} 2>&1 | tr -d '\\r' |
+awk 'tolower($1) == "etag:" {{v = $2}} END {{print v}}')
+[ -n "$etag" ] && key=etag-$(printf '%s %s' "$url" "$etag" | digest)
+[ -n "$key" ] || echo "agent package has no checksum or ETag, not caching"
+fi
+if [ -n "$key" ]; then
+find "$cache" -name '*.tmp.*' -mmin +60 -exec rm -f {{}} + 2> /dev/null
+entry="$cache/$key.tar.gz"
+if [ -f "$entry" ] && [ -f "$entry.sha256" ] &&
+[ "$(digest "$entry")" = "$(cat "$entry.sha256")" ]; then
+echo "agent package cache hit: $entry"
+touch "$entry"
+tar xzf "$entry" --strip={strip} -C "$dest" > /dev/null
+exit $?
+fi
+rm -f "$entry" "$entry.sha256"
+tmp="$entry.tmp.$$"
+else
+{uncached}
+fi
+{fetch_and_extract} || {{ rc=$?; rm -f "$tmp"; exit $rc; }}
+if [ -n "$expected" ] || [ -n "$key" ]; then
+sum=$(digest "$tmp") || {{ rc=$?; rm -f "$tmp"; exit $rc; }}
+fi
+if [ -n "$expected" ] && [ "$sum" != "$expected" ]; then
+rm -f "$tmp"; rm -rf "$dest"
+echo "agent package checksum mismatch: expected $expected but got $sum" >&2
+exit 1
+fi
+if [ -z "$key" ]; then
+rm -f "$tmp"
+exit 0
+fi
+echo "$sum" > "$entry.sha256" && mv "$tmp" "$entry" || exit $?
+total=0
+for cached in $(ls -t "$cache"/*.tar.gz 2> /dev/null); do
+total=$((total + $(wc -c < "$cached")))
+if [ $total -gt {max_size} ] && [ "$cached" != "$entry" ]; then
+echo "evicting $cached from agent package cache"
+rm -f "$cached" "$cached.sha256"
+fi
+done'''
+
+
+# streams the package into tar when it is not cached, verifying its
+# checksum on the way through fd 3 if there is one
+_STREAM_UNCACHED_SCRIPT = '''if [ -n "$expected" ]; then
+sum=$({{ {fetch} | tee /dev/fd/3 | {extract}; }} 3>&1 | digest) || exit $?
+[ "$sum" = "$expected" ] && exit 0
+rm -rf "$dest"
+echo "agent package checksum mismatch: expected $expected but got $sum" >&2
+exit 1
+fi
+{fetch} | {extract}
+exit $?'''
+
+
+def normalize_checksum(checksum):
+    """
+    Returns the hex sha256 digest in ``checksum``, which may be prefixed
+    with ``sha256:``, or None if no checksum is given.
+    """
+    if not checksum:
+        return None
+    value = str(checksum).strip().lower()
+    if value.startswith('sha256:'):
+        value = value[len('sha256:'):]
+    if not _SHA256_PATTERN.match(value):
+        raise NonRecoverableError(
+            'agent package checksum is supposed to be a sha256 hex digest '
+            'but is: {0}'.format(checksum))
+    return value
+
+
+def can_stream(tools, checksum=None):
+    """
+    Gets whether a host with ``tools`` can extract the package while it
+    is downloaded, verifying ``checksum`` on the way if one is given.
+    """
+    if tools is None:
+        return False
+    if 'curl' not in tools and 'wget' not in tools:
+        return False
+    return not checksum or 'sha256sum' in tools
+
+
+def can_cache(tools):
+    """
+    Gets whether a host with ``tools`` can install the package through
+    the host side cache.
+    """
+    if tools is None:
+        return False
+    if 'curl' not in tools and 'wget' not in tools:
+        return False
+    return 'sha256sum' in tools or 'python' in tools
+
+
+def cached_extract_command(url, destination_dir, tools, cache_dir,
+                           max_size=DEFAULT_CACHE_MAX_SIZE, checksum=None,
+                           stream=True):
+    """
+    A single shell script extracting the package at ``url`` from the
+    host side cache in ``cache_dir`` when it holds a verified copy, and
+    downloading it into the cache otherwise.
+
+    Packages whose identity cannot be told, as they have neither a
+    ``checksum`` nor an ETag, are installed without the cache. So are
+    all packages when ``cache_dir`` cannot be created. With ``stream``,
+    these are piped straight into tar as by `stream_extract_command`.
+    """
+    if 'curl' in tools:
+        fetch = 'curl -fsSL "$url"'
+        head = 'curl -sfIL "$url"'
+    else:
+        fetch = 'wget -q -T 30 "$url" -O-'
+        head = 'wget -q -S --spider -T 30 "$url"'
+    extract = 'tar xzf - --strip={0} -C "$dest" > /dev/null'.format(
+        PACKAGE_STRIP_COMPONENTS)
+    if stream:
+        fetch_and_extract = '{0} | tee "$tmp" | {1}'.format(fetch, extract)
+        # with no cache entry to fill, the archive never touches the disk
+        uncached = _STREAM_UNCACHED_SCRIPT.format(fetch=fetch,
+                                                  extract=extract)
+    else:
+        uncached = 'tmp="$dest/agent.tar.gz.tmp.$$"'
+        fetch_and_extract = '{0} > "$tmp" && {1} < "$tmp"'.format(
+            fetch, extract)
+    if 'sha256sum' in tools:
+        digest = 'sha256sum'
+    else:
+        digest = _PYTHON_SHA256
+    return _CACHED_EXTRACT_SCRIPT.format(
+        cache_dir=cache_dir,
+        url=url,
+        destination_dir=destination_dir,
+        checksum=checksum or '',
+        digest=digest,
+        head=head,
+        fetch_and_extract=fetch_and_extract,
+        uncached=uncached,
+        strip=PACKAGE_STRIP_COMPONENTS,
+        max_size=int(max_size))
+
+
+def stream_extract_command(url, destination_dir, tools, checksum=None):
+    """
+    A single shell command piping the package at ``url`` straight into
+    tar, so the archive itself never touches the disk.
+
+    With a ``checksum``, the stream is also fed to sha256sum and
+    ``destination_dir`` is removed if the digest does not match.
+    """
+    if 'curl' in tools:
+        fetch = 'curl -fsSL {0}'.format(url)
+    else:
+        fetch = 'wget -q -T 30 {0} -O-'.format(url)
+    extract = 'tar xzf - --strip={0} -C {1}'.format(
+        PACKAGE_STRIP_COMPONENTS, destination_dir)
+    if not checksum:
+        return 'set -o pipefail; {0} | {1}'.format(fetch, extract)
+    # tee hands a copy of the stream to sha256sum through fd 3 while tar
+    # reads the original, tar's own output is discarded
+    return ('set -o pipefail; '
+            'sum=$({{ {0} | tee /dev/fd/3 | {1} > /dev/null; }} '
+            '3>&1 | sha256sum) || exit $?; '
+            '{2}'.format(fetch, extract,
+                         _verify_sum_command(checksum, destination_dir)))
+
+
+def download_extract_commands(url, destination_dir, tools, checksum=None):
+    """
+    The commands installing the package without streaming: download the
+    archive into ``destination_dir``, verify it if there is a
+    ``checksum``, and extract it. The archive is left in place, see
+    `cleanup_command`.
+    """
+    archive = archive_path(destination_dir)
+    commands = [download_resource_command(url, archive, tools)]
+    if checksum:
+        commands.append(verify_checksum_command(
+            archive, checksum, tools, remove_on_mismatch=destination_dir))
+    commands.append('tar xzvf {0} --strip={1} -C {2}'.format(
+        archive, PACKAGE_STRIP_COMPONENTS, destination_dir))
+    return commands
+
+
+def verify_checksum_command(file_path, checksum, tools=None,
+                            remove_on_mismatch=None):
+    """
+    A command failing, and removing ``remove_on_mismatch`` (by default
+    ``file_path`` itself), unless the sha256 digest of ``file_path`` is
+    ``checksum``. Uses sha256sum, or python when sha256sum is known to
+    be missing.
+    """
+    if tools is not None and 'sha256sum' not in tools:
+        if 'python' not in tools:
+            raise NonRecoverableError(
+                'cannot verify agent package checksum, neither sha256sum '
+                'nor python were found on the host')
+        digest = '{0} {1}'.format(_PYTHON_SHA256, file_path)
+    else:
+        digest = 'sha256sum {0}'.format(file_path)
+    return 'sum=$({0}) || exit $?; {1}'.format(
+        digest, _verify_sum_command(checksum,
+                                    remove_on_mismatch or file_path))
+
+
+def cleanup_command(destination_dir):
+    return 'rm {0}'.format(archive_path(destination_dir))
+
+
+def archive_path(destination_dir):
+    return '{0}/agent.tar.gz'.format(destination_dir)
+
+
+def _verify_sum_command(checksum, remove_on_mismatch):
+    return ('if [ "${{sum%% *}}" != "{0}" ]; then rm -rf {1}; '
+            'echo "agent package checksum mismatch: expected {0} '
+            'but got ${{sum%% *}}" >&2; exit 1; fi'
+            .format(checksum, remove_on_mismatch))
@@ -0,0 +1,280 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+
+import posixpath
+import socket
+
+from cloudify.exceptions import NonRecoverableError
+
+from worker_installer.event_loop import Future
+from worker_installer.event_loop import Return
+from worker_installer.output import CapturedOutput
+from worker_installer.output import DEFAULT_TAIL_BYTES
+from worker_installer.output import TailOutput
+from worker_installer.utils import create_runner
+from worker_installer.utils import FabricRunnerException
+from worker_installer.utils import MAX_PUT_COMMAND_SIZE
+from worker_installer.utils import RECV_BUFFER_SIZE
+from worker_installer.utils import check_put_result
+from worker_installer.utils import put_command
+from worker_installer.utils import put_rename_command
+from worker_installer.utils import put_spec
+from worker_installer.utils import put_upload_path
+from worker_installer.utils import tail_command
+
+# how often to check for the exit status of a command whose output ended
+# before its exit status arrived
+EXIT_STATUS_POLL_INTERVAL = 0.01
+
+
+class AsyncRunner(object):
+    """
+    The event loop counterpart of `FabricRunner`: ``run``, ``exists``,
+    ``put`` and ``get`` return futures, to be yielded by coroutines
+    running on ``loop``.
+
+    Commands of all runners sharing a loop are multiplexed on that loop's
+    thread. Only blocking steps without a non blocking counterpart (SSH
+    handshakes, opening channels and sftp transfers) are handed to the
+    loop's bounded executor. Local agents are handled entirely by the
+    executor. paramiko itself still runs a transport thread per host
+    connected to, so the threads used are bounded by the hosts, not by
+    the commands running on them.
+    """
+
+    def __init__(self, ctx, agent_config, loop):
+        self.ctx = ctx
+        self.loop = loop
+        self._runner = create_runner(ctx, agent_config)
+        self.local = self._runner.local
+        self.phases = None
+
+    @property
+    def trace(self):
+        return self._runner.trace
+
+    @trace.setter
+    def trace(self, trace):
+        self._runner.trace = trace
+
+    def run(self, command, shell_escape=None, output=None):
+        return self._spawn('run', command, len(command),
+                           self._run, command, shell_escape, output)
+
+    def exists(self, file_path):
+        return self._spawn('exists', file_path, 0, self._exists, file_path)
+
+    def put(self, file_path, content, use_sudo=False, mode=None):
+        return self.put_many([(file_path, content, use_sudo, mode)])
+
+    def put_many(self, files):
+        files = [put_spec(*f) for f in files]
+        return self._spawn('put', ' '.join(f[0] for f in files),
+                           sum(len(f[1]) for f in files),
+                           self._put_many, files)
+
+    def get(self, file_path):
+        return self._spawn('get', file_path, 0, self._get, file_path)
+
+    def put_file(self, file_path, source, use_sudo=False, mode=None):
+        """`FabricRunner.put_file`, in the executor"""
+        return self.loop.run_in_executor(self._runner.put_file, file_path,
+                                         source, use_sudo, mode)
+
+    def get_file(self, file_path, target, max_bytes=None, tail=False):
+        """`FabricRunner.get_file`, in the executor"""
+        return self.loop.run_in_executor(self._runner.get_file, file_path,
+                                         target, max_bytes, tail)
+
+    def tail(self, file_path, max_bytes=DEFAULT_TAIL_BYTES, max_lines=None):
+        """`FabricRunner.tail`, in a single command read on the loop"""
+        if self.local:
+            return self.loop.run_in_executor(self._runner.tail, file_path,
+                                             max_bytes, max_lines)
+        return self.run(tail_command(file_path, max_bytes, max_lines),
+                        output=TailOutput(max_bytes))
+
+    def flush(self, batch):
+        """runs the steps queued in a `CommandBatch` of this runner"""
+        return self.loop.spawn(self._flush(batch))
+
+    def close(self):
+        self._runner.close()
+
+    def _spawn(self, kind, subject, bytes_out, func, *args):
+        """
+        Spawns the coroutine ``func(*args)``, recorded as a step when the
+        runner is traced. Local agents are handled by the traced
+        `FabricRunner` itself.
+        """
+        if self.trace is None or self.local:
+            return self.loop.spawn(func(*args))
+        return self.loop.spawn(self._traced(kind, subject, bytes_out,
+                                            func, args))
+
+    def _traced(self, kind, subject, bytes_out, func, args):
+        record = self.trace.begin(kind, subject)
+        record['bytes_out'] = bytes_out
+        exit_code = 0
+        try:
+            result = yield func(*args, record=record)
+        except Exception as e:
+            exit_code = getattr(e, 'code', -1)
+            raise
+        finally:
+            self.trace.end(record, exit_code)
+        if isinstance(result, basestring) and not record['bytes_in']:
+            # unless the step counted the bytes it read itself
+            record['bytes_in'] = len(result)
+        raise Return(result)
+
+    def _in_executor(self, record, func, *args):
+        """
+        Runs ``func(*args)`` in the executor, attributing the connection
+        it uses to the step recorded in ``record``.
+        """
+        if record is None:
+            return self.loop.run_in_executor(func, *args)
+
+        def attached():
+            with self.trace.attached(record):
+                return func(*args)
+        return self.loop.run_in_executor(attached)
+
+    def _run(self, command, shell_escape, output=None, record=None):
+        self.ctx.logger.debug('Running command: {0}'.format(command))
+        if output is None:
+            output = CapturedOutput()
+        if self.local:
+            result = yield self.loop.run_in_executor(
+                self._runner.run, command, shell_escape, output)
+            raise Return(result)
+        code, result = yield self._exec(command, shell_escape, record,
+                                        output)
+        if record is not None and record['kind'] == 'run':
+            record['bytes_in'] = output.size
+        if code != 0:
+            raise FabricRunnerException(command, code, result)
+        raise Return(result)
+
+    def _exists(self, file_path, record=None):
+        if self.local:
+            exists = yield self.loop.run_in_executor(self._runner.exists,
+                                                     file_path)
+            raise Return(exists)
+        code, _ = yield self._exec('test -e "$(echo {0})"'.format(file_path),
+                                   record=record)
+        if record is not None and record['kind'] == 'exists':
+            record['exit_code'] = code
+        raise Return(code == 0)
+
+    def _get(self, file_path, record=None):
+        if self.local:
+            content = yield self.loop.run_in_executor(self._runner.get,
+                                                      file_path)
+        else:
+            content = yield self._in_executor(record, self._runner.download,
+                                              file_path)
+        raise Return(content)
+
+    def _put_many(self, files, record=None):
+        if self.local:
+            yield self.loop.run_in_executor(self._runner.put_many, files)
+            return
+        for file_path, _, use_sudo, mode in files:
+            self.ctx.logger.debug(
+                'Putting file: {0} [use_sudo={1}, mode={2:o}]'.format(
+                    file_path, use_sudo, mode))
+        command = put_command(files)
+        if len(command) > MAX_PUT_COMMAND_SIZE:
+            for f in files:
+                yield self._put_sftp(record, *f)
+            return
+        code, output = yield self._exec(command, record=record)
+        check_put_result(command, code, output)
+
+    def _put_sftp(self, record, file_path, content, use_sudo, mode):
+        if (yield self._exists(file_path, record)):
+            raise NonRecoverableError('Cannot put file, file already '
+                                      'exists: {0}'.format(file_path))
+        directory = posixpath.dirname(file_path) or '.'
+        sudo = 'sudo ' if use_sudo else ''
+        yield self._run('{0}mkdir -p {1}'.format(sudo, directory), None,
+                        record=record)
+        upload_path = put_upload_path(file_path, use_sudo)
+        yield self._in_executor(record, self._runner.upload, upload_path,
+                                content)
+        yield self._run(put_rename_command(upload_path, file_path, use_sudo,
+                                           mode), None, record=record)
+
+    def _flush(self, batch):
+        if not batch.steps:
+            raise Return([])
+        script = batch.begin()
+        yield self.run(script, output=batch.output)
+        raise Return(batch.complete())
+
+    def _exec(self, command, shell_escape=None, record=None, output=None):
+        if output is None:
+            output = CapturedOutput()
+        channel = yield self._in_executor(
+            record, self._runner.start_command, command, shell_escape)
+        try:
+            code, output = yield self._read_channel(channel, output)
+        except Exception as e:
+            raise FabricRunnerException(command, -1, str(e))
+        finally:
+            channel.close()
+        raise Return((code, output))
+
+    def _read_channel(self, channel, output):
+        """
+        A future resolving to the exit code of the command running on
+        ``channel`` and what ``output`` kept of its output, read whenever
+        the loop finds the channel readable.
+        """
+        future = Future()
+        channel.setblocking(0)
+        fd = channel.fileno()
+
+        def on_readable():
+            try:
+                while True:
+                    data = channel.recv(RECV_BUFFER_SIZE)
+                    if not data:
+                        break
+                    output.feed(data)
+            except socket.timeout:
+                # nothing more to read for now
+                return
+            except Exception as e:
+                self.loop.remove_reader(fd)
+                future.set_exception(e)
+                return
+            self.loop.remove_reader(fd)
+            wait_for_exit_status()
+
+        def wait_for_exit_status():
+            if channel.exit_status_ready():
+                output.close()
+                future.set_result((channel.recv_exit_status(),
+                                   output.getvalue()))
+            else:
+                self.loop.call_later(EXIT_STATUS_POLL_INTERVAL,
+                                     wait_for_exit_status)
+
+        self.loop.add_reader(fd, on_readable)
+        return future
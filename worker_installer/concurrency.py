@@ -0,0 +1,125 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+
+import sys
+import time
+import threading
+import traceback
+
+DEFAULT_CONCURRENCY = 10
+
+
+class TaskResult(object):
+    """The outcome of running a task for a single item"""
+
+    def __init__(self, key):
+        self.key = key
+        self.result = None
+        self.error = None
+        self.traceback = None
+        self.timed_out = False
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def succeeded(self):
+        return self.finished_at is not None and \
+            self.error is None and not self.timed_out
+
+    @property
+    def duration(self):
+        if self.started_at is None:
+            return None
+        end = self.finished_at or time.time()
+        return end - self.started_at
+
+    def to_dict(self):
+        if self.timed_out:
+            status = 'timeout'
+        elif self.succeeded:
+            status = 'ok'
+        else:
+            status = 'failed'
+        return {
+            'status': status,
+            'error': str(self.error) if self.error is not None else None,
+            'duration': self.duration
+        }
+
+
+def run_bounded(func, items, concurrency=DEFAULT_CONCURRENCY, timeout=None,
+                key=str):
+    """
+    Calls ``func`` for every item in ``items`` on at most ``concurrency``
+    threads at a time, and returns a `TaskResult` per item, in order.
+
+    ``timeout`` limits, in seconds, how long a single item may run,
+    starting from when its thread starts. A thread cannot be interrupted,
+    so an item which times out is reported as such and its slot is given
+    to the next item, while the thread itself is left to finish in the
+    background.
+    """
+    if concurrency < 1:
+        raise ValueError('concurrency must be at least 1 but is: {0}'
+                         .format(concurrency))
+    results = [TaskResult(key(item)) for item in items]
+    condition = threading.Condition()
+    pending = list(reversed(range(len(items))))
+    running = set()
+
+    def worker(index):
+        result = results[index]
+        try:
+            value = func(items[index])
+            with condition:
+                result.result = value
+        except Exception as e:
+            with condition:
+                result.error = e
+                result.traceback = ''.join(
+                    traceback.format_exception(*sys.exc_info()))
+        finally:
+            with condition:
+                result.finished_at = time.time()
+                running.discard(index)
+                condition.notify()
+
+    with condition:
+        while pending or running:
+            while pending and len(running) < concurrency:
+                index = pending.pop()
+                results[index].started_at = time.time()
+                running.add(index)
+                thread = threading.Thread(target=worker, args=(index,))
+                thread.daemon = True
+                thread.start()
+            wait = None
+            if timeout is not None:
+                now = time.time()
+                for index in list(running):
+                    deadline = results[index].started_at + timeout
+                    if deadline <= now:
+                        results[index].timed_out = True
+                        running.discard(index)
+                    elif wait is None or deadline - now < wait:
+                        wait = deadline - now
+                if not running and not pending:
+                    break
+                if len(running) < concurrency and pending:
+                    continue
+            if running:
+                condition.wait(wait)
+    return results
@@ -0,0 +1,307 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+
+import os
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+DEFAULT_POOL_MAX_SIZE = 64
+DEFAULT_POOL_IDLE_TIMEOUT = 300
+DEFAULT_CONNECT_TIMEOUT = 10
+
+logger = logging.getLogger(__name__)
+
+
+def _credentials_fingerprint(key_filename, password):
+    """
+    A digest of the credentials used for a connection. The key file
+    modification time is included so that replacing the key file in place
+    is treated as an auth change.
+    """
+    digest = hashlib.sha1()
+    if key_filename:
+        key_path = os.path.expanduser(key_filename)
+        digest.update('key:{0}'.format(key_path))
+        if os.path.exists(key_path):
+            digest.update(':{0}'.format(os.path.getmtime(key_path)))
+    if password:
+        digest.update('password:{0}'.format(password))
+    return digest.hexdigest()
+
+
+def _host_key_fingerprint(client):
+    transport = client.get_transport()
+    if transport is None:
+        return None
+    host_key = transport.get_remote_server_key()
+    if host_key is None:
+        return None
+    return host_key.get_fingerprint().encode('hex')
+
+
+def connect(user, host, port, key_filename=None, password=None):
+    """creates a new paramiko client connected to the given endpoint"""
+    # paramiko, and the crypto libraries it loads, are imported by the
+    # first connection rather than by every process loading the plugin
+    import paramiko
+    client = paramiko.SSHClient()
+    # equivalent of fabric's disable_known_hosts
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    client.connect(
+        hostname=host,
+        port=int(port),
+        username=user,
+        key_filename=os.path.expanduser(key_filename)
+        if key_filename else None,
+        password=password,
+        timeout=DEFAULT_CONNECT_TIMEOUT)
+    return client
+
+
+def is_healthy(client):
+    """checks that the connection is still usable before handing it out"""
+    transport = client.get_transport()
+    if transport is None or not transport.is_active():
+        return False
+    try:
+        # forces a write on the socket so a dead peer is detected now
+        # rather than on the next command
+        transport.send_ignore()
+    except Exception:
+        return False
+    return True
+
+
+class _PooledConnection(object):
+
+    def __init__(self, endpoint, credentials, client):
+        self.endpoint = endpoint
+        self.credentials = credentials
+        self.client = client
+        self.last_used = time.time()
+        # checkouts not released yet
+        self.users = 0
+        # removed from the pool while in use, closed once released
+        self.discarded = False
+
+    def close(self):
+        try:
+            self.client.close()
+        except Exception:
+            pass
+
+
+class SSHConnectionPool(object):
+    """
+    A process wide, thread safe pool of SSH connections.
+
+    Connections are keyed by ``user@host:port`` and the credentials used to
+    open them, so that consecutive operations on the same agent host
+    (install, start, restart, stop and their retries) share a single SSH
+    session instead of paying for a handshake each time.
+
+    Connections idle for more than ``idle_timeout`` seconds are evicted, the
+    least recently used connection is closed when the pool grows beyond
+    ``max_size``, and every connection is health checked when it is
+    acquired.
+
+    Every acquired connection must be given back with `release` once the
+    channels opened on it are closed. Connections in use are never closed
+    by the pool: those invalidated meanwhile are closed when released, and
+    the pool may grow beyond ``max_size`` while all of them are in use.
+    """
+
+    def __init__(self,
+                 max_size=DEFAULT_POOL_MAX_SIZE,
+                 idle_timeout=DEFAULT_POOL_IDLE_TIMEOUT,
+                 connect_func=connect,
+                 health_check_func=is_healthy):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._connect = connect_func
+        self._is_healthy = health_check_func
+        self._connections = OrderedDict()
+        # connections checked out, by id of their client
+        self._in_use = {}
+        self._host_keys = {}
+        self._lock = threading.RLock()
+
+    def acquire(self, user, host, port, key_filename=None, password=None):
+        """
+        Returns a connected client for the given endpoint, reusing a pooled
+        connection when a healthy one exists. The client is given back with
+        `release`.
+        """
+        return self.acquire_connection(user, host, port,
+                                       key_filename=key_filename,
+                                       password=password)[0]
+
+    def acquire_connection(self, user, host, port, key_filename=None,
+                           password=None):
+        """
+        Like `acquire`, but returns the client together with whether it
+        was taken from the pool rather than newly connected.
+        """
+        endpoint = '{0}@{1}:{2}'.format(user, host, port)
+        credentials = _credentials_fingerprint(key_filename, password)
+        key = (endpoint, credentials)
+        with self._lock:
+            self._evict_idle()
+            # connections to the same endpoint with other credentials are
+            # stale once the credentials change
+            self._invalidate_where(
+                lambda conn: conn.endpoint == endpoint and
+                conn.credentials != credentials)
+            conn = self._checkout(key)
+            if conn is not None:
+                self._use(conn)
+                return conn.client, True
+
+        # the handshake happens outside the lock so that connecting to one
+        # host does not hold up operations on other hosts
+        logger.debug('Opening new connection to {0}'.format(endpoint))
+        client = self._connect(user, host, port,
+                               key_filename=key_filename,
+                               password=password)
+
+        with self._lock:
+            conn = self._checkout(key)
+            if conn is not None:
+                # another thread connected to the same endpoint meanwhile
+                _PooledConnection(endpoint, credentials, client).close()
+                self._use(conn)
+                return conn.client, True
+            self._verify_host_key(endpoint, client)
+            conn = _PooledConnection(endpoint, credentials, client)
+            self._connections[key] = conn
+            self._use(conn)
+            self._enforce_max_size()
+            return conn.client, False
+
+    def release(self, client):
+        """
+        Gives back a client returned by `acquire`. A connection invalidated
+        while in use is closed once its last user released it.
+        """
+        with self._lock:
+            conn = self._in_use.get(id(client))
+            if conn is None:
+                return
+            conn.users -= 1
+            conn.last_used = time.time()
+            if conn.users > 0:
+                return
+            del self._in_use[id(client)]
+            if conn.discarded:
+                conn.close()
+            else:
+                self._enforce_max_size()
+
+    def invalidate(self, user, host, port):
+        """closes all pooled connections to the given endpoint"""
+        endpoint = '{0}@{1}:{2}'.format(user, host, port)
+        with self._lock:
+            self._invalidate_where(lambda conn: conn.endpoint == endpoint)
+
+    def invalidate_host(self, host, port):
+        """closes all pooled connections to the given host, for any user"""
+        host_port = '{0}:{1}'.format(host, port)
+        with self._lock:
+            self._invalidate_where(
+                lambda conn: conn.endpoint.endswith('@' + host_port))
+            self._host_keys.pop(host_port, None)
+
+    def evict_idle(self):
+        with self._lock:
+            self._evict_idle()
+
+    def close_all(self):
+        with self._lock:
+            self._invalidate_where(lambda conn: True)
+            self._host_keys.clear()
+
+    def __len__(self):
+        return len(self._connections)
+
+    def _checkout(self, key):
+        conn = self._connections.get(key)
+        if conn is None:
+            return None
+        if not self._is_healthy(conn.client):
+            logger.debug('Discarding unhealthy connection to {0}'
+                         .format(conn.endpoint))
+            self._discard(key, conn)
+            return None
+        conn.last_used = time.time()
+        # most recently used connections are kept at the end
+        del self._connections[key]
+        self._connections[key] = conn
+        return conn
+
+    def _verify_host_key(self, endpoint, client):
+        fingerprint = _host_key_fingerprint(client)
+        if fingerprint is None:
+            return
+        host_port = endpoint.split('@', 1)[1]
+        known = self._host_keys.get(host_port)
+        if known is not None and known != fingerprint:
+            # the machine behind this address changed (e.g. it was healed),
+            # connections opened to the previous machine are worthless
+            logger.debug('Host key for {0} changed, invalidating pooled '
+                         'connections'.format(host_port))
+            self._invalidate_where(
+                lambda conn: conn.endpoint.endswith('@' + host_port))
+        self._host_keys[host_port] = fingerprint
+
+    def _evict_idle(self):
+        if self.idle_timeout is None:
+            return
+        deadline = time.time() - self.idle_timeout
+        self._invalidate_where(
+            lambda conn: not conn.users and conn.last_used < deadline)
+
+    def _enforce_max_size(self):
+        excess = len(self._connections) - self.max_size
+        # least recently used first
+        for key, conn in self._connections.items():
+            if excess <= 0:
+                break
+            if not conn.users:
+                self._discard(key, conn)
+                excess -= 1
+
+    def _invalidate_where(self, predicate):
+        for key, conn in self._connections.items():
+            if predicate(conn):
+                self._discard(key, conn)
+
+    def _use(self, conn):
+        conn.users += 1
+        self._in_use[id(conn.client)] = conn
+
+    def _discard(self, key, conn):
+        del self._connections[key]
+        if conn.users:
+            conn.discarded = True
+        else:
+            conn.close()
+
+
+# shared by all operations running in the management worker process
+connection_pool = SSHConnectionPool()
@@ -0,0 +1,481 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""
+A minimal single threaded event loop running generator based coroutines.
+
+Coroutines yield futures, other coroutines, or lists of these, and are
+resumed with their results once they are done. They return a value by
+raising `Return`:
+
+    def flow(runner):
+        output = yield runner.run('uname -a')
+        raise Return(output)
+
+    loop = EventLoop()
+    try:
+        print loop.run_until_complete(flow(runner))
+    finally:
+        loop.close()
+
+Blocking calls that have no non blocking counterpart, such as SSH
+handshakes, run on a small, bounded pool of executor threads.
+"""
+
+import collections
+import errno
+import heapq
+import itertools
+import os
+import select
+import sys
+import threading
+import time
+import traceback
+import types
+import Queue
+
+from worker_installer.concurrency import TaskResult
+
+DEFAULT_EXECUTOR_SIZE = 16
+
+_READ_EVENTS = getattr(select, 'POLLIN', 0) | getattr(select, 'POLLPRI', 0) \
+    | getattr(select, 'POLLERR', 0) | getattr(select, 'POLLHUP', 0)
+
+
+class Return(Exception):
+    """raised by a coroutine to return a value"""
+
+    def __init__(self, value=None):
+        Exception.__init__(self)
+        self.value = value
+
+
+class TimeoutError(Exception):
+    pass
+
+
+class CancelledError(Exception):
+    """what the tasks still running when their loop is closed fail with"""
+
+
+class Future(object):
+    """The eventual result of an operation running on an `EventLoop`"""
+
+    def __init__(self):
+        self._done = False
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        if not self._done:
+            raise RuntimeError('result is not ready')
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self):
+        if not self._done:
+            raise RuntimeError('result is not ready')
+        return self._exc_info[1] if self._exc_info is not None else None
+
+    def set_result(self, result):
+        if self._done:
+            return
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exception):
+        self.set_exc_info((type(exception), exception, None))
+
+    def set_exc_info(self, exc_info):
+        if self._done:
+            return
+        self._exc_info = exc_info
+        self._finish()
+
+    def add_done_callback(self, callback):
+        if self._done:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def _finish(self):
+        self._done = True
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
+class Task(Future):
+    """Drives a coroutine on an event loop, resolving to its return value"""
+
+    def __init__(self, loop, coroutine):
+        Future.__init__(self)
+        self._loop = loop
+        self._coroutine = coroutine
+        loop._tasks.add(self)
+        self.add_done_callback(loop._tasks.discard)
+        loop.call_soon(self._step, None, None)
+
+    def cancel(self):
+        """
+        Closes the coroutine where it waits, running its finally blocks,
+        and fails with `CancelledError`.
+        """
+        if self._done:
+            return
+        try:
+            self._coroutine.close()
+        except Exception:
+            self.set_exc_info(sys.exc_info())
+        else:
+            self.set_exception(CancelledError('event loop closed'))
+
+    def _step(self, value, exc_info):
+        try:
+            if exc_info is not None:
+                yielded = self._coroutine.throw(*exc_info)
+            else:
+                yielded = self._coroutine.send(value)
+        except StopIteration:
+            self.set_result(None)
+            return
+        except Return as e:
+            self.set_result(e.value)
+            return
+        except Exception:
+            self.set_exc_info(sys.exc_info())
+            return
+        yielded = _as_future(self._loop, yielded)
+        if not isinstance(yielded, Future):
+            error = TypeError('coroutines may only yield futures and '
+                              'coroutines, got: {0!r}'.format(yielded))
+            self._loop.call_soon(self._step, None,
+                                 (TypeError, error, None))
+            return
+        yielded.add_done_callback(self._wakeup)
+
+    def _wakeup(self, future):
+        # resume on the next iteration rather than from within the callback
+        # of the future, so long chains of ready futures never nest
+        self._loop.call_soon(self._step, future._result, future._exc_info)
+
+
+def _as_future(loop, value):
+    # a coroutine yielding another coroutine waits for it, the way yield
+    # from does in python 3
+    if isinstance(value, types.GeneratorType):
+        return loop.spawn(value)
+    if isinstance(value, (list, tuple)):
+        return gather([_as_future(loop, item) for item in value])
+    return value
+
+
+def gather(futures):
+    """
+    A future resolving to the list of results of ``futures``, or to the
+    first error raised by any of them.
+    """
+    futures = list(futures)
+    gathered = Future()
+    if not futures:
+        gathered.set_result([])
+        return gathered
+    remaining = [len(futures)]
+
+    def on_done(future):
+        if future._exc_info is not None:
+            gathered.set_exc_info(future._exc_info)
+            return
+        remaining[0] -= 1
+        if remaining[0] == 0:
+            gathered.set_result([f._result for f in futures])
+    for future in futures:
+        future.add_done_callback(on_done)
+    return gathered
+
+
+class EventLoop(object):
+
+    def __init__(self, executor_size=DEFAULT_EXECUTOR_SIZE):
+        self._ready = collections.deque()
+        self._timers = []
+        self._timer_sequence = itertools.count()
+        self._readers = {}
+        self._threadsafe_lock = threading.Lock()
+        self._threadsafe = []
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        self._executor_size = executor_size
+        self._executor_queue = Queue.Queue()
+        self._executor_threads = []
+        self._executor_lock = threading.Lock()
+        self._executor_idle = 0
+        self._tasks = set()
+        self._closing = False
+        self._closed = False
+
+    def time(self):
+        return time.time()
+
+    def call_soon(self, callback, *args):
+        self._ready.append((callback, args))
+
+    def call_later(self, delay, callback, *args):
+        """
+        Schedules ``callback`` to run after ``delay`` seconds and returns
+        a handle that can be passed to `cancel_timer`.
+        """
+        timer = [self.time() + delay, next(self._timer_sequence),
+                 callback, args]
+        heapq.heappush(self._timers, timer)
+        return timer
+
+    def cancel_timer(self, timer):
+        timer[2] = None
+
+    def call_soon_threadsafe(self, callback, *args):
+        if self._closed:
+            return
+        with self._threadsafe_lock:
+            self._threadsafe.append((callback, args))
+        try:
+            os.write(self._wakeup_write, 'x')
+        except OSError:
+            pass
+
+    def add_reader(self, fd, callback, *args):
+        self._readers[fd] = (callback, args)
+
+    def remove_reader(self, fd):
+        self._readers.pop(fd, None)
+
+    def sleep(self, delay):
+        future = Future()
+        self.call_later(delay, future.set_result, None)
+        return future
+
+    def spawn(self, coroutine):
+        """starts running ``coroutine`` and returns its `Task`"""
+        return Task(self, coroutine)
+
+    def run_in_executor(self, func, *args):
+        """
+        Calls ``func`` on one of the executor threads and returns a future
+        resolving to its result.
+        """
+        future = Future()
+        if self._closing:
+            future.set_exception(CancelledError('event loop closed'))
+            return future
+        with self._executor_lock:
+            self._executor_queue.put((future, func, args))
+            start_thread = self._executor_idle == 0 and \
+                len(self._executor_threads) < self._executor_size
+            if start_thread:
+                thread = threading.Thread(target=self._executor_worker)
+                thread.daemon = True
+                self._executor_threads.append(thread)
+        if start_thread:
+            thread.start()
+        return future
+
+    def with_timeout(self, future, timeout):
+        """
+        A future resolving like ``future``, or to `TimeoutError` if it is
+        not done within ``timeout`` seconds. ``future`` itself keeps
+        running.
+        """
+        if timeout is None:
+            return future
+        limited = Future()
+        timer = self.call_later(
+            timeout, limited.set_exception,
+            TimeoutError('timed out after {0} seconds'.format(timeout)))
+
+        def on_done(done):
+            self.cancel_timer(timer)
+            if done._exc_info is not None:
+                limited.set_exc_info(done._exc_info)
+            else:
+                limited.set_result(done._result)
+        future.add_done_callback(on_done)
+        return limited
+
+    def run_until_complete(self, future):
+        """
+        Runs the loop until ``future`` is done and returns its result.
+        Anything a coroutine may yield can be given instead of a future.
+        """
+        future = _as_future(self, future)
+        while not future.done():
+            self._run_once()
+        return future.result()
+
+    def close(self):
+        """
+        Waits for the executor threads to finish what they are running,
+        hands their results over to the coroutines waiting for them, and
+        cancels the tasks still running (see `Task.cancel`).
+        """
+        if self._closed:
+            return
+        self._closing = True
+        for _ in self._executor_threads:
+            self._executor_queue.put(None)
+        for thread in self._executor_threads:
+            thread.join()
+        # coroutines given a connection by the executor get to own it, so
+        # that their finally blocks release it below
+        with self._threadsafe_lock:
+            threadsafe, self._threadsafe = self._threadsafe, []
+        self._ready.extend(threadsafe)
+        while self._ready:
+            callback, args = self._ready.popleft()
+            callback(*args)
+        while self._tasks:
+            self._tasks.pop().cancel()
+        self._ready.clear()
+        self._timers = []
+        self._readers.clear()
+        self._closed = True
+        os.close(self._wakeup_read)
+        os.close(self._wakeup_write)
+
+    def _executor_worker(self):
+        while True:
+            with self._executor_lock:
+                self._executor_idle += 1
+            work = self._executor_queue.get()
+            with self._executor_lock:
+                self._executor_idle -= 1
+            if work is None:
+                return
+            future, func, args = work
+            try:
+                result = func(*args)
+            except Exception:
+                self.call_soon_threadsafe(future.set_exc_info,
+                                          sys.exc_info())
+            else:
+                self.call_soon_threadsafe(future.set_result, result)
+
+    def _run_once(self):
+        timeout = None
+        if self._ready:
+            timeout = 0
+        elif self._timers:
+            timeout = max(0, self._timers[0][0] - self.time())
+        for fd in self._poll(timeout):
+            if fd == self._wakeup_read:
+                self._drain_wakeup()
+            elif fd in self._readers:
+                callback, args = self._readers[fd]
+                self._ready.append((callback, args))
+        with self._threadsafe_lock:
+            threadsafe, self._threadsafe = self._threadsafe, []
+        self._ready.extend(threadsafe)
+        now = self.time()
+        while self._timers and self._timers[0][0] <= now:
+            _, _, callback, args = heapq.heappop(self._timers)
+            if callback is not None:
+                self._ready.append((callback, args))
+        # callbacks scheduled while running these wait for the next round
+        for _ in range(len(self._ready)):
+            callback, args = self._ready.popleft()
+            callback(*args)
+
+    def _poll(self, timeout):
+        fds = list(self._readers) + [self._wakeup_read]
+        try:
+            if hasattr(select, 'poll'):
+                # unlike select, poll is not limited to FD_SETSIZE fds
+                poller = select.poll()
+                for fd in fds:
+                    poller.register(fd, _READ_EVENTS)
+                return [fd for fd, _ in poller.poll(
+                    None if timeout is None else timeout * 1000)]
+            readable, _, _ = select.select(fds, [], [], timeout)
+            return readable
+        except (select.error, IOError, OSError) as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+    def _drain_wakeup(self):
+        try:
+            os.read(self._wakeup_read, 4096)
+        except OSError:
+            pass
+
+
+def run_bounded(loop, func, items, concurrency, timeout=None, key=str):
+    """
+    The event loop counterpart of `concurrency.run_bounded`: runs the
+    coroutine returned by ``func`` for every item in ``items``, at most
+    ``concurrency`` at a time, and returns a future resolving to a
+    `TaskResult` per item, in order.
+
+    An item which times out is reported as such and its slot is given to
+    the next item, while its coroutine keeps running in the background.
+    An item for which ``func`` raises is reported as failed like one whose
+    coroutine raises.
+    """
+    if concurrency < 1:
+        raise ValueError('concurrency must be at least 1 but is: {0}'
+                         .format(concurrency))
+    results = [TaskResult(key(item)) for item in items]
+    done = Future()
+    pending = collections.deque(range(len(items)))
+    running = [0]
+
+    def start_next():
+        while pending and running[0] < concurrency:
+            index = pending.popleft()
+            running[0] += 1
+            results[index].started_at = time.time()
+            try:
+                task = loop.with_timeout(loop.spawn(func(items[index])),
+                                         timeout)
+            except Exception:
+                # failing to even create the item's coroutine fails this
+                # item alone
+                task = Future()
+                task.set_exc_info(sys.exc_info())
+            task.add_done_callback(
+                lambda future, index=index: finish(index, future))
+        if not pending and running[0] == 0:
+            done.set_result(results)
+
+    def finish(index, future):
+        result = results[index]
+        result.finished_at = time.time()
+        if future._exc_info is None:
+            result.result = future._result
+        elif isinstance(future._exc_info[1], TimeoutError):
+            result.timed_out = True
+        else:
+            result.error = future._exc_info[1]
+            result.traceback = ''.join(
+                traceback.format_exception(*future._exc_info))
+        running[0] -= 1
+        loop.call_soon(start_next)
+
+    start_next()
+    return done
@@ -0,0 +1,285 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+
+import os
+import platform
+import pwd
+from distutils.spawn import find_executable
+
+from cloudify.exceptions import NonRecoverableError
+
+FACTS_DELIM_START = '###CLOUDIFYFACTSOPEN'
+FACTS_DELIM_END = 'CLOUDIFYFACTSCLOSE###'
+
+PROBED_TOOLS = ['wget', 'curl', 'python', 'sha256sum']
+
+# facts which do not change between operations on the same host and can be
+# remembered across operations
+STABLE_FACTS = ['distro', 'distro_version', 'distro_codename', 'home_dir',
+                'tools']
+
+# runs on the host when a python interpreter is available. exits with an
+# error when platform.dist is not available so the shell fallback is used.
+_PYTHON_PROBE = '''import os, pwd, platform, sys
+if not hasattr(platform, 'dist'):
+    sys.exit(1)
+dist = platform.dist()
+home = '{home_dir}' or pwd.getpwnam('{user}').pw_dir
+stat = os.statvfs(home)
+facts = [
+    ('distro', dist[0]),
+    ('distro_version', dist[1]),
+    ('distro_codename', dist[2]),
+    ('home_dir', home),
+    ('cpu_count', os.sysconf('SC_NPROCESSORS_ONLN')),
+    ('memory_total',
+     os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')),
+    ('disk_free', stat.f_bavail * stat.f_frsize),
+    ('base_dir_exists',
+     os.path.exists(os.path.join(home, 'cloudify.{name}'))),
+    ('init_file_exists', os.path.exists('{init_file}'))]
+sys.stdout.write(''.join('%s=%s\\n' % fact for fact in facts))'''
+
+# used when python is missing on the host or is too new for platform.dist.
+# distros are named the way platform.dist names them, e.g. centos, redhat
+# and Ubuntu, whatever lsb_release or os-release call them
+_SHELL_PROBE = '''home='{home_dir}'
+[ -n "$home" ] || home=$(getent passwd {user} | cut -d: -f6)
+[ -n "$home" ] || home=$(eval echo ~{user})
+if command -v lsb_release > /dev/null 2>&1; then
+distro=$(lsb_release -si)
+echo "distro_version=$(lsb_release -sr)"
+echo "distro_codename=$(lsb_release -sc)"
+elif [ -r /etc/os-release ]; then
+distro=$(. /etc/os-release; echo "$ID")
+( . /etc/os-release; echo "distro_version=$VERSION_ID";
+echo "distro_codename=$VERSION_CODENAME" )
+fi
+distro=$(echo "$distro" | tr 'A-Z' 'a-z')
+case "$distro" in
+ubuntu) distro=Ubuntu ;;
+rhel|redhat*) distro=redhat ;;
+suse*|opensuse*) distro=SuSE ;;
+esac
+echo "distro=$distro"
+echo "home_dir=$home"
+echo "cpu_count=$(getconf _NPROCESSORS_ONLN)"
+mem=$(awk '/MemTotal/ {{printf "%.0f", $2 * 1024}}' /proc/meminfo)
+echo "memory_total=$mem"
+disk=$(df -Pk "$home" | awk 'NR == 2 {{printf "%.0f", $4 * 1024}}')
+echo "disk_free=$disk"
+if [ -e "$home/cloudify.{name}" ]; then echo base_dir_exists=True;
+else echo base_dir_exists=False; fi
+if [ -e {init_file} ]; then echo init_file_exists=True;
+else echo init_file_exists=False; fi'''
+
+
+def probe_command(user, name, home_dir=None):
+    """
+    A single shell command printing all host facts as ``key=value`` lines
+    between delimiters.
+    """
+    values = {
+        'user': user,
+        'name': name,
+        'home_dir': home_dir or '',
+        'init_file': '/etc/init.d/celeryd-{0}'.format(name)
+    }
+    lines = ["echo '{0}'".format(FACTS_DELIM_START)]
+    for tool in PROBED_TOOLS:
+        lines.append('if command -v {0} > /dev/null 2>&1; '
+                     'then echo tool={0}; fi'.format(tool))
+    lines.append('python -c "{0}" 2> /dev/null || {{\n{1}\n}}'.format(
+        _PYTHON_PROBE.format(**values), _SHELL_PROBE.format(**values)))
+    lines.append("echo '{0}'".format(FACTS_DELIM_END))
+    return '\n'.join(lines)
+
+
+def parse_facts(output):
+    """parses the delimited output of `probe_command` into a dict"""
+    start = output.find(FACTS_DELIM_START)
+    end = output.find(FACTS_DELIM_END)
+    if start == -1 or end == -1:
+        raise NonRecoverableError(
+            'Failed probing host facts, unexpected output: {0}'
+            .format(output))
+    facts = {'tools': []}
+    for line in output[start + len(FACTS_DELIM_START):end].splitlines():
+        key, sep, value = line.strip().partition('=')
+        if not sep:
+            continue
+        if key == 'tool':
+            facts['tools'].append(value)
+        else:
+            facts[key] = value
+    return facts
+
+
+def run_probe(runner, user, name, home_dir=None):
+    return runner.run(probe_command(user, name, home_dir))
+
+
+def local_facts(user, name, home_dir=None):
+    """
+    The facts `probe_command` would print for this machine, gathered in
+    process, in the form `parse_facts` returns them.
+    """
+    dist = platform.dist() if hasattr(platform, 'dist') else ('', '', '')
+    if not home_dir:
+        try:
+            home_dir = pwd.getpwnam(user).pw_dir
+        except KeyError:
+            home_dir = os.path.expanduser('~{0}'.format(user))
+    facts = {
+        'tools': [tool for tool in PROBED_TOOLS if find_executable(tool)],
+        'distro': dist[0],
+        'distro_version': dist[1],
+        'distro_codename': dist[2],
+        'home_dir': home_dir,
+        'cpu_count': str(os.sysconf('SC_NPROCESSORS_ONLN')),
+        'memory_total': str(os.sysconf('SC_PAGE_SIZE') *
+                            os.sysconf('SC_PHYS_PAGES')),
+        'base_dir_exists': str(os.path.exists(
+            os.path.join(home_dir, 'cloudify.{0}'.format(name)))),
+        'init_file_exists': str(os.path.exists(
+            '/etc/init.d/celeryd-{0}'.format(name)))
+    }
+    try:
+        stat = os.statvfs(home_dir)
+        facts['disk_free'] = str(stat.f_bavail * stat.f_frsize)
+    except OSError:
+        pass
+    return facts
+
+
+def _int_or_none(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class HostFacts(object):
+    """
+    Facts about the agent's host, gathered by a single remote probe, or
+    in process for local agents.
+
+    The probe runs the first time any fact is read, so operations that
+    already know everything they need never pay for it. Stable facts
+    remembered from previous operations can be passed as ``known_facts``
+    and are served without probing.
+    """
+
+    def __init__(self, runner, agent_config, known_facts=None):
+        self._runner = runner
+        self._known = dict(known_facts or {})
+        self._user = agent_config['user']
+        self._name = agent_config['name']
+        self._home_dir = agent_config.get('home_dir') or \
+            self._known.get('home_dir')
+        self._facts = None
+        self.forgotten = False
+
+    @property
+    def probed(self):
+        return self._facts is not None
+
+    def stable_facts(self):
+        """the stable facts known so far, without probing"""
+        facts = dict(self._known)
+        if self._facts is not None:
+            facts.update(self._facts)
+        return dict((key, facts[key]) for key in STABLE_FACTS
+                    if facts.get(key) is not None)
+
+    def forget(self):
+        """marks the remembered facts as no longer valid for this host"""
+        self._known = {}
+        self.forgotten = True
+
+    def probe(self):
+        if self.local:
+            self._facts = local_facts(self._user, self._name,
+                                      self._home_dir)
+            return self._facts
+        return self.load(run_probe(self._runner, self._user, self._name,
+                                   self._home_dir))
+
+    @property
+    def local(self):
+        """whether the facts are those of this machine"""
+        return getattr(self._runner, 'local', False) is True
+
+    def probe_command(self):
+        return probe_command(self._user, self._name, self._home_dir)
+
+    def load(self, output):
+        """
+        Uses the output of `probe_command`, run by the caller, instead of
+        probing.
+        """
+        self._facts = parse_facts(output)
+        return self._facts
+
+    def get(self, key, default=None):
+        if self._facts is None:
+            if key in self._known:
+                return self._known[key]
+            self.probe()
+        return self._facts.get(key, default)
+
+    @property
+    def distro(self):
+        return self.get('distro')
+
+    @property
+    def distro_version(self):
+        return self.get('distro_version')
+
+    @property
+    def distro_codename(self):
+        return self.get('distro_codename')
+
+    @property
+    def home_dir(self):
+        return self.get('home_dir')
+
+    @property
+    def tools(self):
+        return self.get('tools', [])
+
+    @property
+    def cpu_count(self):
+        return _int_or_none(self.get('cpu_count'))
+
+    @property
+    def memory_total(self):
+        return _int_or_none(self.get('memory_total'))
+
+    @property
+    def disk_free(self):
+        return _int_or_none(self.get('disk_free'))
+
+    @property
+    def base_dir_exists(self):
+        return self.get('base_dir_exists') == 'True'
+
+    @property
+    def init_file_exists(self):
+        return self.get('init_file_exists') == 'True'
+
+    def has_tool(self, tool):
+        return tool in self.tools
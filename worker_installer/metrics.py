@@ -0,0 +1,246 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""
+Durations of the phases of agent operations (prepare, package, service
+etc.), for watching install latency across the fleet.
+
+Every operation times its phases with a `PhaseTimer`. Once it is done,
+the durations of the phases it completed are added to histograms keyed by
+operation, outcome (success or failure), phase and distro, which are kept
+for the whole process and written in the Prometheus text format to a file
+for node exporter's textfile collector, and/or sent as timers to a statsd
+compatible daemon.
+
+The management worker may run several processes, so each one writes its
+own file, named and labeled after its pid, and removes it when it exits.
+"""
+
+import atexit
+import logging
+import os
+import re
+import socket
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_DIR_ENV = 'CLOUDIFY_AGENT_METRICS_DIR'
+METRICS_STATSD_ENV = 'CLOUDIFY_AGENT_METRICS_STATSD'
+DEFAULT_STATSD_PORT = 8125
+METRIC_NAME = 'cloudify_agent_phase_duration_seconds'
+STATSD_PREFIX = 'cloudify_agent'
+# in seconds, from a single command to a slow package download
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# the phase covering the whole operation
+OPERATION_PHASE = 'operation'
+OUTCOME_SUCCESS = 'success'
+OUTCOME_FAILURE = 'failure'
+
+logger = logging.getLogger('worker_installer.metrics')
+
+
+class Histogram(object):
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # cumulative, like the buckets of a prometheus histogram
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class PhaseMetrics(object):
+    """The phase duration histograms of the process"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._histograms = {}
+        self._lock = threading.Lock()
+        # the files written by this process, removed when it exits
+        self._textfiles = set()
+
+    def observe(self, operation, phase, distro, seconds,
+                outcome=OUTCOME_SUCCESS):
+        key = (operation, outcome, phase, distro or 'unknown')
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def render(self, labels=None):
+        """the histograms in the Prometheus text format"""
+        extra = ''.join(',{0}="{1}"'.format(name, _escape(value))
+                        for name, value in sorted((labels or {}).items()))
+        lines = [
+            '# HELP {0} Duration of the phases of agent operations.'
+            .format(METRIC_NAME),
+            '# TYPE {0} histogram'.format(METRIC_NAME)
+        ]
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            for key, histogram in histograms:
+                series = 'operation="{0}",outcome="{1}",phase="{2}",' \
+                    'distro="{3}"{4}'.format(*(map(_escape, key) + [extra]))
+                for bound, count in zip(histogram.buckets,
+                                        histogram.counts):
+                    lines.append('{0}_bucket{{{1},le="{2}"}} {3}'.format(
+                        METRIC_NAME, series, bound, count))
+                lines.append('{0}_bucket{{{1},le="+Inf"}} {2}'.format(
+                    METRIC_NAME, series, histogram.count))
+                lines.append('{0}_sum{{{1}}} {2!r}'.format(
+                    METRIC_NAME, series, histogram.sum))
+                lines.append('{0}_count{{{1}}} {2}'.format(
+                    METRIC_NAME, series, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, directory):
+        """
+        Writes the histograms to this process' file in ``directory``,
+        atomically, so that the collector never reads a partial file. The
+        file is removed when the process exits, so that the series of
+        processes gone do not stay around.
+        """
+        pid = os.getpid()
+        path = os.path.join(directory,
+                            'cloudify_agent_installer_{0}.prom'.format(pid))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.render({'pid': pid}))
+            os.rename(temp_path, path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+        with self._lock:
+            if not self._textfiles:
+                atexit.register(self.remove_textfiles)
+            self._textfiles.add((pid, path))
+        return path
+
+    def remove_textfiles(self):
+        """removes the files written by this process"""
+        pid = os.getpid()
+        with self._lock:
+            # forked processes inherit the files of their parent
+            paths = [path for writer, path in self._textfiles
+                     if writer == pid]
+            self._textfiles.clear()
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+phase_metrics = PhaseMetrics()
+
+
+class PhaseTimer(object):
+    """
+    Times the phases of one operation on one agent. Only phases that
+    complete are recorded.
+    """
+
+    def __init__(self, operation, metrics_dir=None, statsd_address=None,
+                 metrics=None):
+        self.operation = operation
+        self.metrics_dir = metrics_dir
+        self.statsd_address = statsd_address
+        self.metrics = metrics or phase_metrics
+        self.started_at = time.time()
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        started_at = time.time()
+        yield
+        self.phases.append((name, time.time() - started_at))
+
+    def publish(self, distro, outcome=OUTCOME_SUCCESS):
+        """
+        Adds the phases, and the whole operation, to the histograms of the
+        process and exports them. Exporting never fails the operation.
+        """
+        phases = self.phases + [(OPERATION_PHASE,
+                                 time.time() - self.started_at)]
+        for name, seconds in phases:
+            self.metrics.observe(self.operation, name, distro, seconds,
+                                 outcome)
+        if self.metrics_dir:
+            try:
+                self.metrics.write_textfile(self.metrics_dir)
+            except (IOError, OSError) as e:
+                logger.warning('Could not write metrics to {0}: {1}'.format(
+                    self.metrics_dir, e))
+        if self.statsd_address:
+            try:
+                send_statsd_timers(self.statsd_address, self.operation,
+                                   distro, phases, outcome)
+            except (socket.error, ValueError) as e:
+                logger.warning('Could not send metrics to {0}: {1}'.format(
+                    self.statsd_address, e))
+
+
+def phase(runner, name):
+    """times the block as phase ``name`` of the operation of ``runner``"""
+    if runner.phases is None:
+        return _untimed()
+    return runner.phases.phase(name)
+
+
+@contextmanager
+def _untimed():
+    yield
+
+
+def send_statsd_timers(address, operation, distro, phases,
+                       outcome=OUTCOME_SUCCESS):
+    """
+    Sends the ``(phase, seconds)`` pairs in ``phases`` as statsd timers,
+    named ``cloudify_agent.<operation>.<outcome>.<distro>.<phase>``, in a
+    single datagram.
+    """
+    host, _, port = address.partition(':')
+    lines = ['{0}.{1}.{2}.{3}.{4}:{5:.3f}|ms'.format(
+        STATSD_PREFIX, _statsd_name(operation), _statsd_name(outcome),
+        _statsd_name(distro), _statsd_name(name), seconds * 1000)
+        for name, seconds in phases]
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.sendto('\n'.join(lines),
+                    (host, int(port or DEFAULT_STATSD_PORT)))
+    finally:
+        sock.close()
+
+
+def _statsd_name(value):
+    return re.sub(r'[^A-Za-z0-9_-]', '_', value or 'unknown')
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"') \
+        .replace('\n', r'\n')
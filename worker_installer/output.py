@@ -0,0 +1,206 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""
+Output policies of `FabricRunner.run`.
+
+By default the whole output of a command is kept and returned. Given an
+output policy, the memory used for the output stays constant however
+chatty the command is:
+
+- `DiscardedOutput` keeps nothing but the output's size.
+- `TailOutput` keeps the last ``max_bytes`` of the output.
+- `StreamedOutput` hands every line of the output to a callback as it
+  arrives (see `logged_output`), at most ``max_lines`` lines every
+  ``interval`` seconds, and keeps a short tail.
+
+What a policy kept (its `getvalue`) is what ``run`` returns, and what a
+failing command's `FabricRunnerException` carries.
+"""
+
+import collections
+import logging
+import time
+
+DEFAULT_TAIL_BYTES = 64 * 1024
+DEFAULT_STREAM_TAIL_BYTES = 4 * 1024
+# longer lines are handed over in pieces
+DEFAULT_MAX_LINE_BYTES = 4 * 1024
+DEFAULT_STREAM_INTERVAL = 1.0
+DEFAULT_STREAM_MAX_LINES = 20
+
+
+def normalized(output):
+    """output read from a pty, with its line endings fixed and stripped"""
+    return output.replace('\r\n', '\n').strip()
+
+
+class OutputPolicy(object):
+    """
+    Receives the output of a command in chunks, as it is read. ``size``
+    is the number of bytes received so far.
+    """
+
+    def __init__(self):
+        self.size = 0
+
+    def feed(self, data):
+        self.size += len(data)
+
+    def close(self):
+        """called once the whole output was fed"""
+        pass
+
+    def getvalue(self):
+        return ''
+
+
+class CapturedOutput(OutputPolicy):
+    """keeps the whole output, the default"""
+
+    def __init__(self):
+        OutputPolicy.__init__(self)
+        self._chunks = []
+
+    def feed(self, data):
+        OutputPolicy.feed(self, data)
+        self._chunks.append(data)
+
+    def getvalue(self):
+        return normalized(''.join(self._chunks))
+
+
+class DiscardedOutput(OutputPolicy):
+    """keeps nothing of the output"""
+
+
+class TailOutput(OutputPolicy):
+    """keeps the last ``max_bytes`` of the output"""
+
+    def __init__(self, max_bytes=DEFAULT_TAIL_BYTES):
+        OutputPolicy.__init__(self)
+        self.max_bytes = max_bytes
+        self._chunks = collections.deque()
+        self._buffered = 0
+
+    @property
+    def truncated(self):
+        return self.size > self.max_bytes
+
+    def feed(self, data):
+        OutputPolicy.feed(self, data)
+        data = data[-self.max_bytes:]
+        self._chunks.append(data)
+        self._buffered += len(data)
+        # whole chunks are dropped once the rest is enough of a tail
+        while self._buffered - len(self._chunks[0]) >= self.max_bytes:
+            self._buffered -= len(self._chunks.popleft())
+
+    def getvalue(self):
+        return normalized(''.join(self._chunks)[-self.max_bytes:])
+
+
+class LineOutput(OutputPolicy):
+    """splits the output into lines, handed to `line` one at a time"""
+
+    def __init__(self, max_line_bytes=DEFAULT_MAX_LINE_BYTES):
+        OutputPolicy.__init__(self)
+        self.max_line_bytes = max_line_bytes
+        self._partial = ''
+
+    def feed(self, data):
+        OutputPolicy.feed(self, data)
+        lines = (self._partial + data).split('\n')
+        self._partial = lines.pop()
+        for line in lines:
+            self.line(_strip_cr(line))
+        while len(self._partial) > self.max_line_bytes:
+            self.line(self._partial[:self.max_line_bytes])
+            self._partial = self._partial[self.max_line_bytes:]
+
+    def close(self):
+        if self._partial:
+            self.line(_strip_cr(self._partial))
+            self._partial = ''
+
+    def line(self, line):
+        raise NotImplementedError()
+
+
+class StreamedOutput(LineOutput):
+    """
+    Hands every line of the output to ``callback``. Lines beyond
+    ``max_lines`` in ``interval`` seconds are skipped, and the number of
+    lines skipped is reported instead. The last ``tail_bytes`` of the
+    output are kept.
+    """
+
+    def __init__(self, callback, interval=DEFAULT_STREAM_INTERVAL,
+                 max_lines=DEFAULT_STREAM_MAX_LINES,
+                 tail_bytes=DEFAULT_STREAM_TAIL_BYTES,
+                 max_line_bytes=DEFAULT_MAX_LINE_BYTES,
+                 clock=time.time):
+        LineOutput.__init__(self, max_line_bytes)
+        self.callback = callback
+        self.interval = interval
+        self.max_lines = max_lines
+        self.clock = clock
+        self.skipped = 0
+        self._tail = TailOutput(tail_bytes)
+        self._window_start = None
+        self._window_lines = 0
+        self._window_skipped = 0
+
+    def feed(self, data):
+        LineOutput.feed(self, data)
+        self._tail.feed(data)
+
+    def close(self):
+        LineOutput.close(self)
+        self._report_skipped()
+
+    def line(self, line):
+        now = self.clock()
+        if self._window_start is None or \
+                now - self._window_start >= self.interval:
+            self._report_skipped()
+            self._window_start = now
+            self._window_lines = 0
+        if self._window_lines < self.max_lines:
+            self._window_lines += 1
+            self.callback(line)
+        else:
+            self._window_skipped += 1
+            self.skipped += 1
+
+    def getvalue(self):
+        return self._tail.getvalue()
+
+    def _report_skipped(self):
+        if self._window_skipped:
+            self.callback('... {0} lines skipped'.format(
+                self._window_skipped))
+            self._window_skipped = 0
+
+
+def logged_output(logger, level=logging.DEBUG, prefix='', **kwargs):
+    """a `StreamedOutput` logging the lines of the output to ``logger``"""
+    return StreamedOutput(
+        lambda line: logger.log(level, '{0}{1}'.format(prefix, line)),
+        **kwargs)
+
+
+def _strip_cr(line):
+    return line[:-1] if line.endswith('\r') else line
@@ -0,0 +1,167 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""
+Profiles agent operations on the management worker, without patching the
+plugin.
+
+With ``cpu`` profiling, the operation runs under cProfile and its stats
+are saved to ``<key>.<operation>.prof``, readable with `pstats`. With
+``memory`` profiling, the allocations made by the operation are traced
+with tracemalloc, where available (it is not part of python 2.7), and its
+top allocation sites are saved to ``<key>.<operation>.memory.txt``.
+
+The files of previous runs of the same operation are rotated to ``.1``,
+``.2`` etc., and the oldest are dropped once the files of an operation
+take more than ``max_bytes``.
+"""
+
+import cProfile
+import logging
+import os
+import tempfile
+from contextlib import contextmanager
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+PROFILE_ENV = 'CLOUDIFY_AGENT_PROFILE'
+PROFILE_DIR_ENV = 'CLOUDIFY_AGENT_PROFILE_DIR'
+DEFAULT_PROFILE_DIR = os.path.join(tempfile.gettempdir(),
+                                   'cloudify-agent-profiles')
+CPU = 'cpu'
+MEMORY = 'memory'
+MODES = (CPU, MEMORY)
+DEFAULT_BACKUPS = 5
+DEFAULT_MAX_BYTES = 50 * 1024 * 1024
+# frames kept for every traced allocation
+MEMORY_TRACE_DEPTH = 25
+MEMORY_TOP_ALLOCATIONS = 50
+
+logger = logging.getLogger('worker_installer.profiling')
+
+
+def parse_modes(value):
+    """
+    The profiling modes named in ``value``, e.g. ``cpu,memory``. ``true``
+    stands for ``cpu``, and ``false`` or nothing for no profiling.
+    """
+    value = str(value or '').strip().lower()
+    if value in ('', 'false'):
+        return set()
+    if value == 'true':
+        return set([CPU])
+    modes = set(mode.strip() for mode in value.split(','))
+    unknown = modes - set(MODES)
+    if unknown:
+        raise ValueError('unknown profiling modes: {0}'.format(
+            ', '.join(sorted(unknown))))
+    return modes
+
+
+def profile_path(profile_dir, key, operation_name, suffix):
+    return os.path.join(profile_dir, '{0}.{1}.{2}'.format(
+        key, operation_name or 'operation', suffix))
+
+
+@contextmanager
+def profiled(modes, profile_dir, key, operation_name,
+             backups=DEFAULT_BACKUPS, max_bytes=DEFAULT_MAX_BYTES):
+    """
+    Profiles the block in ``modes``, and saves the stats to
+    ``profile_dir`` under ``key`` and ``operation_name``. Failing to save
+    them never fails the block.
+    """
+    profiler = cProfile.Profile() if CPU in modes else None
+    trace_memory = False
+    if MEMORY in modes:
+        if tracemalloc is None:
+            logger.warning('Memory profiling requested but tracemalloc is '
+                           'not available, profiling cpu only')
+        elif tracemalloc.is_tracing():
+            # tracing is process wide, another operation is being traced
+            logger.warning('Memory is already traced, not tracing {0} of '
+                           '{1}'.format(operation_name, key))
+        else:
+            trace_memory = True
+            tracemalloc.start(MEMORY_TRACE_DEPTH)
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        snapshot = None
+        if trace_memory:
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+        try:
+            if profiler is not None:
+                path = profile_path(profile_dir, key, operation_name, 'prof')
+                _rotate(path, backups)
+                profiler.dump_stats(path)
+                _enforce_max_bytes(path, backups, max_bytes)
+            if snapshot is not None:
+                path = profile_path(profile_dir, key, operation_name,
+                                    'memory.txt')
+                _rotate(path, backups)
+                _write_snapshot(snapshot, path)
+                _enforce_max_bytes(path, backups, max_bytes)
+        except (IOError, OSError) as e:
+            logger.warning('Could not save the profile of {0} of {1}: {2}'
+                           .format(operation_name, key, e))
+
+
+def _write_snapshot(snapshot, path):
+    stats = snapshot.statistics('traceback')
+    with open(path, 'w') as f:
+        f.write('{0} bytes in {1} allocation sites\n'.format(
+            sum(stat.size for stat in stats), len(stats)))
+        for stat in stats[:MEMORY_TOP_ALLOCATIONS]:
+            f.write('\n{0} bytes in {1} blocks\n'.format(stat.size,
+                                                         stat.count))
+            for line in stat.traceback.format():
+                f.write('{0}\n'.format(line))
+
+
+def _backup_paths(path, backups):
+    return ['{0}.{1}'.format(path, i) for i in range(1, backups + 1)]
+
+
+def _rotate(path, backups):
+    """makes room for a new ``path``, keeping ``backups`` previous ones"""
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    paths = [path] + _backup_paths(path, backups)
+    if os.path.exists(paths[-1]):
+        os.remove(paths[-1])
+    for i in range(len(paths) - 2, -1, -1):
+        if os.path.exists(paths[i]):
+            os.rename(paths[i], paths[i + 1])
+
+
+def _enforce_max_bytes(path, backups, max_bytes):
+    """drops the oldest backups of ``path`` beyond ``max_bytes`` in total"""
+    total = os.path.getsize(path)
+    for backup in _backup_paths(path, backups):
+        if not os.path.exists(backup):
+            continue
+        total += os.path.getsize(backup)
+        if total > max_bytes:
+            os.remove(backup)
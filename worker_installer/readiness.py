@@ -0,0 +1,254 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""
+Detects when celery workers come up.
+
+Agent workers run with ``--events``, so the moment a worker is up it
+sends a ``worker-online`` event, followed by periodic heartbeats. Waiting
+for these events costs a single consumer on the events exchange instead
+of a broadcast per poll, and returns as soon as the worker is up.
+
+Pings with exponential backoff run alongside, for workers that do not
+send events, and replace the events entirely when they cannot be
+consumed.
+
+All the workers waited for in a process share a single `ReadinessWaiter`:
+one events consumer, and one ping broadcast per tick covering every
+pending worker, however many agents are starting at once.
+"""
+
+import logging
+import threading
+import time
+
+from celery.events import EventReceiver
+
+# how long a single wait for events blocks before the waiter ticks
+EVENTS_DRAIN_INTERVAL = 0.25
+PING_TIMEOUT = 0.5
+INITIAL_PING_INTERVAL = 0.25
+PING_BACKOFF_FACTOR = 2
+
+logger = logging.getLogger('worker_installer.readiness')
+
+_waiters = {}
+_waiters_lock = threading.Lock()
+
+
+def worker_names(name):
+    """the names a worker named ``name`` may report itself with"""
+    if '@' in name:
+        return set([name, name.split('@', 1)[1]])
+    return set([name, 'celery@{0}'.format(name)])
+
+
+def shared_waiter(app):
+    """the `ReadinessWaiter` shared by everything waiting on ``app``"""
+    with _waiters_lock:
+        waiter = _waiters.get(app)
+        if waiter is None:
+            waiter = _waiters[app] = ReadinessWaiter(app)
+        return waiter
+
+
+def wait_for_worker(app, worker_name, timeout, max_poll_interval=1):
+    """
+    Waits up to ``timeout`` seconds for the worker ``worker_name`` to come
+    up, and returns whether it did.
+    """
+    return shared_waiter(app).wait(worker_name, timeout, max_poll_interval)
+
+
+def ping_worker(app, worker_name, timeout=PING_TIMEOUT):
+    """pings ``worker_name`` once, and returns whether it answered"""
+    inspect = app.control.inspect(destination=[worker_name], timeout=timeout)
+    return bool(worker_names(worker_name) & set(inspect.ping() or {}))
+
+
+class _Watch(object):
+
+    def __init__(self, worker_name, deadline, max_poll_interval, callback):
+        self.worker_name = worker_name
+        self.names = worker_names(worker_name)
+        self.deadline = deadline
+        self.max_poll_interval = max_poll_interval
+        self.callback = callback
+
+
+class ReadinessWaiter(object):
+    """
+    Watches for workers coming up, on a background thread that runs while
+    there are workers to watch.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._lock = threading.Lock()
+        self._watches = []
+        # workers already asked for a heartbeat
+        self._announced = set()
+        self._thread = None
+        self._ping_interval = INITIAL_PING_INTERVAL
+        self._next_ping = 0
+
+    def watch(self, worker_name, timeout, callback, max_poll_interval=1):
+        """
+        Calls ``callback(online)`` once the worker ``worker_name`` comes
+        up, or ``timeout`` seconds pass. ``callback`` runs on the waiter's
+        thread.
+        """
+        watch = _Watch(worker_name, time.time() + timeout,
+                       max_poll_interval, callback)
+        with self._lock:
+            self._watches.append(watch)
+            # new workers are pinged right away
+            self._ping_interval = INITIAL_PING_INTERVAL
+            self._next_ping = 0
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='readiness-waiter')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def wait(self, worker_name, timeout, max_poll_interval=1):
+        """blocks until the worker comes up or ``timeout`` seconds pass"""
+        done = threading.Event()
+        result = []
+
+        def callback(online):
+            result.append(online)
+            done.set()
+        self.watch(worker_name, timeout, callback, max_poll_interval)
+        # waiting in slices keeps the calling thread interruptible
+        while not done.is_set():
+            done.wait(EVENTS_DRAIN_INTERVAL)
+        return result[0]
+
+    def _run(self):
+        try:
+            try:
+                with self.app.connection() as connection:
+                    _WorkerEventsReceiver(connection, self,
+                                          app=self.app).wait()
+                return
+            except Exception as e:
+                logger.debug('Cannot consume worker events, polling '
+                             'instead: {0}'.format(e))
+            while self.tick(announce=False):
+                time.sleep(EVENTS_DRAIN_INTERVAL)
+        except Exception as e:
+            logger.warning('Waiting for workers failed: {0}'.format(e))
+        finally:
+            self._stop()
+
+    def _stop(self):
+        with self._lock:
+            if self._thread is not threading.current_thread():
+                return
+            watches, self._watches = self._watches, []
+            self._thread = None
+        for watch in watches:
+            watch.callback(False)
+
+    def tick(self, announce=True):
+        """
+        Expires watches past their deadline, asks newly watched workers
+        for a heartbeat, and pings the pending ones when a ping is due.
+        Returns whether any workers are still watched.
+        """
+        now = time.time()
+        with self._lock:
+            expired = [w for w in self._watches if w.deadline <= now]
+            self._watches = [w for w in self._watches if w.deadline > now]
+            watches = list(self._watches)
+            if not watches:
+                self._thread = None
+            names = [w.worker_name for w in watches]
+            unannounced = [n for n in names if n not in self._announced]
+            self._announced = set(names)
+            ping_due = watches and now >= self._next_ping
+        for watch in expired:
+            watch.callback(False)
+        if not watches:
+            return False
+        if announce and unannounced:
+            # a worker that came up before the events consumer was ready
+            # only announces itself again with its next heartbeat
+            self.app.control.broadcast('heartbeat', destination=unannounced)
+        if ping_due:
+            self._ping(watches, now)
+        return True
+
+    def _ping(self, watches, now):
+        names = [w.worker_name for w in watches]
+        timeout = min(PING_TIMEOUT,
+                      min(w.deadline for w in watches) - now)
+        inspect = self.app.control.inspect(destination=names,
+                                           timeout=timeout,
+                                           limit=len(names))
+        replies = inspect.ping() or {}
+        max_interval = min(w.max_poll_interval for w in watches)
+        with self._lock:
+            self._next_ping = time.time() + self._ping_interval
+            self._ping_interval = min(
+                self._ping_interval * PING_BACKOFF_FACTOR, max_interval)
+        self.online(replies)
+
+    def online(self, hostnames):
+        """marks the workers reporting as ``hostnames`` as up"""
+        hostnames = set(hostnames)
+        with self._lock:
+            online = [w for w in self._watches if w.names & hostnames]
+            self._watches = [w for w in self._watches
+                             if not w.names & hostnames]
+        for watch in online:
+            watch.callback(True)
+
+
+class _WorkerEventsReceiver(EventReceiver):
+    """Consumes worker events while a `ReadinessWaiter` has watches"""
+
+    # fail fast and fall back to polling when the broker is unreachable
+    connect_max_retries = 1
+
+    def __init__(self, channel, waiter, app=None):
+        EventReceiver.__init__(
+            self, channel,
+            handlers={
+                'worker-online': self.on_worker_event,
+                'worker-heartbeat': self.on_worker_event
+            },
+            # worker events only, task events are of no interest
+            routing_key='worker.#',
+            app=app)
+        self.waiter = waiter
+
+    def on_worker_event(self, event):
+        self.waiter.online([event.get('hostname')])
+
+    def on_iteration(self):
+        if not self.waiter.tick():
+            self.should_stop = True
+
+    def wakeup_workers(self, channel=None):
+        # the waiter asks the workers it watches for a heartbeat itself,
+        # there is no need to wake up every worker
+        pass
+
+    def wait(self):
+        for _ in self.consume(safety_interval=EVENTS_DRAIN_INTERVAL,
+                              wakeup=True):
+            pass
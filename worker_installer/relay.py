@@ -0,0 +1,477 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""
+A caching relay for the manager file server.
+
+Hosts download agent packages (and any other file server resource) from
+the relay instead of from the file server itself. Every resource is
+fetched from the file server at most once at a time no matter how many
+hosts ask for it, kept in a size capped disk cache, and revalidated with
+a conditional request (If-None-Match) once it is older than
+``revalidate_after`` seconds. The number of concurrent transfers to hosts
+is limited, hosts beyond the limit wait for a slot.
+
+Every version of a resource is stored in a file of its own, named after
+its content, so that a revalidation never touches the file of a version
+still being sent to hosts. The files of replaced and evicted versions are
+removed once the last host reading them is done.
+
+Usage:
+
+    python -m worker_installer.relay --upstream http://<manager>:53229 \\
+        --port 53230 --cache-dir /var/cache/cloudify-relay
+
+and set ``package_relay_url`` in the agent configuration to
+``http://<relay host>:53230``.
+"""
+
+import argparse
+import collections
+import hashlib
+import json
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import urllib2
+import BaseHTTPServer
+import SocketServer
+
+DEFAULT_PORT = 53230
+DEFAULT_MAX_SIZE = 2 * 1024 * 1024 * 1024
+DEFAULT_MAX_TRANSFERS = 50
+DEFAULT_ADMISSION_TIMEOUT = 300
+DEFAULT_REVALIDATE_AFTER = 60
+DEFAULT_FETCH_TIMEOUT = 30
+CHUNK_SIZE = 64 * 1024
+
+logger = logging.getLogger('worker_installer.relay')
+
+
+class RelayError(Exception):
+    """An upstream failure, carrying the status to answer hosts with"""
+
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class CacheEntry(object):
+
+    def __init__(self, path, file_path, etag, size, content_type,
+                 validated_at):
+        self.path = path
+        self.file_path = file_path
+        self.etag = etag
+        self.size = size
+        self.content_type = content_type
+        self.validated_at = validated_at
+        # requests sending the file, see `PackageRelay.acquire`
+        self.readers = 0
+        # replaced or evicted, its files are removed once unread
+        self.retired = False
+
+    def to_dict(self):
+        return {
+            'path': self.path,
+            'etag': self.etag,
+            'size': self.size,
+            'content_type': self.content_type,
+            'validated_at': self.validated_at
+        }
+
+
+class Admission(object):
+    """Limits the number of concurrent transfers"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while self.active >= self.limit:
+                remaining = None if deadline is None \
+                    else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            self.active += 1
+            return True
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+
+class _Fetch(object):
+    """an upstream fetch other requests for the same path can wait for"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.entry = None
+        self.error = None
+
+
+class PackageRelay(object):
+    """
+    The disk cache behind the relay server. `get` returns the cache entry
+    for a path, fetching or revalidating it upstream when needed.
+    """
+
+    def __init__(self, upstream_url, cache_dir, max_size=DEFAULT_MAX_SIZE,
+                 revalidate_after=DEFAULT_REVALIDATE_AFTER,
+                 fetch_timeout=DEFAULT_FETCH_TIMEOUT):
+        self.upstream_url = upstream_url.rstrip('/')
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.revalidate_after = revalidate_after
+        self.fetch_timeout = fetch_timeout
+        self.upstream_requests = 0
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._fetches = {}
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self._load()
+
+    @property
+    def size(self):
+        with self._lock:
+            return sum(entry.size for entry in self._entries.values())
+
+    def get(self, path):
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None:
+                # least recently used entries are first in line for eviction
+                del self._entries[path]
+                self._entries[path] = entry
+                if time.time() - entry.validated_at < self.revalidate_after:
+                    return entry
+            fetch = self._fetches.get(path)
+            leader = fetch is None
+            if leader:
+                fetch = self._fetches[path] = _Fetch()
+        if not leader:
+            fetch.done.wait()
+            if fetch.error is not None:
+                raise fetch.error
+            return fetch.entry
+        try:
+            fetch.entry = self._fetch(path, entry)
+            return fetch.entry
+        except Exception as e:
+            fetch.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._fetches[path]
+            fetch.done.set()
+
+    def acquire(self, path):
+        """
+        Like `get`, but the entry's file is kept on disk, even if the entry
+        is replaced or evicted meanwhile, until the entry is given back
+        with `release`.
+        """
+        while True:
+            entry = self.get(path)
+            with self._lock:
+                # retired between lookup and now, the new version is served
+                if not entry.retired:
+                    entry.readers += 1
+                    return entry
+
+    def release(self, entry):
+        with self._lock:
+            entry.readers -= 1
+            if entry.retired:
+                self._remove_if_unread(entry)
+
+    def _fetch(self, path, cached):
+        request = urllib2.Request(self.upstream_url + path)
+        if cached is not None and cached.etag:
+            request.add_header('If-None-Match', cached.etag)
+        with self._lock:
+            self.upstream_requests += 1
+        try:
+            response = urllib2.urlopen(request, timeout=self.fetch_timeout)
+        except urllib2.HTTPError as e:
+            if e.code == 304 and cached is not None:
+                cached.validated_at = time.time()
+                self._write_metadata(cached)
+                return cached
+            raise RelayError(e.code, 'upstream returned {0} for {1}'
+                                     .format(e.code, path))
+        except (urllib2.URLError, socket.error) as e:
+            if cached is not None:
+                logger.warning('Failed revalidating {0}, serving the cached '
+                               'copy: {1}'.format(path, e))
+                return cached
+            raise RelayError(502, 'failed fetching {0}: {1}'.format(path, e))
+        try:
+            return self._store(path, response)
+        finally:
+            response.close()
+
+    def _store(self, path, response):
+        digest = hashlib.sha256()
+        size = 0
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while True:
+                    chunk = response.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    size += len(chunk)
+                    f.write(chunk)
+        except Exception:
+            os.remove(temp_path)
+            raise
+        file_path = self._file_path(path, digest.hexdigest())
+        headers = response.info()
+        entry = CacheEntry(
+            path=path,
+            file_path=file_path,
+            etag=headers.getheader('ETag') or
+            '"sha256-{0}"'.format(digest.hexdigest()),
+            size=size,
+            content_type=headers.getheader('Content-Type') or
+            'application/octet-stream',
+            validated_at=time.time())
+        with self._lock:
+            if os.path.exists(file_path):
+                # the same content is already on disk, maybe being read
+                os.remove(temp_path)
+            else:
+                os.rename(temp_path, file_path)
+            self._write_metadata(entry)
+            replaced = self._entries.pop(path, None)
+            self._entries[path] = entry
+            retired = self._evict(keep=path)
+            if replaced is not None:
+                retired.append(replaced)
+            for old in retired:
+                old.retired = True
+                self._remove_if_unread(old)
+        return entry
+
+    def _evict(self, keep):
+        """removes entries beyond the size cap, and returns them"""
+        evicted = []
+        total = sum(entry.size for entry in self._entries.values())
+        for path in list(self._entries):
+            if total <= self.max_size:
+                break
+            if path == keep:
+                continue
+            entry = self._entries.pop(path)
+            total -= entry.size
+            logger.info('Evicting {0} ({1} bytes)'.format(path, entry.size))
+            evicted.append(entry)
+        return evicted
+
+    def _remove_if_unread(self, entry):
+        """removes the files of a retired entry no request reads anymore"""
+        if entry.readers:
+            return
+        current = self._entries.get(entry.path)
+        # unless a newer entry of the same content uses them
+        if current is None or current.file_path != entry.file_path:
+            self._remove_files(entry)
+
+    def _remove_files(self, entry):
+        for file_path in (entry.file_path, entry.file_path + '.json'):
+            try:
+                os.remove(file_path)
+            except OSError:
+                pass
+
+    def _file_path(self, path, digest):
+        return os.path.join(self.cache_dir, '{0}-{1}'.format(
+            hashlib.sha1(path).hexdigest(), digest))
+
+    def _write_metadata(self, entry):
+        with open(entry.file_path + '.json', 'w') as f:
+            json.dump(entry.to_dict(), f)
+
+    def _load(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.tmp'):
+                os.remove(os.path.join(self.cache_dir, name))
+                continue
+            if not name.endswith('.json'):
+                continue
+            metadata_path = os.path.join(self.cache_dir, name)
+            file_path = metadata_path[:-len('.json')]
+            try:
+                with open(metadata_path) as f:
+                    metadata = json.load(f)
+                entries.append((os.path.getatime(file_path),
+                                CacheEntry(file_path=file_path, **metadata)))
+            except (IOError, OSError, ValueError, TypeError):
+                continue
+        for _, entry in sorted(entries, key=lambda item: item[0]):
+            # a version replaced while hosts were still reading it
+            previous = self._entries.pop(entry.path, None)
+            if previous is not None:
+                if previous.validated_at > entry.validated_at:
+                    previous, entry = entry, previous
+                self._remove_files(previous)
+            self._entries[entry.path] = entry
+
+
+class RelayRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_HEAD(self):
+        self._handle(send_body=False)
+
+    def do_GET(self):
+        self._handle(send_body=True)
+
+    def _handle(self, send_body):
+        server = self.server
+        path = self.path.split('?', 1)[0]
+        try:
+            entry = server.relay.acquire(path)
+        except RelayError as e:
+            self._send_error(e.status, str(e))
+            return
+        try:
+            self._send_entry(path, entry, send_body)
+        finally:
+            server.relay.release(entry)
+
+    def _send_entry(self, path, entry, send_body):
+        server = self.server
+        if entry.etag and entry.etag == self.headers.getheader(
+                'If-None-Match'):
+            self.send_response(304)
+            self.send_header('ETag', entry.etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if not send_body:
+            self._send_headers(entry)
+            return
+        if not server.admission.acquire(server.admission_timeout):
+            self._send_error(503, 'too many concurrent transfers',
+                             retry_after=5)
+            return
+        try:
+            with open(entry.file_path, 'rb') as f:
+                self._send_headers(entry)
+                shutil.copyfileobj(f, self.wfile, CHUNK_SIZE)
+        except IOError as e:
+            # e.g. the host went away
+            logger.warning('Failed sending {0}: {1}'.format(path, e))
+            self.close_connection = 1
+        finally:
+            server.admission.release()
+
+    def _send_headers(self, entry):
+        self.send_response(200)
+        self.send_header('Content-Type', entry.content_type)
+        self.send_header('Content-Length', str(entry.size))
+        self.send_header('ETag', entry.etag)
+        self.end_headers()
+
+    def _send_error(self, status, message, retry_after=None):
+        body = message + '\n'
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        if retry_after is not None:
+            self.send_header('Retry-After', str(retry_after))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('%s - %s', self.address_string(), format % args)
+
+
+class RelayServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, address, relay, max_transfers=DEFAULT_MAX_TRANSFERS,
+                 admission_timeout=DEFAULT_ADMISSION_TIMEOUT):
+        BaseHTTPServer.HTTPServer.__init__(self, address,
+                                           RelayRequestHandler)
+        self.relay = relay
+        self.admission = Admission(max_transfers)
+        self.admission_timeout = admission_timeout
+
+
+def relay_url(url, file_server_url, package_relay_url):
+    """
+    Rewrites a file server ``url`` to go through the relay at
+    ``package_relay_url``. Other urls are returned unchanged.
+    """
+    if not package_relay_url or not url.startswith(file_server_url):
+        return url
+    return package_relay_url.rstrip('/') + url[len(file_server_url):]
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Caching relay for the manager file server')
+    parser.add_argument('--upstream', required=True,
+                        help='the file server url, e.g. http://manager:53229')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--cache-dir', required=True)
+    parser.add_argument('--max-size', type=int, default=DEFAULT_MAX_SIZE,
+                        help='cache size cap in bytes')
+    parser.add_argument('--max-transfers', type=int,
+                        default=DEFAULT_MAX_TRANSFERS,
+                        help='maximal number of concurrent transfers')
+    parser.add_argument('--admission-timeout', type=float,
+                        default=DEFAULT_ADMISSION_TIMEOUT,
+                        help='seconds a request waits for a transfer slot')
+    parser.add_argument('--revalidate-after', type=float,
+                        default=DEFAULT_REVALIDATE_AFTER,
+                        help='seconds before a cached file is revalidated')
+    options = parser.parse_args(args)
+    logging.basicConfig(level=logging.INFO)
+    relay = PackageRelay(options.upstream, options.cache_dir,
+                         max_size=options.max_size,
+                         revalidate_after=options.revalidate_after)
+    server = RelayServer((options.host, options.port), relay,
+                         max_transfers=options.max_transfers,
+                         admission_timeout=options.admission_timeout)
+    logger.info('Relaying {0} on {1}:{2}'.format(
+        options.upstream, options.host, options.port))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -14,21 +14,44 @@
 #  * limitations under the License.
 
 
+import copy
+import math
 import time
 import os
-import jinja2
+from StringIO import StringIO
 
-from cloudify import amqp_client
+from cloudify import context
 from cloudify import ctx
 from cloudify.decorators import operation
 from cloudify.exceptions import NonRecoverableError
 from cloudify.celery import celery as celery_client
-from cloudify import manager
 from cloudify import utils
+from cloudify.state import current_ctx
 
 from worker_installer import init_worker_installer
-from worker_installer.utils import is_on_management_worker
-from worker_installer.utils import download_resource_on_host
+from worker_installer import prepare_bulk_connection_configuration
+from worker_installer import run_with_agent_config
+from worker_installer import run_with_agent_config_async
+from worker_installer import agent_package
+from worker_installer.broker import delete_worker_queues
+from worker_installer.broker import expire_worker_queues
+from worker_installer.concurrency import run_bounded
+from worker_installer.concurrency import DEFAULT_CONCURRENCY
+from worker_installer.event_loop import EventLoop
+from worker_installer.event_loop import Future
+from worker_installer.event_loop import Return
+from worker_installer.event_loop import run_bounded as run_bounded_async
+from worker_installer.metrics import phase
+from worker_installer.readiness import ping_worker
+from worker_installer.readiness import shared_waiter
+from worker_installer.readiness import wait_for_worker
+from worker_installer.relay import relay_url
+from worker_installer.templates import file_server_loader
+from worker_installer.templates import template_cache
+from worker_installer.utils import is_local_agent
+from worker_installer.utils import download_resource_command
+from worker_installer.utils import CommandBatch
+from worker_installer.utils import FabricRunnerException
 
 
 PLUGIN_INSTALLER_PLUGIN_PATH = 'plugin_installer.tasks'
@@ -43,6 +66,18 @@ CELERY_INCLUDES_LIST = [
     SCRIPT_PLUGIN_PATH, DEFAULT_WORKFLOWS_PLUGIN_PATH
 ]
 
+# runtime property holding the time by which an agent started with
+# wait_started_retry must be up
+START_DEADLINE_KEY = 'cloudify_agent_start_deadline'
+
+DEFAULT_BULK_CONCURRENCY = DEFAULT_CONCURRENCY
+DEFAULT_BULK_TIMEOUT = 900
+# the end of a celery startup error, which holds the exception, is enough
+CELERY_ERROR_MAX_BYTES = 64 * 1024
+# how much of the agent's log is attached to a failure to start it
+CELERY_LOG_TAIL_BYTES = 16 * 1024
+CELERY_LOG_TAIL_LINES = 100
+
 DEFAULT_AGENT_RESOURCES = {
     'celery_config_path':
     '/packages/templates/{0}-celeryd-cloudify.conf.template',
@@ -76,6 +111,9 @@ def get_agent_resource_url(ctx, agent_config, resource):
             origin = utils.get_manager_file_server_url() + \
                 resource_path.format(agent_config['distro'])
 
+    # hosts download through the relay when there is one
+    origin = relay_url(origin, utils.get_manager_file_server_url(),
+                       agent_config.get('package_relay_url'))
     ctx.logger.debug('resource origin: {0}'.format(origin))
     return origin
 
@@ -106,68 +144,160 @@ def get_celery_includes_list():
 
 @operation
 @init_worker_installer
-def install(runner, agent_config, agent_package_url=None, **kwargs):
+def install(runner, agent_config, host_facts, agent_package_url=None,
+            **kwargs):
+    install_agent(ctx, runner, agent_config, host_facts, agent_package_url)
+
+
+def install_agent(ctx, runner, agent_config, host_facts,
+                  agent_package_url=None):
+    agent_package_url = _prepare_install(ctx, agent_config,
+                                         agent_package_url)
+
+    # the host facts probe also serves as the connectivity check
+    if host_facts.base_dir_exists:
+        _log_already_installed(ctx)
+        return
+
+    with phase(runner, 'queues'):
+        if agent_config.get('queue_expires'):
+            _expire_amqp_queues(agent_config)
+        elif agent_config.get('delete_amqp_queues'):
+            _delete_amqp_queues(agent_config['name'])
+
+    # download, extraction, virtualenv relinking and the shebang fixes
+    # share a single batch, and are timed as a single phase
+    with phase(runner, 'package'):
+        with runner.batch() as batch:
+            _queue_package_installation(ctx, batch, agent_config,
+                                        host_facts, agent_package_url)
+    _warn_failed_links(ctx, batch)
+
+    with phase(runner, 'configuration'):
+        create_celery_configuration(
+            ctx, runner, agent_config, file_server_loader)
+
+    with phase(runner, 'init'):
+        with runner.batch() as batch:
+            _queue_init_configuration(ctx, batch, agent_config, host_facts)
+
+
+def install_agent_async(ctx, runner, agent_config, host_facts,
+                        agent_package_url=None):
+    """the coroutine counterpart of `install_agent`"""
+    agent_package_url = _prepare_install(ctx, agent_config,
+                                         agent_package_url)
+
+    if host_facts.base_dir_exists:
+        _log_already_installed(ctx)
+        return
 
-    if not agent_package_url.__contains__('http'):
+    with phase(runner, 'queues'):
+        if agent_config.get('queue_expires'):
+            yield runner.loop.run_in_executor(_expire_amqp_queues,
+                                              agent_config)
+        elif agent_config.get('delete_amqp_queues'):
+            yield runner.loop.run_in_executor(_delete_amqp_queues,
+                                              agent_config['name'])
+
+    with phase(runner, 'package'):
+        batch = CommandBatch(runner)
+        _queue_package_installation(ctx, batch, agent_config, host_facts,
+                                    agent_package_url)
+        yield runner.flush(batch)
+    _warn_failed_links(ctx, batch)
+
+    with phase(runner, 'configuration'):
+        files = yield runner.loop.run_in_executor(
+            render_celery_configuration, ctx, agent_config,
+            file_server_loader)
+        yield runner.put_many(files)
+
+    with phase(runner, 'init'):
+        batch = CommandBatch(runner)
+        _queue_init_configuration(ctx, batch, agent_config, host_facts)
+        yield runner.flush(batch)
+
+
+def _prepare_install(ctx, agent_config, agent_package_url):
+    if not agent_package_url or 'http' not in agent_package_url:
         agent_package_url = get_agent_resource_url(
             ctx, agent_config, 'agent_package_path')
 
-    ctx.logger.debug("Pinging agent installer target")
-    runner.ping()
-
     ctx.logger.info(
         'Installing cloudify agent {0}. '
         'Connection details --> {1}'
         .format(agent_config['name'],
                 connection_details(agent_config)))
+    return agent_package_url
 
-    if worker_exists(runner, agent_config):
-        ctx.logger.info("Worker for deployment {0} "
-                        "is already installed. nothing to do."
-                        .format(ctx.deployment.id))
-        return
 
-    if agent_config.get('delete_amqp_queues'):
-        _delete_amqp_queues(agent_config['name'])
+def _log_already_installed(ctx):
+    ctx.logger.info("Worker for deployment {0} "
+                    "is already installed. nothing to do."
+                    .format(ctx.deployment.id))
 
-    ctx.logger.debug(
-        'Installing celery worker [cloudify_agent={0}]'.format(agent_config))
-    runner.run('mkdir -p {0}'.format(agent_config['base_dir']))
 
+def _queue_package_installation(ctx, batch, agent_config, host_facts,
+                                agent_package_url):
     ctx.logger.debug(
-        'Downloading agent package from: {0}'.format(agent_package_url))
-    download_resource_on_host(
-        ctx.logger, runner, agent_package_url, '{0}/{1}'.format(
-            agent_config['base_dir'], 'agent.tar.gz'))
-
-    ctx.logger.debug('extracting agent package on host')
-    runner.run(
-        'tar xzvf {0}/agent.tar.gz --strip=2 -C {1}'.format(
-            agent_config['base_dir'], agent_config['base_dir']))
+        'Installing celery worker [cloudify_agent={0}]'.format(agent_config))
+    base_dir = agent_config['base_dir']
+    checksum = agent_config.get('agent_package_checksum')
+    cache = agent_config['agent_package_cache'] and \
+        agent_package.can_cache(host_facts.tools)
+    stream = agent_config['stream_agent_package'] and \
+        agent_package.can_stream(host_facts.tools, checksum)
+    batch.run('mkdir -p {0}'.format(base_dir))
+    if cache:
+        ctx.logger.debug('Installing agent package from {0} through the '
+                         'host cache in {1}'.format(
+                             agent_package_url,
+                             agent_config['agent_package_cache_dir']))
+        batch.run(agent_package.cached_extract_command(
+            agent_package_url, base_dir, host_facts.tools,
+            agent_config['agent_package_cache_dir'],
+            agent_config['agent_package_cache_max_size'],
+            checksum=checksum,
+            stream=agent_config['stream_agent_package']))
+    elif stream:
+        ctx.logger.debug('Streaming agent package from {0} into {1}'
+                         .format(agent_package_url, base_dir))
+        batch.run(agent_package.stream_extract_command(
+            agent_package_url, base_dir, host_facts.tools, checksum))
+    else:
+        ctx.logger.debug(
+            'Downloading agent package from: {0}'.format(agent_package_url))
+        for command in agent_package.download_extract_commands(
+                agent_package_url, base_dir, host_facts.tools, checksum):
+            batch.run(command)
 
     ctx.logger.debug('configuring virtualenv')
     for link in ['archives', 'bin', 'include', 'lib']:
-        link_path = '{0}/env/local/{1}'.format(agent_config['base_dir'], link)
-        try:
-            runner.run('unlink {0}'.format(link_path))
-            runner.run('ln -s {0}/env/{1} {2}'.format(
-                agent_config['base_dir'], link, link_path))
+        link_path = '{0}/env/local/{1}'.format(agent_config['base_dir'],
+                                               link)
+        batch.run('unlink {0} && ln -s {1}/env/{2} {0}'.format(
+            link_path, agent_config['base_dir'], link),
+            ignore_errors=True)
 
-        except Exception as e:
-            ctx.logger.warn('Error processing link: {0} [error={1}] - '
-                            'ignoring..'.format(link_path, str(e)))
+    # This is for fixing virtualenv included in package paths
+    batch.run("sed -i '1 s|.*/bin/python.*$|#!{0}/env/bin/python|g' "
+              "{0}/env/bin/*".format(agent_config['base_dir']))
 
-    create_celery_configuration(
-        ctx, runner, agent_config, manager.get_resource)
+    if not cache and not stream:
+        # Remove downloaded agent package
+        batch.run(agent_package.cleanup_command(base_dir))
 
-    runner.run('sudo chmod +x {0}'.format(agent_config['init_file']))
 
-    # This is for fixing virtualenv included in package paths
-    runner.run("sed -i '1 s|.*/bin/python.*$|#!{0}/env/bin/python|g' "
-               "{0}/env/bin/*".format(agent_config['base_dir']))
+def _warn_failed_links(ctx, batch):
+    for step in batch.results:
+        if step.failed:
+            ctx.logger.warn('Error processing link: {0} [error={1}] - '
+                            'ignoring..'.format(step.command, step.output))
 
-    # Remove downloaded agent package
-    runner.run('rm {0}/agent.tar.gz'.format(agent_config['base_dir']))
+
+def _queue_init_configuration(ctx, batch, agent_config, host_facts):
+    batch.run('sudo chmod +x {0}'.format(agent_config['init_file']))
 
     # Disable requiretty
     if agent_config['disable_requiretty']:
@@ -177,18 +307,22 @@ def install(runner, agent_config, agent_package_url=None, **kwargs):
         disable_requiretty_script = '{0}/disable-requiretty.sh'.format(
             agent_config['base_dir'])
 
-        download_resource_on_host(
-            ctx.logger, runner, disable_requiretty_script_url,
-            disable_requiretty_script)
+        batch.run(download_resource_command(
+            disable_requiretty_script_url, disable_requiretty_script,
+            host_facts.tools))
 
-        runner.run('chmod +x {0}'.format(disable_requiretty_script))
+        batch.run('chmod +x {0}'.format(disable_requiretty_script))
 
-        runner.run('sudo {0}'.format(disable_requiretty_script))
+        batch.run('sudo {0}'.format(disable_requiretty_script))
 
 
 @operation
 @init_worker_installer
-def uninstall(ctx, runner, agent_config, **kwargs):
+def uninstall(ctx, runner, agent_config, host_facts, **kwargs):
+    uninstall_agent(ctx, runner, agent_config, host_facts)
+
+
+def uninstall_agent(ctx, runner, agent_config, host_facts):
     ctx.logger.info(
         'Uninstalling cloudify agent {0}. '
         'Connection details --> {1}'
@@ -201,9 +335,60 @@ def uninstall(ctx, runner, agent_config, **kwargs):
     files_to_delete = [
         agent_config['init_file'], agent_config['config_file']
     ]
-    folders_to_delete = [agent_config['base_dir']]
-    delete_files_if_exist(ctx, agent_config, runner, files_to_delete)
-    delete_folders_if_exist(ctx, agent_config, runner, folders_to_delete)
+    folders_to_delete = _folders_to_delete(agent_config)
+    with phase(runner, 'delete_files'):
+        delete_files_if_exist(ctx, agent_config, runner, files_to_delete)
+        delete_folders_if_exist(ctx, agent_config, runner,
+                                folders_to_delete)
+
+    if agent_config.get('queue_expires'):
+        # installs with expiring queues leave the worker queue in place
+        with phase(runner, 'queues'):
+            _delete_amqp_queues(agent_config['name'])
+
+    # a reinstall must not rely on anything learned about this agent
+    host_facts.forget()
+
+
+def uninstall_agent_async(ctx, runner, agent_config, host_facts):
+    """the coroutine counterpart of `uninstall_agent`"""
+    ctx.logger.info(
+        'Uninstalling cloudify agent {0}. '
+        'Connection details --> {1}'
+        .format(agent_config['name'],
+                connection_details(agent_config)))
+
+    files_to_delete = [
+        agent_config['init_file'], agent_config['config_file']
+    ]
+    folders_to_delete = _folders_to_delete(agent_config)
+    with phase(runner, 'delete_files'):
+        yield [_delete_if_exists_async(runner, path, 'sudo rm {0}')
+               for path in files_to_delete]
+        yield [_delete_if_exists_async(runner, path, 'sudo rm -rf {0}')
+               for path in folders_to_delete]
+    if agent_config.get('queue_expires'):
+        # installs with expiring queues leave the worker queue in place
+        with phase(runner, 'queues'):
+            yield runner.loop.run_in_executor(_delete_amqp_queues,
+                                              agent_config['name'])
+    host_facts.forget()
+
+
+def _folders_to_delete(agent_config):
+    folders = [agent_config['base_dir']]
+    if agent_config.get('agent_package_cache'):
+        # the cache does not outlive the agents installed through it
+        folders.append(agent_config['agent_package_cache_dir'])
+    return folders
+
+
+def _delete_if_exists_async(runner, path, delete_command):
+    if (yield runner.exists(path)):
+        yield runner.run(delete_command.format(path))
+    else:
+        runner.ctx.logger.debug('Could not find {0} while trying to '
+                                'uninstall worker'.format(path))
 
 
 def delete_files_if_exist(ctx, agent_config, runner, files):
@@ -234,7 +419,11 @@ def delete_folders_if_exist(ctx, agent_config, runner, folders):
 
 @operation
 @init_worker_installer
-def stop(ctx, runner, agent_config, **kwargs):
+def stop(ctx, runner, agent_config, host_facts, **kwargs):
+    stop_agent(ctx, runner, agent_config, host_facts)
+
+
+def stop_agent(ctx, runner, agent_config, host_facts):
     ctx.logger.info(
         'Stopping cloudify agent {0}. '
         'Connection details --> {1}'
@@ -242,8 +431,9 @@ def stop(ctx, runner, agent_config, **kwargs):
                 connection_details(agent_config)))
 
     if runner.exists(agent_config['init_file']):
-        runner.run(
-            "sudo service celeryd-{0} stop".format(agent_config["name"]))
+        with phase(runner, 'service'):
+            runner.run("sudo service celeryd-{0} stop".format(
+                agent_config["name"]))
     else:
         ctx.logger.debug(
             "Could not find any workers with name {0}. nothing to do."
@@ -252,18 +442,105 @@ def stop(ctx, runner, agent_config, **kwargs):
 
 @operation
 @init_worker_installer
-def start(ctx, runner, agent_config, **kwargs):
+def start(ctx, runner, agent_config, host_facts, **kwargs):
+    if agent_config['wait_started_retry']:
+        return start_agent_with_retry(ctx, runner, agent_config, host_facts)
+    start_agent(ctx, runner, agent_config, host_facts)
+
+
+def start_agent(ctx, runner, agent_config, host_facts):
     ctx.logger.info(
         'Starting cloudify agent {0}. '
         'Connection details --> {1}'
         .format(agent_config['name'],
                 connection_details(agent_config)))
 
-    runner.run("sudo service celeryd-{0} start".format(agent_config["name"]))
+    with phase(runner, 'service'):
+        runner.run("sudo service celeryd-{0} start".format(
+            agent_config["name"]))
 
     _wait_for_started(runner, agent_config)
 
 
+def start_agent_with_retry(ctx, runner, agent_config, host_facts):
+    """
+    Starts the agent without waiting for it. Until it is up or
+    ``wait_started_timeout`` passes, the operation is retried, and every
+    retry pings the agent's worker just once. The retries left are spread
+    over the time left, so that the last one happens at the deadline.
+
+    Only node instances have runtime properties to keep the deadline in,
+    other agents (e.g. the deployment's workers) are waited for as usual.
+    """
+    if ctx.type != context.NODE_INSTANCE:
+        return start_agent(ctx, runner, agent_config, host_facts)
+
+    runtime_properties = ctx.instance.runtime_properties
+    if not ctx.operation.retry_number or \
+            START_DEADLINE_KEY not in runtime_properties:
+        ctx.logger.info(
+            'Starting cloudify agent {0}. '
+            'Connection details --> {1}'
+            .format(agent_config['name'],
+                    connection_details(agent_config)))
+        with phase(runner, 'service'):
+            runner.run("sudo service celeryd-{0} start".format(
+                agent_config["name"]))
+        _verify_no_celery_error(runner, agent_config)
+        runtime_properties[START_DEADLINE_KEY] = \
+            time.time() + agent_config['wait_started_timeout']
+
+    with phase(runner, 'ping'):
+        online = ping_worker(celery_client, _worker_name(agent_config))
+    if online:
+        del runtime_properties[START_DEADLINE_KEY]
+        return
+    remaining = runtime_properties[START_DEADLINE_KEY] - time.time()
+    retries_left = _retries_left(ctx)
+    if remaining <= 0 or retries_left == 0:
+        del runtime_properties[START_DEADLINE_KEY]
+        _verify_no_celery_error(runner, agent_config)
+        message = None
+        if remaining > 0:
+            message = 'Failed starting agent. the operation ran out of ' \
+                      'retries {0:.0f} seconds before wait_started_timeout ' \
+                      'passed, consider raising its max_retries.' \
+                      .format(remaining)
+        _raise_not_started(agent_config, _celery_log_tail(runner,
+                                                          agent_config),
+                           message)
+    retry_after = agent_config['wait_started_interval']
+    if retries_left is not None:
+        retry_after = max(retry_after, remaining / retries_left)
+    return ctx.operation.retry(
+        message='Waiting for cloudify agent {0} to start'.format(
+            agent_config['name']),
+        retry_after=int(math.ceil(min(retry_after, remaining))))
+
+
+def _retries_left(ctx):
+    """the retries the operation has left, None when unlimited"""
+    max_retries = ctx.operation.max_retries
+    if max_retries is None or max_retries < 0:
+        return None
+    return max(max_retries - (ctx.operation.retry_number or 0), 0)
+
+
+def start_agent_async(ctx, runner, agent_config, host_facts):
+    """the coroutine counterpart of `start_agent`"""
+    ctx.logger.info(
+        'Starting cloudify agent {0}. '
+        'Connection details --> {1}'
+        .format(agent_config['name'],
+                connection_details(agent_config)))
+
+    with phase(runner, 'service'):
+        yield runner.run("sudo service celeryd-{0} start".format(
+            agent_config["name"]))
+
+    yield _wait_for_started_async(runner, agent_config)
+
+
 @operation
 @init_worker_installer
 def restart(ctx, runner, agent_config, **kwargs):
@@ -276,19 +553,162 @@ def restart(ctx, runner, agent_config, **kwargs):
     restart_celery_worker(runner, agent_config)
 
 
+@operation
+def install_many(ctx, agents, agent_package_url=None,
+                 concurrency=DEFAULT_BULK_CONCURRENCY,
+                 timeout=DEFAULT_BULK_TIMEOUT, use_event_loop=False,
+                 **kwargs):
+    """installs the agents described by ``agents`` concurrently"""
+    flow = install_agent_async if use_event_loop else install_agent
+    return _run_many(ctx, 'install', flow, agents, concurrency, timeout,
+                     use_event_loop=use_event_loop,
+                     agent_package_url=agent_package_url)
+
+
+@operation
+def uninstall_many(ctx, agents, concurrency=DEFAULT_BULK_CONCURRENCY,
+                   timeout=DEFAULT_BULK_TIMEOUT, use_event_loop=False,
+                   **kwargs):
+    """uninstalls the agents described by ``agents`` concurrently"""
+    flow = uninstall_agent_async if use_event_loop else uninstall_agent
+    return _run_many(ctx, 'uninstall', flow, agents, concurrency, timeout,
+                     use_event_loop=use_event_loop)
+
+
+@operation
+def start_many(ctx, agents, concurrency=DEFAULT_BULK_CONCURRENCY,
+               timeout=DEFAULT_BULK_TIMEOUT, use_event_loop=False,
+               **kwargs):
+    """starts the agents described by ``agents`` concurrently"""
+    flow = start_agent_async if use_event_loop else start_agent
+    return _run_many(ctx, 'start', flow, agents, concurrency, timeout,
+                     use_event_loop=use_event_loop)
+
+
+@operation
+def stop_many(ctx, agents, concurrency=DEFAULT_BULK_CONCURRENCY,
+              timeout=DEFAULT_BULK_TIMEOUT, **kwargs):
+    """stops the agents described by ``agents`` concurrently"""
+    return _run_many(ctx, 'stop', stop_agent, agents, concurrency,
+                     timeout)
+
+
+def _run_many(ctx, operation_name, flow, agents, concurrency, timeout,
+              use_event_loop=False, **flow_kwargs):
+    """
+    Runs ``flow`` for each agent configuration in ``agents``, and returns
+    the outcome per agent name.
+
+    The agents are handled on a bounded pool of threads or, when
+    ``use_event_loop`` is set and ``flow`` is a coroutine, all of them
+    on a single `EventLoop`, in which case ``concurrency`` can be much
+    higher.
+
+    Every agent configuration must include the host and the name of the
+    agent, the rest is completed the same way as for a single agent.
+    Raises `NonRecoverableError` listing all the agents that failed or
+    timed out, after all of them were handled.
+    """
+    if not agents:
+        return {}
+    if not str(concurrency).isdigit() or int(concurrency) < 1:
+        raise NonRecoverableError('concurrency is supposed to be a positive '
+                                  'number but is: {0}'.format(concurrency))
+    agents = [copy.deepcopy(agent_config) for agent_config in agents]
+    timeout = float(timeout) if timeout else None
+
+    def key(agent_config):
+        return agent_config.get('name', agent_config.get('host'))
+
+    def run_agent(agent_config):
+        # helpers in this module log through the current context
+        current_ctx.set(ctx)
+        try:
+            prepare_bulk_connection_configuration(ctx, agent_config)
+            return run_with_agent_config(ctx, agent_config, flow, ctx,
+                                         persist_resolved_config=False,
+                                         **flow_kwargs)
+        finally:
+            current_ctx.clear()
+
+    ctx.logger.info('Running {0} on {1} agents [concurrency={2}, '
+                    'timeout={3}, event_loop={4}]'.format(
+                        operation_name, len(agents), concurrency, timeout,
+                        bool(use_event_loop)))
+    if use_event_loop:
+        loop = EventLoop()
+        try:
+            def run_agent_async(agent_config):
+                prepare_bulk_connection_configuration(ctx, agent_config)
+                return run_with_agent_config_async(ctx, loop, agent_config,
+                                                   flow, ctx, **flow_kwargs)
+            results = loop.run_until_complete(run_bounded_async(
+                loop, run_agent_async, agents,
+                concurrency=int(concurrency),
+                timeout=timeout,
+                key=key))
+        finally:
+            loop.close()
+    else:
+        results = run_bounded(run_agent, agents,
+                              concurrency=int(concurrency),
+                              timeout=timeout,
+                              key=key)
+    summary = dict((result.key, result.to_dict()) for result in results)
+    failed = [result for result in results if not result.succeeded]
+    for result in failed:
+        if result.traceback:
+            ctx.logger.debug('{0} failed on agent {1}: {2}'.format(
+                operation_name, result.key, result.traceback))
+    if failed:
+        raise NonRecoverableError(
+            '{0} failed on {1} of {2} agents: {3}'.format(
+                operation_name, len(failed), len(results),
+                ', '.join('{0} ({1})'.format(
+                    result.key, summary[result.key]['error'] or 'timeout')
+                    for result in failed)))
+    ctx.logger.info('{0} succeeded on all {1} agents'.format(
+        operation_name, len(results)))
+    return summary
+
+
 def get_agent_ip(ctx, agent_config):
-    if is_on_management_worker(ctx):
+    if is_local_agent(ctx, agent_config):
         return utils.get_manager_ip()
     return agent_config['host']
 
 
 def create_celery_configuration(ctx, runner, agent_config, resource_loader):
-    create_celery_includes_file(ctx, runner, agent_config)
-    loader = jinja2.FunctionLoader(resource_loader)
-    env = jinja2.Environment(loader=loader)
+    files = render_celery_configuration(ctx, agent_config, resource_loader)
+
+    ctx.logger.debug(
+        'Creating celery includes, config and init files '
+        '[cloudify_agent={0}]'.format(agent_config))
+
+    # all three files are put by a single remote command
+    runner.put_many(files)
+
+
+def render_celery_configuration(ctx, agent_config, resource_loader):
+    """
+    Returns the path, content and whether sudo is needed to write it for
+    each of the files created by `create_celery_configuration`.
+    """
+    config, init = _render_celery_templates(ctx, agent_config,
+                                            resource_loader)
+    return [
+        (agent_config['includes_file'], _celery_includes(), False),
+        (agent_config['config_file'], config, True),
+        (agent_config['init_file'], init, True)
+    ]
+
+
+def _render_celery_templates(ctx, agent_config, resource_loader):
+    # the templates are compiled once per process, see `TemplateCache`
     config_template_path = get_agent_resource_local_path(
         ctx, agent_config, 'celery_config_path')
-    config_template = env.get_template(config_template_path)
+    config_template = template_cache.get_template(config_template_path,
+                                                  resource_loader)
     config_template_values = {
         'includes_file_path': agent_config['includes_file'],
         'celery_base_dir': agent_config['celery_base_dir'],
@@ -309,7 +729,8 @@ def create_celery_configuration(ctx, runner, agent_config, resource_loader):
     config = config_template.render(config_template_values)
     init_template_path = get_agent_resource_local_path(
         ctx, agent_config, 'celery_init_path')
-    init_template = env.get_template(init_template_path)
+    init_template = template_cache.get_template(init_template_path,
+                                                resource_loader)
     init_template_values = {
         'celery_base_dir': agent_config['celery_base_dir'],
         'worker_modifier': agent_config['name']
@@ -320,33 +741,17 @@ def create_celery_configuration(ctx, runner, agent_config, resource_loader):
         'values: {0}'.format(init_template_values))
 
     init = init_template.render(init_template_values)
+    return config, init
 
-    ctx.logger.debug(
-        'Creating celery config and init files [cloudify_agent={0}]'.format(
-            agent_config))
-
-    runner.put(agent_config['config_file'], config, use_sudo=True)
-    runner.put(agent_config['init_file'], init, use_sudo=True)
-
-
-def create_celery_includes_file(ctx, runner, agent_config):
-    # build initial includes
-    includes_list = get_celery_includes_list()
-    runner.put(agent_config['includes_file'], 'INCLUDES={0}\n'.format(
-        ','.join(includes_list)))
-
-    ctx.logger.debug('Created celery includes file [file=%s, content=%s]',
-                     agent_config['includes_file'],
-                     includes_list)
 
-
-def worker_exists(runner, agent_config):
-    return runner.exists(agent_config['base_dir'])
+def _celery_includes():
+    return 'INCLUDES={0}\n'.format(','.join(get_celery_includes_list()))
 
 
 def restart_celery_worker(runner, agent_config):
-    runner.run("sudo service celeryd-{0} restart".format(
-        agent_config['name']))
+    with phase(runner, 'service'):
+        runner.run("sudo service celeryd-{0} restart".format(
+            agent_config['name']))
     _wait_for_started(runner, agent_config)
 
 
@@ -359,20 +764,20 @@ def _delete_amqp_queues(worker_name):
     # re-used if vm gets re-created by auto-heal.
     # Deleting the queues is a workaround for celery problems this creates.
     # Having unique worker names is probably a better long-term strategy.
-    client = amqp_client.create_client()
-    try:
-        channel = client.connection.channel()
+    #
+    # The deletions of concurrent installs share a single broker channel
+    # and round trip.
+    delete_worker_queues([worker_name])
 
-        # celery worker queue
-        channel.queue_delete(worker_name)
 
-        # celery management queue
-        channel.queue_delete('celery@{0}.celery.pidbox'.format(worker_name))
-    finally:
-        try:
-            client.close()
-        except Exception:
-            pass
+def _expire_amqp_queues(agent_config):
+    # the broker deletes the pidbox queues once they are unused for
+    # queue_expires seconds. the pidbox queue of a previous worker with the
+    # same name is only gone by the time a re-created vm starts its worker
+    # if healing it took longer than that. the policy is shared by all
+    # agents, only the first install of the process sets it
+    expire_worker_queues(agent_config['queue_expires'],
+                         agent_config['broker_management_url'])
 
 
 def _verify_no_celery_error(runner, agent_config):
@@ -383,32 +788,104 @@ def _verify_no_celery_error(runner, agent_config):
     #  exception and it wrote its content
     # to the file above because of our custom exception handler (see celery.py)
     if runner.exists(celery_error_out):
-        output = runner.get(celery_error_out)
+        output = StringIO()
+        runner.get_file(celery_error_out, output,
+                        max_bytes=CELERY_ERROR_MAX_BYTES, tail=True)
         runner.run('rm {0}'.format(celery_error_out))
         raise NonRecoverableError(
-            'Celery worker failed to start:\n{0}'.format(output))
+            'Celery worker failed to start:\n{0}'.format(output.getvalue()))
+
+
+def _verify_no_celery_error_async(runner, agent_config):
+    celery_error_out = os.path.join(
+        agent_config['base_dir'], 'work/celery_error.out')
+    if (yield runner.exists(celery_error_out)):
+        output = StringIO()
+        yield runner.get_file(celery_error_out, output,
+                              max_bytes=CELERY_ERROR_MAX_BYTES, tail=True)
+        yield runner.run('rm {0}'.format(celery_error_out))
+        raise NonRecoverableError(
+            'Celery worker failed to start:\n{0}'.format(output.getvalue()))
 
 
 def _wait_for_started(runner, agent_config):
     _verify_no_celery_error(runner, agent_config)
-    worker_name = 'celery@{0}'.format(agent_config['name'])
-    inspect = celery_client.control.inspect(destination=[worker_name])
-    wait_started_timeout = agent_config['wait_started_timeout']
-    timeout = time.time() + wait_started_timeout
-    interval = agent_config['wait_started_interval']
-    while time.time() < timeout:
-        stats = (inspect.stats() or {}).get(worker_name)
-        if stats:
-            return
-        time.sleep(interval)
+    with phase(runner, 'wait_started'):
+        started = _wait_for_worker(agent_config)
+    if started:
+        return
     _verify_no_celery_error(runner, agent_config)
-    celery_log_file = os.path.join(
-        agent_config['base_dir'], 'work/celery.log')
-    if os.path.exists(celery_log_file):
-        with open(celery_log_file, 'r') as f:
-            ctx.logger.error(f.read())
-    raise NonRecoverableError('Failed starting agent. waited for {0} seconds.'
-                              .format(wait_started_timeout))
+    _raise_not_started(agent_config, _celery_log_tail(runner, agent_config))
+
+
+def _wait_for_started_async(runner, agent_config):
+    """
+    The coroutine counterpart of `_wait_for_started`. The shared readiness
+    waiter resolves a future on the loop, so no thread is held while the
+    agent boots.
+    """
+    loop = runner.loop
+    yield _verify_no_celery_error_async(runner, agent_config)
+    started = Future()
+    shared_waiter(celery_client).watch(
+        _worker_name(agent_config), agent_config['wait_started_timeout'],
+        lambda online: loop.call_soon_threadsafe(started.set_result, online),
+        max_poll_interval=agent_config['wait_started_interval'])
+    with phase(runner, 'wait_started'):
+        online = yield started
+    if online:
+        return
+    yield _verify_no_celery_error_async(runner, agent_config)
+    log_tail = yield _celery_log_tail_async(runner, agent_config)
+    _raise_not_started(agent_config, log_tail)
+
+
+def _wait_for_worker(agent_config):
+    return wait_for_worker(
+        celery_client, _worker_name(agent_config),
+        timeout=agent_config['wait_started_timeout'],
+        max_poll_interval=agent_config['wait_started_interval'])
+
+
+def _worker_name(agent_config):
+    return 'celery@{0}'.format(agent_config['name'])
+
+
+def _celery_log_file(agent_config):
+    return os.path.join(agent_config['base_dir'], 'work/celery.log')
+
+
+def _celery_log_tail(runner, agent_config):
+    """the end of the agent's log on its host, or None if unavailable"""
+    try:
+        return runner.tail(_celery_log_file(agent_config),
+                           max_bytes=CELERY_LOG_TAIL_BYTES,
+                           max_lines=CELERY_LOG_TAIL_LINES)
+    except FabricRunnerException as e:
+        ctx.logger.warn('Could not read the log of agent {0}: {1}'.format(
+            agent_config['name'], e))
+
+
+def _celery_log_tail_async(runner, agent_config):
+    try:
+        log_tail = yield runner.tail(_celery_log_file(agent_config),
+                                     max_bytes=CELERY_LOG_TAIL_BYTES,
+                                     max_lines=CELERY_LOG_TAIL_LINES)
+    except FabricRunnerException as e:
+        ctx.logger.warn('Could not read the log of agent {0}: {1}'.format(
+            agent_config['name'], e))
+        return
+    raise Return(log_tail)
+
+
+def _raise_not_started(agent_config, log_tail=None, message=None):
+    if message is None:
+        message = 'Failed starting agent. waited for {0} seconds.'.format(
+            agent_config['wait_started_timeout'])
+    if log_tail:
+        message = '{0} End of {1}:\n{2}'.format(
+            message, _celery_log_file(agent_config), log_tail)
+    raise NonRecoverableError(message)
 
 
 def connection_details(cloudify_agent):
@@ -0,0 +1,245 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""
+A process wide cache of the compiled celery config and init templates.
+
+A template is loaded from the manager and compiled by the first install
+needing it, and installs render it from memory from then on. Once it is
+older than ``revalidate_after`` seconds it is revalidated: with a
+conditional request (If-None-Match) when its loader supports one (see
+`FileServerLoader`), by loading it again otherwise. Either way, it is
+only compiled again when its content changed. The least recently used
+templates are evicted beyond ``max_size``.
+
+With ``CLOUDIFY_AGENT_TEMPLATE_CACHE_DIR`` set, compiled templates are
+also kept on disk in a jinja2 bytecode cache, so that new processes skip
+compiling them too.
+"""
+
+import collections
+import hashlib
+import logging
+import os
+import socket
+import threading
+import time
+import urllib2
+
+from cloudify import manager
+from cloudify import utils
+from cloudify.exceptions import NonRecoverableError
+
+BYTECODE_CACHE_DIR_ENV = 'CLOUDIFY_AGENT_TEMPLATE_CACHE_DIR'
+DEFAULT_MAX_SIZE = 32
+DEFAULT_REVALIDATE_AFTER = 60
+DEFAULT_FETCH_TIMEOUT = 30
+
+logger = logging.getLogger('worker_installer.templates')
+
+
+class FileServerLoader(object):
+    """
+    Loads resources from the manager file server. Resources are loaded
+    with `manager.get_resource`, and revalidated with conditional
+    requests.
+    """
+
+    def __init__(self, base_url=None, fetch_timeout=DEFAULT_FETCH_TIMEOUT):
+        self.base_url = base_url
+        self.fetch_timeout = fetch_timeout
+
+    def __call__(self, path):
+        if self.base_url is None:
+            return manager.get_resource(path)
+        return manager.get_resource(path, base_url=self.base_url)
+
+    def load_if_changed(self, path, etag):
+        """
+        Returns the content of ``path`` and its etag, or None as the
+        content when the resource still matches ``etag``.
+        """
+        base_url = self.base_url or utils.get_manager_file_server_url()
+        request = urllib2.Request('{0}/{1}'.format(base_url.rstrip('/'),
+                                                   path.lstrip('/')))
+        if etag:
+            request.add_header('If-None-Match', etag)
+        try:
+            response = urllib2.urlopen(request, timeout=self.fetch_timeout)
+        except urllib2.HTTPError as e:
+            if e.code == 304:
+                return None, etag
+            raise
+        try:
+            return response.read(), response.info().getheader('ETag')
+        finally:
+            response.close()
+
+
+class _Entry(object):
+
+    def __init__(self, template, digest, etag=None):
+        self.template = template
+        self.digest = digest
+        self.etag = etag
+        self.validated_at = time.time()
+
+
+class _Load(object):
+    """a load in progress, waited for by the other threads needing it"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.entry = None
+        self.error = None
+
+
+class TemplateCache(object):
+    """compiled templates by resource path, see the module's docstring"""
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE,
+                 revalidate_after=DEFAULT_REVALIDATE_AFTER,
+                 bytecode_cache_dir=None):
+        self.max_size = max_size
+        self.revalidate_after = revalidate_after
+        self.bytecode_cache_dir = bytecode_cache_dir
+        self.loads = 0
+        self.compilations = 0
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._loads = {}
+        self._environment = None
+        self._bytecode_cache = None
+
+    def get_template(self, path, loader):
+        """
+        The compiled template of the resource at ``path``, loaded with
+        ``loader`` (e.g. `FileServerLoader`) when needed.
+        """
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None:
+                # least recently used entries are first in line for eviction
+                del self._entries[path]
+                self._entries[path] = entry
+                if time.time() - entry.validated_at < self.revalidate_after:
+                    return entry.template
+            load = self._loads.get(path)
+            leader = load is None
+            if leader:
+                load = self._loads[path] = _Load()
+        if not leader:
+            load.done.wait()
+            if load.error is not None:
+                raise load.error
+            return load.entry.template
+        try:
+            load.entry = self._load(path, loader, entry)
+            return load.entry.template
+        except Exception as e:
+            load.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._loads[path]
+            load.done.set()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _load(self, path, loader, cached):
+        with self._lock:
+            self.loads += 1
+        etag = None
+        load_if_changed = getattr(loader, 'load_if_changed', None)
+        if cached is not None and load_if_changed is not None:
+            try:
+                source, etag = load_if_changed(path, cached.etag)
+            except (urllib2.URLError, socket.error) as e:
+                logger.warning('Failed revalidating {0}, using the cached '
+                               'template: {1}'.format(path, e))
+                source = None
+            if source is None:
+                cached.validated_at = time.time()
+                return cached
+        else:
+            if load_if_changed is None:
+                source = loader(path)
+            else:
+                # the first load gets the etag to revalidate the template with
+                try:
+                    source, etag = load_if_changed(path, None)
+                except urllib2.HTTPError as e:
+                    if e.code != 404:
+                        raise
+                    source = None
+            if source is None:
+                raise NonRecoverableError('template not found: {0}'.format(
+                    path))
+        if isinstance(source, str):
+            source = source.decode('utf-8')
+        digest = hashlib.sha256(source.encode('utf-8')).hexdigest()
+        if cached is not None and cached.digest == digest:
+            entry = _Entry(cached.template, digest, etag)
+        else:
+            entry = _Entry(self._compile(path, source), digest, etag)
+        with self._lock:
+            self._entries.pop(path, None)
+            self._entries[path] = entry
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return entry
+
+    def _compile(self, path, source):
+        """
+        Compiles ``source``, or loads its code from the bytecode cache the
+        way jinja2 loaders do.
+        """
+        environment = self._get_environment()
+        bucket = None
+        code = None
+        if self._bytecode_cache is not None:
+            bucket = self._bytecode_cache.get_bucket(environment, path, None,
+                                                     source)
+            code = bucket.code
+        if code is None:
+            with self._lock:
+                self.compilations += 1
+            code = environment.compile(source, path)
+            if bucket is not None:
+                bucket.code = code
+                self._bytecode_cache.set_bucket(bucket)
+        return environment.template_class.from_code(
+            environment, code, environment.make_globals(None))
+
+    def _get_environment(self):
+        with self._lock:
+            if self._environment is None:
+                # jinja2 is only needed by the installs, not by every
+                # process loading the plugin's tasks
+                import jinja2
+                if self.bytecode_cache_dir is not None:
+                    if not os.path.isdir(self.bytecode_cache_dir):
+                        os.makedirs(self.bytecode_cache_dir)
+                    self._bytecode_cache = jinja2.FileSystemBytecodeCache(
+                        self.bytecode_cache_dir)
+                self._environment = jinja2.Environment()
+            return self._environment
+
+
+template_cache = TemplateCache(
+    bytecode_cache_dir=os.environ.get(BYTECODE_CACHE_DIR_ENV))
+file_server_loader = FileServerLoader()
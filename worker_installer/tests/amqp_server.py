@@ -0,0 +1,150 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""
+An in-process AMQP 0-9-1 server standing in for the manager's broker in
+tests and benchmarks.
+
+It speaks just enough of the protocol for connections, channels and
+queue declarations and deletions, and keeps count of them. ``latency``
+delays every batch of frames read from a connection, like a network
+round trip does.
+"""
+
+import socket
+import threading
+import time
+import SocketServer
+
+from pika import frame
+from pika import spec
+
+
+class LocalAMQPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+    def __init__(self, latency=0):
+        SocketServer.TCPServer.__init__(self, ('127.0.0.1', 0),
+                                        _AMQPHandler)
+        self.latency = latency
+        self.queues = set()
+        self.connections = 0
+        self.deleted = []
+        # deletions the client waited for
+        self.confirmed_deletions = 0
+        self.lock = threading.Lock()
+        self._handlers = set()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever,
+                                  kwargs={'poll_interval': 0.05})
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.drop_connections()
+
+    def drop_connections(self):
+        """closes every open connection, like a broker restart does"""
+        with self.lock:
+            handlers = list(self._handlers)
+        for handler in handlers:
+            try:
+                handler.request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+
+class _AMQPHandler(SocketServer.BaseRequestHandler):
+
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self.server.lock:
+            self.server.connections += 1
+            self.server._handlers.add(self)
+
+    def finish(self):
+        with self.server.lock:
+            self.server._handlers.discard(self)
+
+    def handle(self):
+        data = ''
+        while True:
+            try:
+                received = self.request.recv(65536)
+            except socket.error:
+                return
+            if not received:
+                return
+            if self.server.latency:
+                time.sleep(self.server.latency)
+            data += received
+            replies = []
+            while data:
+                consumed, received_frame = frame.decode_frame(data)
+                if not consumed:
+                    break
+                data = data[consumed:]
+                reply = self._reply(received_frame)
+                if reply is not None:
+                    channel_number = getattr(received_frame,
+                                             'channel_number', 0)
+                    replies.append(
+                        frame.Method(channel_number, reply).marshal())
+            if replies:
+                self.request.sendall(''.join(replies))
+
+    def _reply(self, received_frame):
+        if isinstance(received_frame, frame.ProtocolHeader):
+            return spec.Connection.Start(
+                server_properties={'product': 'LocalAMQPServer'},
+                mechanisms='PLAIN')
+        if not isinstance(received_frame, frame.Method):
+            # heartbeats and message contents
+            return None
+        method = received_frame.method
+        if isinstance(method, spec.Connection.StartOk):
+            return spec.Connection.Tune(channel_max=2047, frame_max=131072)
+        if isinstance(method, spec.Connection.Open):
+            return spec.Connection.OpenOk()
+        if isinstance(method, spec.Connection.Close):
+            return spec.Connection.CloseOk()
+        if isinstance(method, spec.Channel.Open):
+            return spec.Channel.OpenOk()
+        if isinstance(method, spec.Channel.Close):
+            return spec.Channel.CloseOk()
+        if isinstance(method, spec.Queue.Declare):
+            with self.server.lock:
+                self.server.queues.add(method.queue)
+            if not method.nowait:
+                return spec.Queue.DeclareOk(method.queue, 0, 0)
+        if isinstance(method, spec.Queue.Delete):
+            with self.server.lock:
+                self.server.queues.discard(method.queue)
+                self.server.deleted.append(method.queue)
+            if not method.nowait:
+                with self.server.lock:
+                    self.server.confirmed_deletions += 1
+                return spec.Queue.DeleteOk(0)
+        return None
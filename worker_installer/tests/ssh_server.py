@@ -0,0 +1,238 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""
+An in-process SSH server standing in for an agent host in tests.
+
+Commands are executed on the local machine, and the sftp subsystem
+serves the local file system.
+"""
+
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+
+import paramiko
+
+from worker_installer.tests import get_logger
+
+logger = get_logger('LocalSSHServer')
+
+_host_key = None
+_host_key_lock = threading.Lock()
+
+
+def _get_host_key():
+    # generating a key is slow, all servers share one
+    global _host_key
+    with _host_key_lock:
+        if _host_key is None:
+            _host_key = paramiko.RSAKey.generate(1024)
+        return _host_key
+
+
+class _SFTPHandle(paramiko.SFTPHandle):
+
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(
+                os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+
+class _SFTPServer(paramiko.SFTPServerInterface):
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(path, flags, 0o644)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        handle = _SFTPHandle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.lstat(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        try:
+            os.rename(oldpath, newpath)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def chattr(self, path, attr):
+        try:
+            paramiko.SFTPServer.set_file_attr(path, attr)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def canonicalize(self, path):
+        return os.path.abspath(path)
+
+
+class _ServerInterface(paramiko.ServerInterface):
+
+    def __init__(self, server):
+        self.server = server
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        if (username, password) == (self.server.user, self.server.password):
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_pty_request(self, channel, term, width, height,
+                                  pixelwidth, pixelheight, modes):
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        thread = threading.Thread(target=self.server.execute,
+                                  args=(channel, command))
+        thread.daemon = True
+        thread.start()
+        return True
+
+
+class LocalSSHServer(object):
+    """
+    Listens on a random local port and accepts password authentication for
+    a single user.
+    """
+
+    def __init__(self, user='cloudify', password='cloudify'):
+        self.user = user
+        self.password = password
+        self.host = '127.0.0.1'
+        self.connections = 0
+        self.commands = []
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((self.host, 0))
+        self.port = self._socket.getsockname()[1]
+        self._transports = []
+        self._closed = False
+        # commands run in login shells, keep the local user's profile out
+        self.home_dir = tempfile.mkdtemp()
+        self._env = {
+            'HOME': self.home_dir,
+            'PATH': os.environ.get('PATH', '/usr/bin:/bin')
+        }
+
+    def start(self):
+        self._socket.listen(100)
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self._closed = True
+        self._socket.close()
+        for transport in self._transports:
+            transport.close()
+        shutil.rmtree(self.home_dir, ignore_errors=True)
+
+    @property
+    def agent_config(self):
+        return {
+            'user': self.user,
+            'password': self.password,
+            'host': self.host,
+            'port': self.port
+        }
+
+    def execute(self, channel, command):
+        self.commands.append(command)
+        try:
+            process = subprocess.Popen(command, shell=True,
+                                       cwd=self.home_dir,
+                                       env=self._env,
+                                       stdin=subprocess.PIPE,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT)
+            feeder = threading.Thread(target=self._feed,
+                                      args=(channel, process))
+            feeder.daemon = True
+            feeder.start()
+            for data in iter(lambda: process.stdout.read(4096), ''):
+                channel.sendall(data)
+            channel.send_exit_status(process.wait())
+        except Exception as e:
+            logger.debug('Failed executing {0}: {1}'.format(command, e))
+            channel.send_exit_status(255)
+        finally:
+            channel.close()
+
+    def _feed(self, channel, process):
+        try:
+            for data in iter(lambda: channel.recv(4096), ''):
+                process.stdin.write(data)
+        except Exception:
+            pass
+        finally:
+            try:
+                process.stdin.close()
+            except Exception:
+                pass
+
+    def _accept(self):
+        while not self._closed:
+            try:
+                client, _ = self._socket.accept()
+            except socket.error:
+                return
+            self.connections += 1
+            transport = paramiko.Transport(client)
+            transport.add_server_key(_get_host_key())
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer,
+                                            _SFTPServer)
+            transport.start_server(server=_ServerInterface(self))
+            self._transports.append(transport)
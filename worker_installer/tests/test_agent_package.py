@@ -0,0 +1,248 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import hashlib
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import unittest
+import BaseHTTPServer
+import SimpleHTTPServer
+
+from cloudify.mocks import MockCloudifyContext
+from cloudify.exceptions import NonRecoverableError
+
+from worker_installer import agent_package
+from worker_installer.utils import FabricRunner
+from worker_installer.utils import FabricRunnerException
+
+
+class _PackageHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+
+    serve_dir = None
+    etag = True
+    requests = []
+
+    def translate_path(self, path):
+        return os.path.join(self.serve_dir, path.lstrip('/'))
+
+    def send_response(self, code, message=None):
+        SimpleHTTPServer.SimpleHTTPRequestHandler.send_response(
+            self, code, message)
+        self.requests.append((self.command, self.path))
+        if code == 200 and self.etag:
+            stat = os.stat(self.translate_path(self.path))
+            self.send_header('ETag', '"{0}-{1}"'.format(
+                int(stat.st_mtime), stat.st_size))
+
+    def log_message(self, *args):
+        pass
+
+
+def _create_package(serve_dir, name, content):
+    package_dir = os.path.join(serve_dir, name, 'env', 'bin')
+    os.makedirs(package_dir)
+    with open(os.path.join(package_dir, 'python'), 'w') as f:
+        f.write(content)
+    archive = os.path.join(serve_dir, '{0}.tar.gz'.format(name))
+    with tarfile.open(archive, 'w:gz') as tar:
+        tar.add(os.path.join(serve_dir, name), arcname='root/package')
+    with open(archive, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class AgentPackageTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.serve_dir = tempfile.mkdtemp()
+        cls.checksum = _create_package(cls.serve_dir, 'agent',
+                                       '#!/usr/bin/python')
+        cls.other_checksum = _create_package(cls.serve_dir, 'other',
+                                             '#!/usr/bin/python2')
+        _PackageHandler.serve_dir = cls.serve_dir
+        cls.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0),
+                                               _PackageHandler)
+        thread = threading.Thread(target=cls.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        cls.base_url = 'http://127.0.0.1:{0}'.format(
+            cls.server.server_address[1])
+        cls.url = '{0}/agent.tar.gz'.format(cls.base_url)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        shutil.rmtree(cls.serve_dir)
+
+    def setUp(self):
+        ctx = MockCloudifyContext(deployment_id='deployment_id')
+        self.runner = FabricRunner(ctx)
+        self.work_dir = tempfile.mkdtemp()
+        self.base_dir = os.path.join(self.work_dir, 'cloudify.agent')
+        os.makedirs(self.base_dir)
+        self.cache_dir = os.path.join(self.work_dir, 'cache')
+        _PackageHandler.etag = True
+        del _PackageHandler.requests[:]
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def _assert_extracted(self):
+        self.assertTrue(os.path.isfile(
+            os.path.join(self.base_dir, 'env', 'bin', 'python')))
+        self.assertFalse(os.path.exists(
+            agent_package.archive_path(self.base_dir)))
+
+    def test_normalize_checksum(self):
+        self.assertEqual(self.checksum, agent_package.normalize_checksum(
+            'SHA256:{0}'.format(self.checksum.upper())))
+        self.assertIsNone(agent_package.normalize_checksum(None))
+        self.assertRaises(NonRecoverableError,
+                          agent_package.normalize_checksum, 'md5:abc')
+
+    def test_can_stream(self):
+        self.assertTrue(agent_package.can_stream(['wget']))
+        self.assertFalse(agent_package.can_stream(None))
+        self.assertFalse(agent_package.can_stream(['python']))
+        self.assertFalse(agent_package.can_stream(['curl'], self.checksum))
+        self.assertTrue(agent_package.can_stream(['curl', 'sha256sum'],
+                                                 self.checksum))
+
+    def test_stream(self):
+        for tools in (['curl'], ['wget']):
+            self.runner.run(agent_package.stream_extract_command(
+                self.url, self.base_dir, tools))
+            self._assert_extracted()
+
+    def test_stream_with_checksum(self):
+        self.runner.run(agent_package.stream_extract_command(
+            self.url, self.base_dir, ['curl', 'sha256sum'], self.checksum))
+        self._assert_extracted()
+
+    def test_stream_checksum_mismatch(self):
+        try:
+            self.runner.run(agent_package.stream_extract_command(
+                self.url, self.base_dir, ['wget', 'sha256sum'], '0' * 64))
+            self.fail('expected checksum verification to fail')
+        except FabricRunnerException as e:
+            self.assertIn('checksum mismatch', e.message)
+        self.assertFalse(os.path.exists(self.base_dir))
+
+    def test_stream_missing_package(self):
+        self.assertRaises(
+            FabricRunnerException, self.runner.run,
+            agent_package.stream_extract_command(
+                self.url + '.missing', self.base_dir, ['curl']))
+
+    def test_download_extract_with_python_checksum(self):
+        with self.runner.batch() as batch:
+            for command in agent_package.download_extract_commands(
+                    self.url, self.base_dir, ['wget', 'python'],
+                    self.checksum):
+                batch.run(command)
+            batch.run(agent_package.cleanup_command(self.base_dir))
+        self._assert_extracted()
+
+    def test_download_checksum_mismatch(self):
+        def install():
+            with self.runner.batch() as batch:
+                for command in agent_package.download_extract_commands(
+                        self.url, self.base_dir, ['curl', 'sha256sum'],
+                        '0' * 64):
+                    batch.run(command)
+        self.assertRaises(FabricRunnerException, install)
+        self.assertFalse(os.path.exists(self.base_dir))
+
+    def _install_cached(self, url=None, checksum=None, max_size=None,
+                        tools=('curl', 'sha256sum'), stream=True):
+        shutil.rmtree(self.base_dir, ignore_errors=True)
+        os.makedirs(self.base_dir)
+        output = self.runner.run(agent_package.cached_extract_command(
+            url or self.url, self.base_dir, list(tools), self.cache_dir,
+            max_size or agent_package.DEFAULT_CACHE_MAX_SIZE,
+            checksum=checksum, stream=stream))
+        self._assert_extracted()
+        return output
+
+    def _cache_entries(self):
+        return sorted(name for name in os.listdir(self.cache_dir)
+                      if name.endswith('.tar.gz'))
+
+    def _downloads(self):
+        return len([r for r in _PackageHandler.requests if r[0] == 'GET'])
+
+    def test_can_cache(self):
+        self.assertTrue(agent_package.can_cache(['wget', 'python']))
+        self.assertFalse(agent_package.can_cache(['wget']))
+        self.assertFalse(agent_package.can_cache(['sha256sum']))
+
+    def test_cache_hit_by_checksum(self):
+        self._install_cached(checksum=self.checksum)
+        output = self._install_cached(checksum=self.checksum)
+        self.assertIn('cache hit', output)
+        self.assertEqual(1, self._downloads())
+        self.assertEqual(['sha256-{0}.tar.gz'.format(self.checksum)],
+                         self._cache_entries())
+
+    def test_cache_hit_by_etag(self):
+        for tools in (['curl', 'sha256sum'], ['wget', 'python']):
+            self._install_cached(tools=tools, stream=False)
+            self.assertIn('cache hit', self._install_cached(tools=tools))
+        self.assertEqual(1, self._downloads())
+        self.assertEqual(1, len(self._cache_entries()))
+
+    def test_no_cache_without_etag(self):
+        _PackageHandler.etag = False
+        self.assertIn('not caching', self._install_cached())
+        self._install_cached()
+        self.assertEqual(2, self._downloads())
+        self.assertEqual([], self._cache_entries())
+
+    def test_corrupted_entry_downloaded_again(self):
+        self._install_cached(checksum=self.checksum)
+        entry = os.path.join(self.cache_dir, self._cache_entries()[0])
+        with open(entry, 'ab') as f:
+            f.write('garbage')
+        self.assertNotIn('cache hit',
+                         self._install_cached(checksum=self.checksum))
+        self.assertEqual(2, self._downloads())
+
+    def test_cache_eviction(self):
+        self._install_cached(checksum=self.checksum, max_size=1)
+        output = self._install_cached(
+            url='{0}/other.tar.gz'.format(self.base_url),
+            checksum=self.other_checksum, max_size=1)
+        self.assertIn('evicting', output)
+        self.assertEqual(['sha256-{0}.tar.gz'.format(self.other_checksum)],
+                         self._cache_entries())
+
+    def test_uncached_checksum(self):
+        # a file where the cache directory should be, nothing is cached
+        with open(self.cache_dir, 'w'):
+            pass
+        self.assertIn('not caching',
+                      self._install_cached(checksum=self.checksum))
+        self.assertRaises(FabricRunnerException, self._install_cached,
+                          checksum='0' * 64)
+        self.assertFalse(os.path.exists(self.base_dir))
+
+    def test_cache_checksum_mismatch(self):
+        self.assertRaises(FabricRunnerException, self._install_cached,
+                          checksum='0' * 64)
+        self.assertFalse(os.path.exists(self.base_dir))
+        self.assertEqual([], self._cache_entries())
@@ -0,0 +1,151 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from cloudify.mocks import MockCloudifyContext
+from cloudify.exceptions import NonRecoverableError
+
+from worker_installer import run_with_agent_config_async
+from worker_installer import tasks
+from worker_installer.async_runner import AsyncRunner
+from worker_installer.event_loop import EventLoop
+from worker_installer.event_loop import Return
+from worker_installer.utils import CommandBatch
+from worker_installer.utils import FabricRunnerException
+from worker_installer.tests.ssh_server import LocalSSHServer
+
+
+class AsyncRunnerTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = LocalSSHServer().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        self.ctx = MockCloudifyContext(node_id='node_id')
+        self.loop = EventLoop()
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.loop.close()
+        shutil.rmtree(self.work_dir)
+
+    def _runner(self):
+        return AsyncRunner(self.ctx, self.server.agent_config, self.loop)
+
+    def test_run(self):
+        runner = self._runner()
+        self.assertEqual('quoted  spaces $HOME', self.loop.run_until_complete(
+            runner.run('echo "quoted  spaces" \'$HOME\'')))
+
+    def test_run_failure(self):
+        try:
+            self.loop.run_until_complete(
+                self._runner().run('echo failure; exit 2'))
+            self.fail('expected command to fail')
+        except FabricRunnerException as e:
+            self.assertEqual(2, e.code)
+            self.assertEqual('failure', e.message)
+
+    def test_put_get_exists(self):
+        runner = self._runner()
+        file_path = os.path.join(self.work_dir, 'sub', 'file')
+
+        def flow():
+            before = yield runner.exists(file_path)
+            yield runner.put(file_path, 'content')
+            after = yield runner.exists(file_path)
+            content = yield runner.get(file_path)
+            raise Return((before, after, content))
+        self.assertEqual((False, True, 'content'),
+                         self.loop.run_until_complete(flow()))
+        self.assertRaises(NonRecoverableError, self.loop.run_until_complete,
+                          runner.put(file_path, 'x'))
+
+    def test_tail(self):
+        file_path = os.path.join(self.work_dir, 'log')
+        with open(file_path, 'w') as f:
+            f.write(''.join('line {0}\n'.format(i) for i in range(1000)))
+        self.assertEqual('line 999', self.loop.run_until_complete(
+            self._runner().tail(file_path, max_lines=1)))
+
+    def test_flush_batch(self):
+        runner = self._runner()
+        batch = CommandBatch(runner)
+        batch.run('echo first')
+        batch.run('exit 1', ignore_errors=True)
+        batch.run('echo last')
+        steps = self.loop.run_until_complete(runner.flush(batch))
+        self.assertEqual(['first', '', 'last'],
+                         [step.output for step in steps])
+        self.assertTrue(steps[1].failed)
+
+    def test_many_commands_on_one_thread(self):
+        runners = [self._runner() for _ in range(10)]
+        threads_before = threading.active_count()
+
+        def flow(index, runner):
+            outputs = []
+            for _ in range(3):
+                output = yield runner.run('sleep 0.1; echo {0}'.format(index))
+                outputs.append(output)
+            raise Return(outputs)
+        results = self.loop.run_until_complete(
+            [flow(index, runner) for index, runner in enumerate(runners)])
+        self.assertEqual([[str(index)] * 3 for index in range(10)], results)
+        # opening channels is left to the executor, nothing else is
+        # allowed to hold a thread per command
+        self.assertTrue(threading.active_count() - threads_before <=
+                        self.loop._executor_size)
+
+    def test_run_with_agent_config(self):
+        agent_config = dict(self.server.agent_config,
+                            name='agent', home_dir=self.work_dir)
+
+        def flow(ctx, runner, agent_config, host_facts):
+            output = yield runner.run('echo {0}'.format(
+                agent_config['base_dir']))
+            raise Return((output, host_facts.base_dir_exists))
+        result = self.loop.run_until_complete(run_with_agent_config_async(
+            self.ctx, self.loop, agent_config, flow, self.ctx))
+        self.assertEqual(
+            (os.path.join(self.work_dir, 'cloudify.agent'), False), result)
+
+    def test_run_many_on_event_loop(self):
+        def flow(ctx, runner, agent_config, host_facts):
+            if agent_config['name'] == 'agent2':
+                raise RuntimeError('cannot install')
+            output = yield runner.run('echo {0}'.format(
+                agent_config['name']))
+            raise Return(output)
+
+        agents = [dict(self.server.agent_config, name='agent{0}'.format(i),
+                       home_dir=self.work_dir) for i in range(4)]
+        try:
+            tasks._run_many(self.ctx, 'test', flow, agents, concurrency=4,
+                            timeout=10, use_event_loop=True)
+            self.fail('expected bulk operation to fail')
+        except NonRecoverableError as e:
+            self.assertIn('1 of 4 agents', str(e))
+            self.assertIn('agent2 (cannot install)', str(e))
@@ -0,0 +1,164 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import getpass
+import os
+import pwd
+import threading
+import time
+import unittest
+
+from mock import MagicMock
+from mock import patch
+
+from cloudify.mocks import MockCloudifyContext
+from cloudify.exceptions import NonRecoverableError
+
+from worker_installer import tasks
+from worker_installer.concurrency import run_bounded
+
+
+# for tests purposes. need a path to a file which always exists
+KEY_FILE_PATH = '/bin/sh'
+
+
+class RunBoundedTest(unittest.TestCase):
+
+    def test_results_in_order(self):
+        results = run_bounded(lambda item: item * 2, [1, 2, 3],
+                              concurrency=2)
+        self.assertEqual([2, 4, 6], [result.result for result in results])
+        self.assertTrue(all(result.succeeded for result in results))
+
+    def test_concurrency_is_bounded(self):
+        lock = threading.Lock()
+        running = [0]
+        peak = [0]
+
+        def task(item):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+
+        run_bounded(task, range(10), concurrency=3)
+        self.assertEqual(3, peak[0])
+
+    def test_errors_are_collected(self):
+        def task(item):
+            if item == 2:
+                raise RuntimeError('failed on 2')
+            return item
+
+        results = run_bounded(task, [1, 2, 3], concurrency=3)
+        self.assertEqual([True, False, True],
+                         [result.succeeded for result in results])
+        self.assertEqual('failed', results[1].to_dict()['status'])
+        self.assertIn('failed on 2', results[1].traceback)
+
+    def test_timeout_frees_slot(self):
+        def task(item):
+            if item == 'slow':
+                time.sleep(5)
+            return item
+
+        start = time.time()
+        results = run_bounded(task, ['slow', 'fast'], concurrency=1,
+                              timeout=0.2)
+        self.assertTrue(time.time() - start < 2)
+        self.assertTrue(results[0].timed_out)
+        self.assertEqual('timeout', results[0].to_dict()['status'])
+        self.assertTrue(results[1].succeeded)
+
+
+class BulkOperationsTest(unittest.TestCase):
+
+    def setUp(self):
+        os.environ['MANAGEMENT_USER'] = getpass.getuser()
+        self.ctx = MockCloudifyContext(deployment_id='deployment_id')
+        self.home_dir = pwd.getpwnam(getpass.getuser()).pw_dir
+
+    def _agent(self, name, host):
+        return {
+            'name': name,
+            'host': host,
+            'user': getpass.getuser(),
+            'key': KEY_FILE_PATH,
+            'home_dir': self.home_dir,
+            'distro': 'Ubuntu',
+            'distro_codename': 'trusty'
+        }
+
+    def test_run_many(self):
+        seen = {}
+
+        def flow(ctx, runner, agent_config, host_facts):
+            self.assertFalse(runner.local)
+            seen[agent_config['name']] = agent_config['base_dir']
+
+        summary = tasks._run_many(
+            self.ctx, 'test', flow,
+            [self._agent('agent1', '10.0.0.1'),
+             self._agent('agent2', '10.0.0.2')],
+            concurrency=2, timeout=10)
+        self.assertEqual(['agent1', 'agent2'], sorted(seen.keys()))
+        self.assertEqual('{0}/cloudify.agent1'.format(self.home_dir),
+                         seen['agent1'])
+        self.assertEqual('ok', summary['agent1']['status'])
+
+    def test_run_many_reports_failures(self):
+        def flow(ctx, runner, agent_config, host_facts):
+            if agent_config['name'] == 'agent2':
+                raise RuntimeError('cannot install')
+
+        agents = [self._agent('agent1', '10.0.0.1'),
+                  self._agent('agent2', '10.0.0.2')]
+        try:
+            tasks._run_many(self.ctx, 'test', flow, agents,
+                            concurrency=2, timeout=10)
+            self.fail('expected bulk operation to fail')
+        except NonRecoverableError as e:
+            self.assertIn('1 of 2 agents', str(e))
+            self.assertIn('agent2 (cannot install)', str(e))
+
+    def test_run_many_requires_host(self):
+        agent = self._agent('agent1', '10.0.0.1')
+        del agent['host']
+        self.assertRaises(NonRecoverableError, tasks._run_many,
+                          self.ctx, 'test', lambda **kwargs: None, [agent],
+                          concurrency=1, timeout=10)
+
+    def test_install_many_default_package_url(self):
+        urls = []
+
+        def run_with_agent_config(ctx, agent_config, flow, *args, **kwargs):
+            del kwargs['persist_resolved_config']
+            return flow(*args, runner=MagicMock(), agent_config=agent_config,
+                        host_facts=MagicMock(base_dir_exists=True), **kwargs)
+
+        def get_agent_resource_url(ctx, agent_config, resource):
+            urls.append(resource)
+            return 'http://manager/agent.tar.gz'
+
+        with patch.object(tasks, 'run_with_agent_config',
+                          run_with_agent_config), \
+                patch.object(tasks, 'get_agent_resource_url',
+                             get_agent_resource_url):
+            summary = tasks.install_many(
+                ctx=self.ctx, agents=[self._agent('agent1', '10.0.0.1')])
+        self.assertEqual('ok', summary['agent1']['status'])
+        self.assertEqual(['agent_package_path'], urls)
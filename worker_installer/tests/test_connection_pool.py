@@ -0,0 +1,133 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import unittest
+
+from mock import MagicMock
+
+from worker_installer.connection_pool import SSHConnectionPool
+
+
+class MockClient(object):
+
+    def __init__(self, host_key='host-key'):
+        self.closed = False
+        self.transport = MagicMock()
+        self.transport.is_active.return_value = True
+        self.transport.get_remote_server_key.return_value.get_fingerprint\
+            .return_value = host_key
+
+    def get_transport(self):
+        return self.transport
+
+    def close(self):
+        self.closed = True
+
+
+class SSHConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clients = []
+        self.host_key = 'host-key'
+        self.pool = SSHConnectionPool(max_size=2,
+                                      idle_timeout=300,
+                                      connect_func=self._connect)
+
+    def _connect(self, user, host, port, key_filename=None, password=None):
+        client = MockClient(self.host_key)
+        self.clients.append(client)
+        return client
+
+    def test_connection_reused(self):
+        first = self.pool.acquire('user', 'host', 22, password='pass')
+        second = self.pool.acquire('user', 'host', 22, password='pass')
+        self.assertIs(first, second)
+        self.assertEqual(1, len(self.clients))
+
+    def test_unhealthy_connection_replaced(self):
+        first = self.pool.acquire('user', 'host', 22, password='pass')
+        self.pool.release(first)
+        first.transport.is_active.return_value = False
+        second = self.pool.acquire('user', 'host', 22, password='pass')
+        self.assertIsNot(first, second)
+        self.assertTrue(first.closed)
+
+    def test_credentials_change_invalidates(self):
+        first = self.pool.acquire('user', 'host', 22, password='pass')
+        self.pool.release(first)
+        second = self.pool.acquire('user', 'host', 22, password='other')
+        self.assertIsNot(first, second)
+        self.assertTrue(first.closed)
+        self.assertEqual(1, len(self.pool))
+
+    def test_host_key_change_invalidates(self):
+        first = self.pool.acquire('user', 'host', 22, password='pass')
+        self.pool.release(first)
+        first.transport.is_active.return_value = False
+        self.host_key = 'new-host-key'
+        other_user = self.pool.acquire('other', 'host', 22, password='pass')
+        self.assertTrue(first.closed)
+        self.assertFalse(other_user.closed)
+
+    def test_idle_connections_evicted(self):
+        first = self.pool.acquire('user', 'host', 22, password='pass')
+        self.pool.release(first)
+        self.pool.idle_timeout = -1
+        self.pool.evict_idle()
+        self.assertTrue(first.closed)
+        self.assertEqual(0, len(self.pool))
+
+    def test_least_recently_used_evicted(self):
+        first = self.pool.acquire('user', 'host1', 22, password='pass')
+        second = self.pool.acquire('user', 'host2', 22, password='pass')
+        for client in [first, second, self.pool.acquire(
+                'user', 'host1', 22, password='pass')]:
+            self.pool.release(client)
+        self.pool.release(self.pool.acquire('user', 'host3', 22,
+                                            password='pass'))
+        self.assertFalse(first.closed)
+        self.assertTrue(second.closed)
+        self.assertEqual(2, len(self.pool))
+
+    def test_invalidate(self):
+        first = self.pool.acquire('user', 'host', 22, password='pass')
+        self.pool.release(first)
+        self.pool.invalidate('user', 'host', 22)
+        self.assertTrue(first.closed)
+        self.assertEqual(0, len(self.pool))
+
+    def test_in_use_connection_closed_once_released(self):
+        first = self.pool.acquire('user', 'host', 22, password='pass')
+        self.assertIs(first, self.pool.acquire('user', 'host', 22,
+                                               password='pass'))
+        self.pool.invalidate('user', 'host', 22)
+        self.assertEqual(0, len(self.pool))
+        self.pool.release(first)
+        self.assertFalse(first.closed)
+        self.pool.release(first)
+        self.assertTrue(first.closed)
+
+    def test_in_use_connections_not_evicted(self):
+        first = self.pool.acquire('user', 'host1', 22, password='pass')
+        second = self.pool.acquire('user', 'host2', 22, password='pass')
+        third = self.pool.acquire('user', 'host3', 22, password='pass')
+        self.pool.idle_timeout = -1
+        self.pool.evict_idle()
+        # beyond max_size while all of them are in use
+        self.assertEqual(3, len(self.pool))
+        self.pool.release(second)
+        self.assertTrue(second.closed)
+        self.assertFalse(first.closed or third.closed)
+        self.assertEqual(2, len(self.pool))
@@ -0,0 +1,138 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import threading
+import time
+import unittest
+
+from worker_installer.event_loop import CancelledError
+from worker_installer.event_loop import EventLoop
+from worker_installer.event_loop import Future
+from worker_installer.event_loop import Return
+from worker_installer.event_loop import run_bounded
+
+
+class EventLoopTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = EventLoop(executor_size=2)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_coroutine_return_value(self):
+        def double(value):
+            yield self.loop.sleep(0)
+            raise Return(value * 2)
+
+        def flow():
+            first = yield double(1)
+            rest = yield [double(2), double(3)]
+            raise Return([first] + rest)
+        self.assertEqual([2, 4, 6], self.loop.run_until_complete(flow()))
+
+    def test_coroutine_error(self):
+        def fail():
+            yield self.loop.sleep(0)
+            raise ValueError('failed')
+
+        def flow():
+            try:
+                yield fail()
+            except ValueError as e:
+                raise Return(str(e))
+        self.assertEqual('failed', self.loop.run_until_complete(flow()))
+        self.assertRaises(ValueError, self.loop.run_until_complete, fail())
+
+    def test_sleeps_are_concurrent(self):
+        def flow():
+            yield [self.loop.sleep(0.2) for _ in range(50)]
+        start = time.time()
+        self.loop.run_until_complete(flow())
+        self.assertTrue(time.time() - start < 1)
+
+    def test_executor_is_bounded(self):
+        threads = set()
+
+        def work():
+            threads.add(threading.current_thread())
+            time.sleep(0.01)
+            return 1
+
+        def flow():
+            results = yield [self.loop.run_in_executor(work)
+                             for _ in range(20)]
+            raise Return(sum(results))
+        self.assertEqual(20, self.loop.run_until_complete(flow()))
+        self.assertTrue(len(threads) <= 2)
+
+    def test_close_cancels_tasks(self):
+        released = []
+
+        def connect():
+            time.sleep(0.2)
+            return 'connection'
+
+        def flow():
+            connection = yield self.loop.run_in_executor(connect)
+            try:
+                yield Future()
+            finally:
+                released.append(connection)
+        task = self.loop.spawn(flow())
+        self.loop.run_until_complete(self.loop.sleep(0.05))
+        # the connection is still being made, it is released nonetheless
+        self.loop.close()
+        self.assertEqual(['connection'], released)
+        self.assertIsInstance(task.exception(), CancelledError)
+        self.assertTrue(all(not thread.is_alive()
+                            for thread in self.loop._executor_threads))
+
+    def test_run_bounded(self):
+        running = [0]
+        peak = [0]
+
+        def handle(item):
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+            try:
+                yield self.loop.sleep(1 if item == 'slow' else 0.01)
+                if item == 'bad':
+                    raise ValueError(item)
+                raise Return(item)
+            finally:
+                running[0] -= 1
+        items = ['a', 'bad', 'slow', 'b', 'c']
+        results = self.loop.run_until_complete(run_bounded(
+            self.loop, handle, items, concurrency=2, timeout=0.3))
+        self.assertEqual(['ok', 'failed', 'timeout', 'ok', 'ok'],
+                         [result.to_dict()['status'] for result in results])
+        self.assertEqual('c', results[4].result)
+        self.assertEqual(2, peak[0])
+
+    def test_run_bounded_failed_start(self):
+        def wait():
+            yield self.loop.sleep(0.01)
+
+        def handle(item):
+            # raises before a coroutine is even created
+            if item == 'bad':
+                raise ValueError('invalid item')
+            return wait()
+        results = self.loop.run_until_complete(run_bounded(
+            self.loop, handle, ['a', 'bad', 'b'], concurrency=1))
+        self.assertEqual(['ok', 'failed', 'ok'],
+                         [result.to_dict()['status'] for result in results])
+        self.assertIn('invalid item', results[1].traceback)
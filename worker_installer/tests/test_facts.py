@@ -0,0 +1,124 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import getpass
+import os
+import pwd
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from mock import MagicMock
+
+from cloudify.mocks import MockCloudifyContext
+from cloudify.exceptions import NonRecoverableError
+
+from worker_installer.facts import HostFacts
+from worker_installer.facts import local_facts
+from worker_installer.facts import parse_facts
+from worker_installer.facts import probe_command
+from worker_installer.facts import run_probe
+from worker_installer.facts import FACTS_DELIM_START, FACTS_DELIM_END
+from worker_installer.utils import FabricRunner
+from worker_installer.utils import LocalRunner
+
+
+class HostFactsTest(unittest.TestCase):
+
+    def test_parse_facts(self):
+        output = '\n'.join([
+            'motd noise',
+            FACTS_DELIM_START,
+            'tool=wget',
+            'tool=python',
+            'distro=Ubuntu',
+            'distro_codename=trusty',
+            'home_dir=/home/ubuntu',
+            FACTS_DELIM_END])
+        facts = parse_facts(output)
+        self.assertEqual(['wget', 'python'], facts['tools'])
+        self.assertEqual('Ubuntu', facts['distro'])
+        self.assertEqual('/home/ubuntu', facts['home_dir'])
+
+    def test_parse_facts_no_delimiters(self):
+        self.assertRaises(NonRecoverableError, parse_facts, 'bash: error')
+
+    def test_probe_is_lazy_and_runs_once(self):
+        runner = MagicMock()
+        runner.run.return_value = '{0}\ndistro=centos\n{1}'.format(
+            FACTS_DELIM_START, FACTS_DELIM_END)
+        facts = HostFacts(runner, {'user': 'centos', 'name': 'node'})
+        self.assertFalse(runner.run.called)
+        self.assertEqual('centos', facts.distro)
+        self.assertIsNone(facts.distro_codename)
+        self.assertFalse(facts.base_dir_exists)
+        self.assertEqual(1, runner.run.call_count)
+
+    def test_probe_local_host(self):
+        ctx = MockCloudifyContext(deployment_id='deployment_id')
+        user = getpass.getuser()
+        facts = HostFacts(FabricRunner(ctx), {'user': user,
+                                              'name': 'deployment_id'})
+        self.assertEqual(pwd.getpwnam(user).pw_dir, facts.home_dir)
+        self.assertTrue(facts.cpu_count > 0)
+        self.assertTrue(facts.memory_total > 0)
+        self.assertTrue(facts.disk_free > 0)
+        self.assertFalse(facts.init_file_exists)
+
+    def test_local_facts_match_probe(self):
+        ctx = MockCloudifyContext(deployment_id='deployment_id')
+        user = getpass.getuser()
+        runner = LocalRunner(ctx)
+        probed = parse_facts(run_probe(runner, user, 'deployment_id'))
+        facts = local_facts(user, 'deployment_id')
+        for key in ['home_dir', 'tools', 'cpu_count', 'base_dir_exists',
+                    'init_file_exists']:
+            self.assertEqual(probed[key], facts[key])
+        # nothing is spawned for the facts of this machine
+        runner.run = MagicMock()
+        self.assertEqual(facts['home_dir'],
+                         HostFacts(runner, {'user': user,
+                                            'name': 'deployment_id'})
+                         .home_dir)
+        self.assertFalse(runner.run.called)
+
+    def test_shell_probe_distro_names(self):
+        bin_dir = tempfile.mkdtemp()
+        try:
+            # no usable python, and lsb_release naming the distro its way
+            self._script(bin_dir, 'python', 'exit 1')
+            for reported, expected in [('CentOS', 'centos'),
+                                       ('Ubuntu', 'Ubuntu'),
+                                       ('RedHatEnterpriseServer', 'redhat')]:
+                self._script(bin_dir, 'lsb_release',
+                             'case "$1" in -si) echo {0} ;; '
+                             '-sr) echo 7.0 ;; *) echo Core ;; esac'
+                             .format(reported))
+                env = dict(os.environ)
+                env['PATH'] = bin_dir + os.pathsep + env['PATH']
+                facts = parse_facts(subprocess.check_output(
+                    ['sh', '-c', probe_command(getpass.getuser(), 'node')],
+                    env=env))
+                self.assertEqual(expected, facts['distro'])
+                self.assertEqual('7.0', facts['distro_version'])
+        finally:
+            shutil.rmtree(bin_dir)
+
+    def _script(self, directory, name, content):
+        path = os.path.join(directory, name)
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\n{0}\n'.format(content))
+        os.chmod(path, 0755)
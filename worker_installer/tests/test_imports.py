@@ -0,0 +1,39 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import os
+import subprocess
+import sys
+import unittest
+
+ROOT = os.path.join(os.path.dirname(__file__), '..', '..')
+
+# imported on first use only, see benchmarks/import_time.py
+LAZY_MODULES = ['jinja2', 'paramiko']
+
+
+class LazyImportsTest(unittest.TestCase):
+
+    def test_tasks_import(self):
+        # a fresh interpreter, as a celery worker loading the tasks
+        output = subprocess.check_output([
+            sys.executable, '-c',
+            'import sys; import worker_installer.tasks; '
+            'print(" ".join(sorted(set(name.split(".")[0] '
+            'for name in sys.modules))))'], cwd=ROOT)
+        imported = output.split()
+        self.assertIn('worker_installer', imported)
+        for module in LAZY_MODULES:
+            self.assertNotIn(module, imported)
@@ -19,6 +19,8 @@ from mock import patch
 from mock import MagicMock
 
 from worker_installer import init_worker_installer
+from worker_installer import RESOLVED_CONFIG_KEY
+from worker_installer.facts import FACTS_DELIM_START, FACTS_DELIM_END
 from cloudify.mocks import MockCloudifyContext
 from cloudify.exceptions import NonRecoverableError
 
@@ -26,6 +28,12 @@ from cloudify.exceptions import NonRecoverableError
 # for tests purposes. need a path to a file which always exists
 KEY_FILE_PATH = '/bin/sh'
 
+PROBE_OUTPUT = '\n'.join([FACTS_DELIM_START,
+                          'home_dir=/home/user',
+                          'distro=Ubuntu',
+                          'distro_codename=trusty',
+                          FACTS_DELIM_END])
+
 
 @init_worker_installer
 def init_cloudify_agent_configuration(*args, **kwargs):
@@ -37,7 +45,8 @@ def init_cloudify_agent_configuration(*args, **kwargs):
         raise ValueError("'cloudify_agent' not set by init_worker_installer")
 
 
-@patch('worker_installer._run_py_cmd_with_output', MagicMock(return_value=""))
+@patch('worker_installer.facts.run_probe',
+       MagicMock(return_value=PROBE_OUTPUT))
 @patch('worker_installer.utils.FabricRunner', MagicMock())
 class InitTest(unittest.TestCase):
 
@@ -124,6 +133,38 @@ class InitTest(unittest.TestCase):
         self.assertRaisesRegexp(NonRecoverableError, expected_message,
                                 init_cloudify_agent_configuration, ctx)
 
+    def test_resolved_config_reused(self):
+        ctx = MockCloudifyContext(node_id='node_id',
+                                  properties={'ip': 'localhost'},
+                                  runtime_properties={})
+        agent_config = {'user': 'input_user', 'key': KEY_FILE_PATH}
+        with patch('worker_installer.facts.run_probe',
+                   MagicMock(return_value=PROBE_OUTPUT)) as run_probe:
+            init_cloudify_agent_configuration(
+                ctx, cloudify_agent=dict(agent_config))
+            cloudify_agent = init_cloudify_agent_configuration(
+                ctx, cloudify_agent=dict(agent_config))
+        self.assertEqual(1, run_probe.call_count)
+        self.assertEqual('/home/user', cloudify_agent['home_dir'])
+        resolved = ctx.instance.runtime_properties[RESOLVED_CONFIG_KEY]
+        self.assertEqual('/home/user', resolved['facts']['home_dir'])
+        self.assertEqual(['facts', 'fingerprint', 'version'],
+                         sorted(resolved))
+
+    def test_resolved_config_of_other_host_ignored(self):
+        ctx = MockCloudifyContext(node_id='node_id',
+                                  properties={},
+                                  runtime_properties={'ip': '10.0.0.2'})
+        agent_config = {'user': 'input_user', 'key': KEY_FILE_PATH}
+        with patch('worker_installer.facts.run_probe',
+                   MagicMock(return_value=PROBE_OUTPUT)) as run_probe:
+            init_cloudify_agent_configuration(
+                ctx, cloudify_agent=dict(agent_config))
+            ctx.instance.runtime_properties['ip'] = '10.0.0.1'
+            init_cloudify_agent_configuration(
+                ctx, cloudify_agent=dict(agent_config))
+        self.assertEqual(2, run_probe.call_count)
+
     def test_cloudify_agent_no_auth(self):
         ctx = MockCloudifyContext(node_id='node_id',
                                   properties={'ip': 'localhost'})
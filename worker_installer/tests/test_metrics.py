@@ -0,0 +1,135 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+from cloudify.mocks import MockCloudifyContext
+
+from worker_installer import run_with_agent_config
+from worker_installer.metrics import PhaseMetrics
+from worker_installer.metrics import PhaseTimer
+from worker_installer.metrics import phase_metrics
+
+
+class PhaseMetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_render(self):
+        metrics = PhaseMetrics(buckets=(1, 10))
+        metrics.observe('install', 'package', 'Ubuntu', 0.5)
+        metrics.observe('install', 'package', 'Ubuntu', 5)
+        metrics.observe('install', 'package', 'Ubuntu', 50)
+        series = 'operation="install",outcome="success",phase="package",' \
+            'distro="Ubuntu"'
+        lines = metrics.render({'pid': 1}).splitlines()
+        self.assertIn('# TYPE cloudify_agent_phase_duration_seconds '
+                      'histogram', lines)
+        for suffix, value in [('_bucket{{{0},pid="1",le="1"}}', '1'),
+                              ('_bucket{{{0},pid="1",le="10"}}', '2'),
+                              ('_bucket{{{0},pid="1",le="+Inf"}}', '3'),
+                              ('_sum{{{0},pid="1"}}', '55.5'),
+                              ('_count{{{0},pid="1"}}', '3')]:
+            self.assertIn('cloudify_agent_phase_duration_seconds{0} {1}'
+                          .format(suffix.format(series), value), lines)
+
+    def test_write_textfile(self):
+        metrics = PhaseMetrics()
+        metrics.observe('start', 'service', 'centos', 1)
+        path = metrics.write_textfile(os.path.join(self.work_dir, 'prom'))
+        self.assertEqual(
+            'cloudify_agent_installer_{0}.prom'.format(os.getpid()),
+            os.path.basename(path))
+        with open(path) as f:
+            self.assertEqual(metrics.render({'pid': os.getpid()}), f.read())
+        self.assertEqual([os.path.basename(path)],
+                         os.listdir(os.path.dirname(path)))
+        # when the process exits
+        metrics.remove_textfiles()
+        self.assertEqual([], os.listdir(os.path.dirname(path)))
+
+    def test_failed_phase_not_recorded(self):
+        timer = PhaseTimer('install', metrics=PhaseMetrics())
+        with timer.phase('configuration'):
+            pass
+        try:
+            with timer.phase('init'):
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(['configuration'],
+                         [name for name, _ in timer.phases])
+
+    def test_statsd(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        sock.settimeout(5)
+        try:
+            metrics = PhaseMetrics()
+            timer = PhaseTimer(
+                'install', metrics=metrics,
+                statsd_address='127.0.0.1:{0}'.format(
+                    sock.getsockname()[1]))
+            with timer.phase('package'):
+                pass
+            timer.publish('Ubuntu 14.04')
+            lines = sock.recv(65536).splitlines()
+        finally:
+            sock.close()
+        self.assertEqual(
+            ['cloudify_agent.install.success.Ubuntu_14_04.package',
+             'cloudify_agent.install.success.Ubuntu_14_04.operation'],
+            [line.split(':')[0] for line in lines])
+        self.assertTrue(all(line.endswith('|ms') for line in lines))
+        self.assertIn('operation="install",outcome="success",'
+                      'phase="package"', metrics.render())
+
+    def test_operation_phases_published(self):
+        ctx = MockCloudifyContext(deployment_id='deployment_id',
+                                  operation={'name': 'worker_installer.'
+                                                     'tasks.restart'})
+        agent_config = {'name': 'deployment_id',
+                        'user': 'cloudify',
+                        'home_dir': self.work_dir,
+                        'distro': 'metrics-test',
+                        'distro_codename': 'test',
+                        'metrics_dir': self.work_dir}
+        run_with_agent_config(ctx, agent_config,
+                              lambda runner, **_: runner.run('true'),
+                              persist_resolved_config=False)
+        rendered = phase_metrics.render()
+        for name in ['prepare', 'operation']:
+            self.assertIn('operation="restart",outcome="success",'
+                          'phase="{0}",distro="metrics-test"'.format(name),
+                          rendered)
+        self.assertTrue(os.path.exists(os.path.join(
+            self.work_dir,
+            'cloudify_agent_installer_{0}.prom'.format(os.getpid()))))
+
+        def fail(runner, **_):
+            raise RuntimeError('failed')
+        self.assertRaises(RuntimeError, run_with_agent_config, ctx,
+                          agent_config, fail, persist_resolved_config=False)
+        self.assertIn('operation="restart",outcome="failure",'
+                      'phase="operation",distro="metrics-test"',
+                      phase_metrics.render())
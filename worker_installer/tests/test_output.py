@@ -0,0 +1,86 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import logging
+import unittest
+
+from mock import MagicMock
+
+from worker_installer.output import DiscardedOutput
+from worker_installer.output import StreamedOutput
+from worker_installer.output import TailOutput
+from worker_installer.output import logged_output
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class OutputTest(unittest.TestCase):
+
+    def test_discarded(self):
+        output = DiscardedOutput()
+        output.feed('a' * 100)
+        self.assertEqual((100, ''), (output.size, output.getvalue()))
+
+    def test_tail(self):
+        output = TailOutput(max_bytes=10)
+        for i in range(1000):
+            output.feed('line {0}\r\n'.format(i))
+        self.assertTrue(output.getvalue().endswith('line 999'))
+        self.assertTrue(len(output.getvalue()) <= 10)
+        self.assertTrue(output._buffered < 20)
+        self.assertTrue(output.truncated)
+        output = TailOutput(max_bytes=10)
+        output.feed('x' * 100)
+        self.assertEqual('x' * 10, output.getvalue())
+
+    def test_streamed_lines(self):
+        lines = []
+        output = StreamedOutput(lines.append, max_line_bytes=5)
+        output.feed('first\r\nsec')
+        output.feed('ond\nvery long line')
+        output.feed('\nend')
+        output.close()
+        self.assertEqual(['first', 'second', 'very ', 'long ', 'line',
+                          'end'], lines)
+        self.assertEqual('first\nsecond\nvery long line\nend',
+                         output.getvalue())
+
+    def test_streamed_throttling(self):
+        lines = []
+        clock = Clock()
+        output = StreamedOutput(lines.append, interval=1, max_lines=2,
+                                clock=clock)
+        output.feed('1\n2\n3\n4\n')
+        clock.now = 1
+        output.feed('5\n6\n')
+        clock.now = 1.5
+        output.feed('7\n')
+        output.close()
+        self.assertEqual(['1', '2', '... 2 lines skipped', '5', '6',
+                          '... 1 lines skipped'], lines)
+        self.assertEqual(3, output.skipped)
+
+    def test_logged(self):
+        logger = MagicMock()
+        output = logged_output(logger, level=logging.INFO, prefix='tar: ')
+        output.feed('file\n')
+        logger.log.assert_called_once_with(logging.INFO, 'tar: file')
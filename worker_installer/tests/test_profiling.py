@@ -0,0 +1,124 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import os
+import pstats
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+from mock import MagicMock
+
+from cloudify.exceptions import NonRecoverableError
+from cloudify.mocks import MockCloudifyContext
+
+from worker_installer import init_worker_installer
+from worker_installer import profiling
+from worker_installer.facts import FACTS_DELIM_START, FACTS_DELIM_END
+
+PROBE_OUTPUT = '\n'.join([FACTS_DELIM_START,
+                          'home_dir=/home/user',
+                          'distro=Ubuntu',
+                          'distro_codename=trusty',
+                          FACTS_DELIM_END])
+
+
+def busy_operation():
+    return sum(i * i for i in range(1000))
+
+
+@init_worker_installer
+def profiled_operation(*args, **kwargs):
+    return busy_operation()
+
+
+class ProfilingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.profile_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.profile_dir)
+
+    def _path(self, suffix='prof'):
+        return profiling.profile_path(self.profile_dir, 'node_id',
+                                      'install', suffix)
+
+    def test_parse_modes(self):
+        self.assertEqual(set(), profiling.parse_modes(None))
+        self.assertEqual(set(), profiling.parse_modes('false'))
+        self.assertEqual(set(['cpu']), profiling.parse_modes(True))
+        self.assertEqual(set(['cpu', 'memory']),
+                         profiling.parse_modes('cpu, memory'))
+        self.assertRaises(ValueError, profiling.parse_modes, 'disk')
+
+    def test_cpu_profile(self):
+        with profiling.profiled(['cpu'], self.profile_dir, 'node_id',
+                                'install'):
+            busy_operation()
+        stats = pstats.Stats(self._path())
+        self.assertTrue(any(function[2] == 'busy_operation'
+                            for function in stats.stats))
+
+    def test_rotation(self):
+        for _ in range(4):
+            with profiling.profiled(['cpu'], self.profile_dir, 'node_id',
+                                    'install', backups=2):
+                busy_operation()
+        self.assertEqual(
+            sorted(os.path.basename(self._path()) + suffix
+                   for suffix in ['', '.1', '.2']),
+            sorted(os.listdir(self.profile_dir)))
+
+    def test_max_bytes(self):
+        for _ in range(3):
+            with profiling.profiled(['cpu'], self.profile_dir, 'node_id',
+                                    'install', max_bytes=1):
+                busy_operation()
+        # the latest profile is always kept
+        self.assertEqual([os.path.basename(self._path())],
+                         os.listdir(self.profile_dir))
+
+    @patch('worker_installer.profiling.tracemalloc', None)
+    def test_memory_without_tracemalloc(self):
+        with profiling.profiled(['cpu', 'memory'], self.profile_dir,
+                                'node_id', 'install'):
+            busy_operation()
+        self.assertEqual([os.path.basename(self._path())],
+                         os.listdir(self.profile_dir))
+
+    @patch('worker_installer.facts.run_probe',
+           MagicMock(return_value=PROBE_OUTPUT))
+    @patch('worker_installer.utils.FabricRunner', MagicMock())
+    def test_operation_profiled(self):
+        ctx = MockCloudifyContext(node_id='node_id',
+                                  properties={'ip': 'localhost'},
+                                  operation={'name': 'install'})
+        agent_config = {'user': 'user',
+                        'key': '/bin/sh',
+                        'profile': 'cpu',
+                        'profile_dir': self.profile_dir}
+        self.assertEqual(busy_operation(),
+                         profiled_operation(ctx, cloudify_agent=agent_config))
+        self.assertTrue(os.path.exists(self._path()))
+
+    def test_invalid_profile(self):
+        ctx = MockCloudifyContext(node_id='node_id',
+                                  properties={'ip': 'localhost'})
+        agent_config = {'user': 'user', 'key': '/bin/sh',
+                        'profile': 'disk'}
+        self.assertRaises(NonRecoverableError, profiled_operation, ctx,
+                          cloudify_agent=agent_config)
@@ -0,0 +1,279 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import socket
+import threading
+import time
+import unittest
+
+import mock
+from celery import Celery
+from cloudify.exceptions import NonRecoverableError
+from cloudify.mocks import MockCloudifyContext
+
+from worker_installer import readiness
+from worker_installer import tasks
+
+from worker_installer.event_loop import EventLoop
+from worker_installer.event_loop import Future
+from worker_installer.readiness import ReadinessWaiter
+from worker_installer.readiness import wait_for_worker
+from worker_installer.readiness import worker_names
+
+
+def _memory_app():
+    app = Celery(broker='memory://')
+    app.conf.BROKER_TRANSPORT_OPTIONS = {'polling_interval': 0.01}
+    return app
+
+
+class _Worker(threading.Thread):
+    """
+    A stand-in for a celery worker, answering the control commands
+    readiness detection uses.
+    """
+
+    daemon = True
+
+    def __init__(self, app, name, events=True, pings=True, delay=0):
+        threading.Thread.__init__(self)
+        self.app = app
+        self.name = name
+        self.events = events
+        self.pings = pings
+        self.delay = delay
+        self.stopped = False
+
+    def run(self):
+        time.sleep(self.delay)
+        with self.app.connection() as connection:
+            dispatcher = self.app.events.Dispatcher(
+                connection, hostname=self.name, enabled=self.events)
+            handlers = {'heartbeat': lambda state, **kwargs:
+                        dispatcher.send('worker-heartbeat')}
+            if self.pings:
+                handlers['ping'] = lambda state, **kwargs: {'ok': 'pong'}
+            self.app.control.mailbox.Node(
+                self.name, channel=connection.default_channel,
+                handlers=handlers).listen()
+            dispatcher.send('worker-online')
+            while not self.stopped:
+                try:
+                    connection.drain_events(timeout=0.05)
+                except socket.timeout:
+                    pass
+
+    def stop(self):
+        self.stopped = True
+        self.join()
+
+
+class ReadinessTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = _memory_app()
+        self.worker = None
+
+    def tearDown(self):
+        if self.worker is not None:
+            self.worker.stop()
+        for thread in threading.enumerate():
+            if thread.name == 'readiness-waiter':
+                thread.join()
+
+    def _start_worker(self, name, **kwargs):
+        self.worker = _Worker(self.app, name, **kwargs)
+        self.worker.start()
+
+    def _wait(self, name, timeout=5):
+        start = time.time()
+        online = wait_for_worker(self.app, name, timeout,
+                                 max_poll_interval=1)
+        return online, time.time() - start
+
+    def test_worker_names(self):
+        self.assertEqual(set(['agent', 'celery@agent']),
+                         worker_names('agent'))
+        self.assertEqual(set(['agent', 'celery@agent']),
+                         worker_names('celery@agent'))
+
+    def test_worker_online_event(self):
+        self._start_worker('celery@online', pings=False, delay=0.3)
+        online, elapsed = self._wait('celery@online')
+        self.assertTrue(online)
+        self.assertLess(elapsed, 1.5)
+
+    def test_worker_already_online(self):
+        self._start_worker('celery@running', pings=False)
+        time.sleep(0.3)
+        online, elapsed = self._wait('celery@running')
+        self.assertTrue(online)
+        self.assertLess(elapsed, 1)
+
+    def test_worker_without_events(self):
+        self._start_worker('celery@quiet', events=False, delay=0.3)
+        online, elapsed = self._wait('celery@quiet')
+        self.assertTrue(online)
+        self.assertLess(elapsed, 3)
+
+    def test_other_worker_ignored(self):
+        self._start_worker('celery@other')
+        online, elapsed = self._wait('celery@missing', timeout=1)
+        self.assertFalse(online)
+        self.assertLess(elapsed, 2)
+
+    def test_polling_when_events_unavailable(self):
+        self._start_worker('celery@polled', delay=0.3)
+        with mock.patch.object(readiness, '_WorkerEventsReceiver',
+                               side_effect=IOError('no events')):
+            online, elapsed = self._wait('celery@polled')
+        self.assertTrue(online)
+        self.assertLess(elapsed, 3)
+
+    def test_single_broadcast_per_tick(self):
+        pings = []
+
+        class CountingWaiter(ReadinessWaiter):
+            def _ping(self, watches, now):
+                pings.append(len(watches))
+                ReadinessWaiter._ping(self, watches, now)
+
+        waiter = CountingWaiter(self.app)
+        workers = [_Worker(self.app, 'celery@fleet{0}'.format(i),
+                           events=False, delay=0.3)
+                   for i in range(20)]
+        for worker in workers:
+            worker.start()
+        try:
+            results = []
+            threads = [threading.Thread(
+                target=lambda name=w.name: results.append(
+                    waiter.wait(name, 5, max_poll_interval=0.5)))
+                for w in workers]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            for worker in workers:
+                worker.stop()
+        self.assertEqual([True] * 20, results)
+        self.assertLess(len(pings), len(workers))
+        self.assertEqual(20, max(pings))
+
+    def test_watch_resolves_loop_future(self):
+        self._start_worker('celery@looped', delay=0.3)
+        loop = EventLoop()
+        try:
+            started = Future()
+            ReadinessWaiter(self.app).watch(
+                'celery@looped', 5,
+                lambda online: loop.call_soon_threadsafe(
+                    started.set_result, online))
+            self.assertTrue(loop.run_until_complete(started))
+        finally:
+            loop.close()
+
+
+class StartWithRetryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = _memory_app()
+        self.worker = None
+        self.runner = mock.MagicMock()
+        self.runner.exists.return_value = False
+        self.runtime_properties = {}
+        self.agent_config = {'name': 'retried',
+                             'user': 'user',
+                             'base_dir': '/tmp/retried',
+                             'wait_started_timeout': 15,
+                             'wait_started_interval': 1}
+        patcher = mock.patch.object(tasks, 'celery_client', self.app)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        if self.worker is not None:
+            self.worker.stop()
+
+    def _start(self, retry_number, max_retries=None):
+        ctx = MockCloudifyContext(
+            node_id='node_id',
+            runtime_properties=self.runtime_properties,
+            operation={'name': 'start', 'retry_number': retry_number,
+                       'max_retries': max_retries})
+        tasks.start_agent_with_retry(ctx, self.runner, self.agent_config,
+                                     None)
+        self.runtime_properties = ctx.instance.runtime_properties
+        return ctx.operation._operation_retry
+
+    def test_retried_until_started(self):
+        self.assertIsNotNone(self._start(retry_number=0))
+        self.assertIn(tasks.START_DEADLINE_KEY, self.runtime_properties)
+        self.runner.run.assert_called_once_with(
+            'sudo service celeryd-retried start')
+        self.runner.reset_mock()
+
+        self.worker = _Worker(self.app, 'celery@retried', events=False)
+        self.worker.start()
+        time.sleep(0.3)
+        self.assertIsNone(self._start(retry_number=1))
+        self.assertNotIn(tasks.START_DEADLINE_KEY, self.runtime_properties)
+        self.assertFalse(self.runner.run.called)
+
+    def test_deadline_passed(self):
+        self.runtime_properties[tasks.START_DEADLINE_KEY] = time.time() - 1
+        self.runner.tail.return_value = 'ImportError: No module named x'
+        try:
+            self._start(retry_number=3)
+            self.fail('expected the start to fail')
+        except NonRecoverableError as e:
+            # the end of the log on the agent's host comes with the error
+            self.assertIn('ImportError: No module named x', str(e))
+        self.runner.tail.assert_called_once_with(
+            '/tmp/retried/work/celery.log',
+            max_bytes=tasks.CELERY_LOG_TAIL_BYTES,
+            max_lines=tasks.CELERY_LOG_TAIL_LINES)
+        self.assertNotIn(tasks.START_DEADLINE_KEY, self.runtime_properties)
+        self.assertFalse(self.runner.run.called)
+
+    def test_retries_spread_until_deadline(self):
+        retry = self._start(retry_number=0, max_retries=5)
+        # 5 retries left for the 15 seconds of wait_started_timeout
+        self.assertEqual(3, retry.retry_after)
+        retry = self._start(retry_number=1, max_retries=60)
+        self.assertEqual(1, retry.retry_after)
+
+    def test_out_of_retries(self):
+        self.runtime_properties[tasks.START_DEADLINE_KEY] = time.time() + 60
+        self.runner.tail.return_value = ''
+        try:
+            self._start(retry_number=5, max_retries=5)
+            self.fail('expected the start to fail')
+        except NonRecoverableError as e:
+            self.assertIn('ran out of retries', str(e))
+            self.assertIn('max_retries', str(e))
+        self.assertNotIn(tasks.START_DEADLINE_KEY, self.runtime_properties)
+
+    def test_deployment_agent_waited_for(self):
+        ctx = MockCloudifyContext(
+            deployment_id='deployment_id',
+            operation={'name': 'start', 'retry_number': 0})
+        with mock.patch.object(tasks, '_wait_for_started') as wait:
+            self.assertIsNone(tasks.start_agent_with_retry(
+                ctx, self.runner, self.agent_config, None))
+        wait.assert_called_once_with(self.runner, self.agent_config)
+        self.runner.run.assert_called_once_with(
+            'sudo service celeryd-retried start')
@@ -0,0 +1,207 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import urllib2
+import BaseHTTPServer
+import SocketServer
+
+from worker_installer.relay import PackageRelay
+from worker_installer.relay import RelayServer
+from worker_installer.relay import relay_url
+
+
+class _Upstream(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           _UpstreamHandler)
+        self.files = {}
+        self.requests = []
+        self.delay = 0
+
+
+class _UpstreamHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.server.requests.append(
+            (self.path, self.headers.getheader('If-None-Match')))
+        time.sleep(self.server.delay)
+        content = self.server.files.get(self.path)
+        if content is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        etag = '"{0}"'.format(hash(content))
+        if self.headers.getheader('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+def _serve(server):
+    thread = threading.Thread(target=server.serve_forever,
+                              kwargs={'poll_interval': 0.05})
+    thread.daemon = True
+    thread.start()
+    return 'http://127.0.0.1:{0}'.format(server.server_address[1])
+
+
+class RelayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.upstream = _Upstream()
+        self.upstream.files['/packages/agent.tar.gz'] = 'agent' * 1000
+        self.upstream_url = _serve(self.upstream)
+        self.server = None
+
+    def tearDown(self):
+        self.upstream.shutdown()
+        if self.server is not None:
+            self.server.shutdown()
+        shutil.rmtree(self.cache_dir)
+
+    def _start(self, max_transfers=10, admission_timeout=1, **kwargs):
+        self.relay = PackageRelay(self.upstream_url, self.cache_dir,
+                                  **kwargs)
+        self.server = RelayServer(('127.0.0.1', 0), self.relay,
+                                  max_transfers=max_transfers,
+                                  admission_timeout=admission_timeout)
+        self.url = _serve(self.server)
+
+    def _get(self, path='/packages/agent.tar.gz', etag=None):
+        request = urllib2.Request(self.url + path)
+        if etag:
+            request.add_header('If-None-Match', etag)
+        try:
+            response = urllib2.urlopen(request, timeout=10)
+        except urllib2.HTTPError as e:
+            return e.code, None, e.headers.getheader('ETag')
+        return response.getcode(), response.read(), \
+            response.info().getheader('ETag')
+
+    def test_cached(self):
+        self._start()
+        first = self._get()
+        second = self._get()
+        self.assertEqual(200, first[0])
+        self.assertEqual('agent' * 1000, first[1])
+        self.assertEqual(first, second)
+        self.assertEqual(1, len(self.upstream.requests))
+
+    def test_revalidated(self):
+        self._start(revalidate_after=0)
+        etag = self._get()[2]
+        self._get()
+        self.assertEqual(etag, self.upstream.requests[1][1])
+        self.upstream.files['/packages/agent.tar.gz'] = 'new'
+        self.assertEqual('new', self._get()[1])
+
+    def test_replaced_while_read(self):
+        self._start(revalidate_after=0)
+        old = self.relay.acquire('/packages/agent.tar.gz')
+        self.upstream.files['/packages/agent.tar.gz'] = 'new'
+        self.assertEqual('new', self._get()[1])
+        # the previous version is kept until its last reader is done
+        with open(old.file_path) as f:
+            self.assertEqual('agent' * 1000, f.read())
+        self.relay.release(old)
+        self.assertFalse(os.path.exists(old.file_path))
+        self.assertEqual(2, len(os.listdir(self.cache_dir)))
+
+    def test_same_content_refetched(self):
+        self._start(revalidate_after=0)
+        old = self.relay.acquire('/packages/agent.tar.gz')
+        # fetched again, but with the same content
+        old.etag = '"stale"'
+        self.assertEqual('agent' * 1000, self._get()[1])
+        self.relay.release(old)
+        self.assertTrue(os.path.exists(old.file_path))
+        self.assertEqual('agent' * 1000, self._get()[1])
+
+    def test_client_conditional_request(self):
+        self._start()
+        etag = self._get()[2]
+        self.assertEqual(304, self._get(etag=etag)[0])
+
+    def test_single_upstream_fetch(self):
+        self.upstream.delay = 0.3
+        self._start()
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+            self._get()[1])) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(['agent' * 1000] * 10, results)
+        self.assertEqual(1, len(self.upstream.requests))
+
+    def test_missing(self):
+        self._start()
+        self.assertEqual(404, self._get('/packages/missing.tar.gz')[0])
+
+    def test_eviction(self):
+        self.upstream.files['/packages/other.tar.gz'] = 'other' * 1000
+        self._start(max_size=6000)
+        self._get()
+        self._get('/packages/other.tar.gz')
+        self.assertEqual(5000, self.relay.size)
+        self.assertEqual(2, len(os.listdir(self.cache_dir)))
+        self._get()
+        self.assertEqual(3, len(self.upstream.requests))
+
+    def test_admission_limit(self):
+        self._start(max_transfers=1, admission_timeout=0.1)
+        self.server.admission.acquire()
+        self.assertEqual(503, self._get()[0])
+        self.server.admission.release()
+        self.assertEqual(200, self._get()[0])
+
+    def test_cache_survives_restart(self):
+        self._start()
+        self._get()
+        relay = PackageRelay(self.upstream_url, self.cache_dir)
+        self.assertEqual('agent' * 1000, open(relay.get(
+            '/packages/agent.tar.gz').file_path).read())
+        self.assertEqual(1, len(self.upstream.requests))
+
+    def test_relay_url(self):
+        file_server = 'http://10.0.0.1:53229'
+        self.assertEqual(
+            'http://relay:53230/packages/agent.tar.gz',
+            relay_url(file_server + '/packages/agent.tar.gz', file_server,
+                      'http://relay:53230/'))
+        self.assertEqual('http://other/agent.tar.gz',
+                         relay_url('http://other/agent.tar.gz', file_server,
+                                   'http://relay:53230'))
+        self.assertEqual(file_server + '/a', relay_url(
+            file_server + '/a', file_server, None))
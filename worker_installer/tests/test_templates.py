@@ -0,0 +1,131 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from cloudify.exceptions import NonRecoverableError
+
+from worker_installer.templates import FileServerLoader
+from worker_installer.templates import TemplateCache
+from worker_installer.tests.test_relay import _Upstream
+from worker_installer.tests.test_relay import _serve
+
+
+class Loader(object):
+
+    def __init__(self, templates, delay=0):
+        self.templates = templates
+        self.delay = delay
+        self.calls = []
+
+    def __call__(self, path):
+        self.calls.append(path)
+        time.sleep(self.delay)
+        return self.templates.get(path)
+
+
+class TemplateCacheTest(unittest.TestCase):
+
+    def test_compiled_once(self):
+        cache = TemplateCache()
+        loader = Loader({'conf': 'name={{ name }}'})
+        for name in ['first', 'second']:
+            self.assertEqual('name={0}'.format(name), cache.get_template(
+                'conf', loader).render(name=name))
+        self.assertEqual(['conf'], loader.calls)
+        self.assertEqual(1, cache.compilations)
+        self.assertRaises(NonRecoverableError, cache.get_template,
+                          'missing', loader)
+
+    def test_revalidation(self):
+        cache = TemplateCache(revalidate_after=0)
+        loader = Loader({'conf': 'a={{ a }}'})
+        cache.get_template('conf', loader)
+        cache.get_template('conf', loader)
+        # loaded again, but not compiled again while unchanged
+        self.assertEqual((2, 1), (len(loader.calls), cache.compilations))
+        loader.templates['conf'] = 'b={{ a }}'
+        self.assertEqual('b=1', cache.get_template('conf', loader).render(
+            a=1))
+        self.assertEqual(2, cache.compilations)
+
+    def test_lru_eviction(self):
+        cache = TemplateCache(max_size=2)
+        loader = Loader({'a': 'a', 'b': 'b', 'c': 'c'})
+        for path in ['a', 'b', 'a', 'c', 'a', 'b']:
+            cache.get_template(path, loader)
+        self.assertEqual(['a', 'b', 'c', 'b'], loader.calls)
+
+    def test_concurrent_loads(self):
+        cache = TemplateCache()
+        loader = Loader({'conf': 'x'}, delay=0.2)
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(
+                cache.get_template('conf', loader).render()))
+            for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(['x'] * 5, results)
+        self.assertEqual(['conf'], loader.calls)
+
+    def test_bytecode_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            loader = Loader({'conf': u'caf\xe9 {{ a }}'.encode('utf-8')})
+            first = TemplateCache(bytecode_cache_dir=cache_dir)
+            first.get_template('conf', loader)
+            # a new process finds the template compiled on disk
+            second = TemplateCache(bytecode_cache_dir=cache_dir)
+            self.assertEqual(u'caf\xe9 1', second.get_template(
+                'conf', loader).render(a=1))
+            self.assertEqual((1, 0), (first.compilations,
+                                      second.compilations))
+        finally:
+            shutil.rmtree(cache_dir)
+
+
+class FileServerLoaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.upstream = _Upstream()
+        self.loader = FileServerLoader(base_url=_serve(self.upstream))
+        self.upstream.files['/conf'] = 'a={{ a }}'
+
+    def tearDown(self):
+        self.upstream.shutdown()
+        self.upstream.server_close()
+
+    def test_conditional_revalidation(self):
+        cache = TemplateCache(revalidate_after=0)
+        for _ in range(3):
+            self.assertEqual('a=1', cache.get_template(
+                '/conf', self.loader).render(a=1))
+        self.upstream.files['/conf'] = 'b={{ a }}'
+        self.assertEqual('b=1', cache.get_template('/conf', self.loader)
+                         .render(a=1))
+        # the etag of the first load is used by every revalidation
+        etag = '"{0}"'.format(hash('a={{ a }}'))
+        self.assertEqual([None, etag, etag, etag],
+                         [header for _, header in self.upstream.requests])
+        self.assertEqual(2, cache.compilations)
+        self.assertRaises(NonRecoverableError, cache.get_template,
+                          '/missing', self.loader)
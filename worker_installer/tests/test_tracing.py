@@ -0,0 +1,177 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from cloudify.mocks import MockCloudifyContext
+
+from worker_installer import run_with_agent_config
+from worker_installer.async_runner import AsyncRunner
+from worker_installer.connection_pool import connection_pool
+from worker_installer.event_loop import EventLoop
+from worker_installer.event_loop import Return
+from worker_installer.tracing import CommandTrace
+from worker_installer.tracing import trace_path
+from worker_installer.utils import FabricRunner
+from worker_installer.utils import FabricRunnerException
+from worker_installer.tests.ssh_server import LocalSSHServer
+
+
+class CommandTraceTest(unittest.TestCase):
+
+    def test_records_bounded(self):
+        trace = CommandTrace(max_records=2)
+        for command in ['first', 'second', 'third']:
+            with trace.step('run', command):
+                pass
+        self.assertEqual(['second', 'third'],
+                         [r['command'] for r in trace.records])
+        self.assertTrue(trace.summary().startswith('3 steps'))
+
+    def test_nested_steps(self):
+        trace = CommandTrace()
+        with trace.step('put', '/tmp/file'):
+            with trace.step('run', 'mkdir -p /tmp'):
+                trace.connection(True)
+            trace.connection(False)
+        run, put = trace.records
+        self.assertEqual((1, True), (run['depth'], run['reused_connection']))
+        self.assertEqual((0, False),
+                         (put['depth'], put['reused_connection']))
+        self.assertEqual([put], trace.slowest())
+
+    def test_failed_step(self):
+        trace = CommandTrace()
+        try:
+            with trace.step('run', 'exit 3'):
+                raise FabricRunnerException('exit 3', 3, 'failed')
+        except FabricRunnerException:
+            pass
+        self.assertEqual(3, trace.records[0]['exit_code'])
+
+    def test_slowest(self):
+        trace = CommandTrace()
+        for duration in [2, 5, 1]:
+            record = trace.begin('run', 'sleep {0}'.format(duration))
+            record['started_at'] -= duration
+            trace.end(record)
+        self.assertEqual(['sleep 5', 'sleep 2'],
+                         [r['command'] for r in trace.slowest(2)])
+        self.assertIn('sleep 5', trace.summary(1))
+        self.assertNotIn('sleep 2', trace.summary(1))
+
+    def test_dump(self):
+        work_dir = tempfile.mkdtemp()
+        try:
+            trace = CommandTrace()
+            with trace.step('run', 'uname'):
+                pass
+            path = trace_path(os.path.join(work_dir, 'traces'), 'agent',
+                              'install')
+            trace.dump(path, operation='install')
+            trace.dump(path, operation='install')
+            with open(path) as f:
+                lines = [json.loads(line) for line in f]
+            self.assertEqual(2, len(lines))
+            self.assertEqual('uname', lines[0]['command'])
+            self.assertEqual('install', lines[0]['operation'])
+        finally:
+            shutil.rmtree(work_dir)
+
+
+class TracedRunnerTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = LocalSSHServer().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        self.ctx = MockCloudifyContext(node_id='node_id')
+        self.work_dir = tempfile.mkdtemp()
+        connection_pool.invalidate_host(self.server.host, self.server.port)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_remote_steps(self):
+        runner = FabricRunner(self.ctx, self.server.agent_config)
+        runner.trace = CommandTrace()
+        file_path = os.path.join(self.work_dir, 'sub', 'file')
+        runner.run('echo hello')
+        runner.put(file_path, 'content')
+        self.assertEqual('content', runner.get(file_path))
+        self.assertFalse(runner.exists(file_path + '.missing'))
+        steps = [r for r in runner.trace.records if r['depth'] == 0]
+        self.assertEqual(['run', 'put', 'get', 'exists'],
+                         [r['kind'] for r in steps])
+        run, put, get, exists = steps
+        # the bytes read, before the output is stripped
+        self.assertEqual((False, len('hello\n')),
+                         (run['reused_connection'], run['bytes_in']))
+        self.assertEqual((True, 7), (put['reused_connection'],
+                                     put['bytes_out']))
+        self.assertEqual(7, get['bytes_in'])
+        self.assertEqual(1, exists['exit_code'])
+        # a put is a single command, with no steps of its own
+        self.assertEqual(4, len(runner.trace.records))
+
+    def test_async_remote_steps(self):
+        loop = EventLoop()
+        try:
+            runner = AsyncRunner(self.ctx, self.server.agent_config, loop)
+            runner.trace = CommandTrace()
+            file_path = os.path.join(self.work_dir, 'file')
+
+            def flow():
+                yield runner.run('echo hello')
+                yield runner.put(file_path, 'content')
+                content = yield runner.get(file_path)
+                raise Return(content)
+            self.assertEqual('content', loop.run_until_complete(flow()))
+        finally:
+            loop.close()
+        run, put, get = runner.trace.records
+        self.assertEqual(('run', False, 6),
+                         (run['kind'], run['reused_connection'],
+                          run['bytes_in']))
+        self.assertEqual(('put', True, 7),
+                         (put['kind'], put['reused_connection'],
+                          put['bytes_out']))
+        self.assertEqual(('get', 7), (get['kind'], get['bytes_in']))
+
+    def test_operation_trace_dumped(self):
+        agent_config = dict(self.server.agent_config,
+                            name='agent',
+                            home_dir=self.work_dir,
+                            distro='Ubuntu',
+                            distro_codename='trusty',
+                            trace_commands='true',
+                            trace_dir=self.work_dir)
+        result = run_with_agent_config(
+            self.ctx, agent_config,
+            lambda runner, **_: runner.run('echo traced'),
+            persist_resolved_config=False)
+        self.assertEqual('traced', result)
+        with open(trace_path(self.work_dir, 'agent', None)) as f:
+            commands = [json.loads(line)['command'] for line in f]
+        self.assertIn('echo traced', commands)
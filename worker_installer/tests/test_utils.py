@@ -0,0 +1,386 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from StringIO import StringIO
+
+from cloudify.mocks import MockCloudifyContext
+from cloudify.exceptions import NonRecoverableError
+
+from worker_installer.connection_pool import connection_pool
+from worker_installer.output import DiscardedOutput
+from worker_installer.output import StreamedOutput
+from worker_installer.output import TailOutput
+from worker_installer.utils import FabricRunner
+from worker_installer.utils import LocalRunner
+from worker_installer.utils import FabricRunnerException
+from worker_installer.utils import MAX_PUT_COMMAND_SIZE
+from worker_installer.tests.ssh_server import LocalSSHServer
+
+
+class CommandBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        ctx = MockCloudifyContext(deployment_id='deployment_id')
+        self.runner = FabricRunner(ctx)
+
+    def test_batch_output(self):
+        with self.runner.batch() as batch:
+            batch.run('echo first')
+            batch.run('echo second; echo error >&2')
+        self.assertEqual(['first', 'second\nerror'],
+                         [step.output for step in batch.results])
+        self.assertEqual([0, 0], [step.code for step in batch.results])
+
+    def test_batch_failing_step(self):
+        def run_batch():
+            with self.runner.batch() as batch:
+                batch.run('echo first')
+                batch.run('echo failed; exit 3')
+                batch.run('echo never')
+            return batch
+        try:
+            run_batch()
+            self.fail('expected batch to fail')
+        except FabricRunnerException as e:
+            self.assertEqual('echo failed; exit 3', e.command)
+            self.assertEqual(3, e.code)
+            self.assertIn('step 2 of 3 failed: failed', e.message)
+
+    def test_batch_ignore_errors(self):
+        with self.runner.batch() as batch:
+            batch.run('exit 1', ignore_errors=True)
+            batch.run('echo after')
+        self.assertTrue(batch.results[0].failed)
+        self.assertEqual('after', batch.results[1].output)
+
+    def test_batch_step_output_without_new_line(self):
+        with self.runner.batch() as batch:
+            batch.run('printf first')
+            batch.run('printf "second\\n\\nthird"; exit 4',
+                      ignore_errors=True)
+        self.assertEqual(['first', 'second\n\nthird'],
+                         [step.output for step in batch.results])
+        self.assertEqual([0, 4], [step.code for step in batch.results])
+
+    def test_run_output_policies(self):
+        command = 'for i in $(seq 1000); do echo line $i; done'
+        tail = TailOutput(max_bytes=20)
+        self.assertEqual('line 1000', self.runner.run(
+            command, output=tail).splitlines()[-1])
+        self.assertEqual(len(self.runner.run(command)) + 1, tail.size)
+        lines = []
+        self.runner.run(command, output=StreamedOutput(
+            lines.append, max_lines=1000))
+        self.assertEqual('line 1000', lines[-1])
+        self.assertEqual(1000, len(lines))
+        try:
+            self.runner.run('echo output; echo error >&2; exit 1',
+                            output=DiscardedOutput())
+            self.fail('expected command to fail')
+        except FabricRunnerException as e:
+            self.assertEqual('error', e.message)
+
+    def test_batch_discarded_on_error(self):
+        def run_batch():
+            with self.runner.batch() as batch:
+                batch.run('touch /should/never/run')
+                raise ValueError()
+        self.assertRaises(ValueError, run_batch)
+
+
+class LocalRunnerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.runner = LocalRunner(
+            MockCloudifyContext(deployment_id='deployment_id'))
+        self.work_dir = tempfile.mkdtemp()
+        # a sudo that runs its command as is, and logs it
+        bin_dir = os.path.join(self.work_dir, 'bin')
+        os.mkdir(bin_dir)
+        self.sudo_log = os.path.join(self.work_dir, 'sudo.log')
+        sudo = os.path.join(bin_dir, 'sudo')
+        with open(sudo, 'w') as f:
+            f.write('#!/bin/sh\necho "$@" >> {0}\nexec "$@"\n'.format(
+                self.sudo_log))
+        os.chmod(sudo, 0755)
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = '{0}:{1}'.format(bin_dir, self.path)
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        shutil.rmtree(self.work_dir)
+
+    def _sudo_commands(self):
+        if not os.path.exists(self.sudo_log):
+            return []
+        with open(self.sudo_log) as f:
+            return f.read().splitlines()
+
+    def test_put_get_exists(self):
+        file_path = os.path.join(self.work_dir, 'sub', 'file')
+        self.assertFalse(self.runner.exists(file_path))
+        self.runner.put(file_path, 'content\n')
+        self.assertTrue(self.runner.exists(file_path))
+        self.assertEqual('content\n', self.runner.get(file_path))
+        self.assertRaises(NonRecoverableError, self.runner.put, file_path,
+                          'other')
+        self.assertEqual([], self._sudo_commands())
+
+    def test_put_with_sudo(self):
+        file_path = os.path.join(self.work_dir, 'sub', 'file')
+        self.runner.put(file_path, 'content with "quotes" and $vars')
+        other_path = os.path.join(self.work_dir, 'sub', 'other')
+        self.runner.put(other_path, 'other', use_sudo=True)
+        with open(other_path) as f:
+            self.assertEqual('other', f.read())
+        # the directory exists, a single privileged process writes the file
+        self.assertEqual(['install -m 644 /dev/stdin {0}'.format(other_path)],
+                         self._sudo_commands())
+
+    def test_get_unreadable_file(self):
+        file_path = os.path.join(self.work_dir, 'file')
+        self.runner.put(file_path, 'content')
+        os.chmod(file_path, 0)
+        if os.access(file_path, os.R_OK):
+            # running as root, everything is readable
+            return
+        self.assertEqual('content', self.runner.get(file_path))
+        self.assertEqual(['cat {0}'.format(file_path)],
+                         self._sudo_commands())
+
+    def test_put_get_file(self):
+        source = os.path.join(self.work_dir, 'source')
+        with open(source, 'w') as f:
+            f.write('0123456789' * 10000)
+        file_path = os.path.join(self.work_dir, 'sub', 'file')
+        self.assertEqual(100000, self.runner.put_file(file_path, source,
+                                                      mode=0600))
+        self.assertEqual(0600, os.stat(file_path).st_mode & 0777)
+        self.assertRaises(NonRecoverableError, self.runner.put_file,
+                          file_path, StringIO('other'))
+        sudo_path = os.path.join(self.work_dir, 'sudo')
+        self.runner.put_file(sudo_path, StringIO('streamed'), use_sudo=True)
+        self.assertEqual('streamed', self.runner.get(sudo_path))
+        target = StringIO()
+        self.assertEqual(15, self.runner.get_file(file_path, target,
+                                                  max_bytes=15, tail=True))
+        self.assertEqual('567890123456789', target.getvalue())
+        self.assertEqual('0123456789', ''.join(self.runner.iter_file(
+            file_path, max_bytes=10)))
+
+    def test_tail(self):
+        file_path = os.path.join(self.work_dir, 'log')
+        with open(file_path, 'w') as f:
+            f.write(''.join('line {0}\n'.format(i) for i in range(1000)))
+        self.assertEqual('line 998\nline 999',
+                         self.runner.tail(file_path, max_lines=2))
+        self.assertEqual('999', self.runner.tail(file_path, max_bytes=4))
+        self.assertEqual('', self.runner.tail(file_path + '.missing'))
+
+    def test_execute(self):
+        self.assertEqual('a b; c\n',
+                         self.runner.execute(['echo', 'a b; c']))
+        try:
+            self.runner.execute(['sh', '-c', 'echo failed >&2; exit 3'])
+            self.fail('expected command to fail')
+        except FabricRunnerException as e:
+            self.assertEqual(3, e.code)
+            self.assertEqual('failed', e.message)
+
+    def test_no_remote_methods(self):
+        # nothing runs on channels or over sftp locally
+        for name in ['start_command', '_exec', '_open_sftp']:
+            self.assertFalse(hasattr(self.runner, name))
+
+
+class RemoteRunnerTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = LocalSSHServer().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        self.ctx = MockCloudifyContext(node_id='node_id')
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def _runner(self):
+        return FabricRunner(self.ctx, self.server.agent_config)
+
+    def test_run(self):
+        runner = self._runner()
+        self.assertEqual('quoted  spaces $HOME',
+                         runner.run('echo "quoted  spaces" \'$HOME\''))
+        self.assertEqual('/', runner.run('cd / && echo $PWD'))
+
+    def test_connection_released(self):
+        runner = self._runner()
+        file_path = os.path.join(self.work_dir, 'file')
+        runner.run('true')
+        runner.upload(file_path, 'content')
+        self.assertEqual('content', runner.download(file_path))
+        config = self.server.agent_config
+        client = connection_pool.acquire(
+            config['user'], config['host'], config['port'],
+            key_filename=config.get('key'), password=config.get('password'))
+        connection_pool.release(client)
+        # nothing uses the connection anymore, so it is closed right away
+        connection_pool.invalidate_host(config['host'], config['port'])
+        self.assertIsNone(client.get_transport())
+
+    def test_run_failure(self):
+        try:
+            self._runner().run('echo failure; exit 2')
+            self.fail('expected command to fail')
+        except FabricRunnerException as e:
+            self.assertEqual(2, e.code)
+            self.assertEqual('failure', e.message)
+
+    def test_put_get_exists(self):
+        runner = self._runner()
+        file_path = os.path.join(self.work_dir, 'sub', 'file')
+        self.assertFalse(runner.exists(file_path))
+        runner.put(file_path, 'content')
+        self.assertTrue(runner.exists(file_path))
+        self.assertEqual('content', runner.get(file_path))
+        self.assertRaises(NonRecoverableError, runner.put, file_path, 'x')
+
+    def test_put_content_and_mode(self):
+        runner = self._runner()
+        file_path = os.path.join(self.work_dir, 'script')
+        content = u'#!/bin/sh\necho "$HOME" \'`%s\' \\n \u00e9\n'
+        runner.put(file_path, content, mode=0755)
+        with open(file_path) as f:
+            self.assertEqual(content.encode('utf-8'), f.read())
+        self.assertEqual(0755, os.stat(file_path).st_mode & 0777)
+        self.assertEqual([], [name for name in os.listdir(self.work_dir)
+                              if name.startswith('.cloudify-')])
+
+    def test_put_many(self):
+        runner = self._runner()
+        paths = [os.path.join(self.work_dir, name) for name in 'abc']
+        commands = len(self.server.commands)
+        runner.put_many([(path, path) for path in paths])
+        self.assertEqual(1, len(self.server.commands) - commands)
+        for path in paths:
+            self.assertEqual(path, runner.get(path))
+        # nothing is written when any of the files exists
+        new_path = os.path.join(self.work_dir, 'd')
+        self.assertRaises(NonRecoverableError, runner.put_many,
+                          [(new_path, 'd'), (paths[0], 'a')])
+        self.assertFalse(os.path.exists(new_path))
+
+    def test_put_large_file(self):
+        runner = self._runner()
+        file_path = os.path.join(self.work_dir, 'large')
+        content = '\x00\xff' * MAX_PUT_COMMAND_SIZE
+        runner.put(file_path, content)
+        with open(file_path) as f:
+            self.assertEqual(content, f.read())
+        self.assertEqual(0644, os.stat(file_path).st_mode & 0777)
+        self.assertEqual(['large'], os.listdir(self.work_dir))
+
+    def test_run_output_policies(self):
+        runner = self._runner()
+        command = 'for i in $(seq 100); do echo line $i; done; exit 3'
+        lines = []
+        try:
+            runner.run(command, output=StreamedOutput(lines.append,
+                                                      tail_bytes=16))
+            self.fail('expected command to fail')
+        except FabricRunnerException as e:
+            self.assertEqual('line 100', e.message.splitlines()[-1])
+            self.assertTrue(len(e.message) <= 16)
+        self.assertEqual(['line {0}'.format(i) for i in range(1, 21)],
+                         lines[:20])
+        self.assertEqual('', runner.run('echo discarded',
+                                        output=DiscardedOutput()))
+
+    def test_put_get_file(self):
+        runner = self._runner()
+        content = ''.join(chr(i % 256) for i in range(300000))
+        file_path = os.path.join(self.work_dir, 'sub', 'file')
+        self.assertEqual(len(content), runner.put_file(
+            file_path, StringIO(content), mode=0755))
+        self.assertEqual(0755, os.stat(file_path).st_mode & 0777)
+        self.assertRaises(NonRecoverableError, runner.put_file, file_path,
+                          StringIO('other'))
+        target = os.path.join(self.work_dir, 'target')
+        self.assertEqual(len(content), runner.get_file(file_path, target))
+        with open(target) as f:
+            self.assertEqual(content, f.read())
+        tail = StringIO()
+        runner.get_file(file_path, tail, max_bytes=1000, tail=True)
+        self.assertEqual(content[-1000:], tail.getvalue())
+        self.assertEqual(content[:10], ''.join(runner.iter_file(
+            file_path, max_bytes=10)))
+        self.assertRaises(FabricRunnerException, runner.get_file,
+                          os.path.join(self.work_dir, 'missing'), tail)
+
+    def test_tail(self):
+        runner = self._runner()
+        file_path = os.path.join(self.work_dir, 'log')
+        with open(file_path, 'w') as f:
+            f.write(''.join('line {0}\n'.format(i) for i in range(1000)))
+        commands = len(self.server.commands)
+        self.assertEqual('line 998\nline 999',
+                         runner.tail(file_path, max_lines=2))
+        self.assertEqual(1, len(self.server.commands) - commands)
+        self.assertEqual('999', runner.tail(file_path, max_bytes=4))
+        self.assertEqual('', runner.tail(file_path + '.missing'))
+
+    def test_concurrent_runners(self):
+        errors = []
+
+        def run(index):
+            runner = self._runner()
+            try:
+                for _ in range(5):
+                    output = runner.run('echo {0}'.format(index))
+                    if output != str(index):
+                        errors.append(output)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                runner.close()
+
+        threads = [threading.Thread(target=run, args=(index,))
+                   for index in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+
+    def test_connection_reused_across_runners(self):
+        connections = self.server.connections
+        first = self._runner()
+        first.run('true')
+        first.close()
+        second = self._runner()
+        second.run('true')
+        second.close()
+        self.assertTrue(self.server.connections - connections <= 1)
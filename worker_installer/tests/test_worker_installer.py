@@ -20,6 +20,7 @@ import time
 import os
 from os import path
 from worker_installer.utils import FabricRunner
+from worker_installer.utils import download_resource_on_host
 from worker_installer.tests import \
     id_generator, get_local_context, \
     get_remote_context, VAGRANT_MACHINE_IP, MANAGER_IP
@@ -319,7 +320,7 @@ class TestRemoteInstallerCase(WorkerInstallerTestCase):
         }
         ctx = get_remote_context(properties)
         runner = FabricRunner(ctx, ctx.node.properties['cloudify_agent'])
-        tasks.download_resource_on_host(
+        download_resource_on_host(
             ctx.logger, runner, AGENT_PACKAGE_URL, 'Ubuntu-agent.tar.gz')
         r = runner.exists('Ubuntu-agent.tar.gz')
         self.assertTrue(r)
@@ -424,7 +425,7 @@ class TestLocalInstallerCase(WorkerInstallerTestCase):
     def test_download_resource_on_host(self):
         ctx = get_local_context()
         runner = FabricRunner(ctx)
-        tasks.download_resource_on_host(
+        download_resource_on_host(
             ctx.logger, runner, AGENT_PACKAGE_URL, 'Ubuntu-agent.tar.gz')
         r = runner.exists('Ubuntu-agent.tar.gz')
         self.assertTrue(r)
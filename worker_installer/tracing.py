@@ -0,0 +1,167 @@
+#########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""
+Records where the time of an operation goes, command by command.
+
+Every ``run``, ``exists``, ``put`` and ``get`` of a traced runner becomes
+a record of the command, its wall time, the bytes sent and received, its
+exit code and whether it ran on a reused pooled connection. Steps made by
+another step (e.g. the ``mkdir`` of a ``put``) are recorded as well, one
+level deeper, and left out of the summary of the slowest steps.
+
+Only the last ``max_records`` steps are kept, so that tracing a long
+running operation does not grow without bounds.
+"""
+
+import collections
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_TRACE_DIR = os.path.join(tempfile.gettempdir(),
+                                 'cloudify-agent-traces')
+DEFAULT_SUMMARY_SIZE = 5
+DEFAULT_MAX_RECORDS = 10000
+
+
+class CommandTrace(object):
+    """The trace of the commands run by the runners of one operation"""
+
+    def __init__(self, max_records=DEFAULT_MAX_RECORDS):
+        self.records = collections.deque(maxlen=max_records)
+        # all the steps recorded, including those no longer kept, and the
+        # time spent in those not made by another step
+        self.steps = 0
+        self.duration = 0
+        self._lock = threading.Lock()
+        # the steps in progress on each thread, innermost last
+        self._local = threading.local()
+
+    def begin(self, kind, command, parent=None):
+        """starts recording a step, nested in ``parent`` if given"""
+        return {
+            'kind': kind,
+            'command': command,
+            'depth': 0 if parent is None else parent['depth'] + 1,
+            'started_at': time.time(),
+            'duration': None,
+            'bytes_in': 0,
+            'bytes_out': 0,
+            'exit_code': None,
+            'reused_connection': None
+        }
+
+    def end(self, record, exit_code=0):
+        """stops recording a step, unless its exit code was already set"""
+        record['duration'] = time.time() - record['started_at']
+        if record['exit_code'] is None:
+            record['exit_code'] = exit_code
+        with self._lock:
+            self.records.append(record)
+            self.steps += 1
+            if record['depth'] == 0:
+                self.duration += record['duration']
+
+    @contextmanager
+    def step(self, kind, command):
+        """
+        Records the step run by the block, nested in the step already in
+        progress on this thread if any.
+        """
+        stack = self._stack()
+        record = self.begin(kind, command, stack[-1] if stack else None)
+        stack.append(record)
+        exit_code = 0
+        try:
+            yield record
+        except Exception as e:
+            exit_code = getattr(e, 'code', -1)
+            raise
+        finally:
+            stack.pop()
+            self.end(record, exit_code)
+
+    @contextmanager
+    def attached(self, record):
+        """
+        Attributes the connections used by the block, which may run on
+        any thread, to ``record``.
+        """
+        stack = self._stack()
+        stack.append(record)
+        try:
+            yield
+        finally:
+            stack.pop()
+
+    def connection(self, reused):
+        """notes the connection used by the steps in progress"""
+        for record in self._stack():
+            # a step reused its connection only if all of its steps did
+            record['reused_connection'] = \
+                reused and record['reused_connection'] is not False
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def slowest(self, count=DEFAULT_SUMMARY_SIZE):
+        """the ``count`` slowest steps not made by another step"""
+        with self._lock:
+            records = [r for r in self.records if r['depth'] == 0]
+        records.sort(key=lambda r: r['duration'], reverse=True)
+        return records[:count]
+
+    def summary(self, count=DEFAULT_SUMMARY_SIZE):
+        with self._lock:
+            steps, total = self.steps, self.duration
+        lines = ['{0} steps, {1:.3f}s in total, slowest:'.format(
+            steps, total)]
+        for record in self.slowest(count):
+            lines.append('  {0:8.3f}s {1} [exit_code={2}, reused={3}]: '
+                         '{4}'.format(record['duration'], record['kind'],
+                                      record['exit_code'],
+                                      record['reused_connection'],
+                                      record['command']))
+        return '\n'.join(lines)
+
+    def dump(self, path, **fields):
+        """
+        Appends the records to ``path`` as JSON lines, each with
+        ``fields`` added, e.g. the operation and the agent they belong to.
+        """
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with self._lock:
+            records = sorted(self.records, key=lambda r: r['started_at'])
+        with open(path, 'a') as f:
+            for record in records:
+                line = dict(record)
+                line.update(fields)
+                f.write(json.dumps(line, sort_keys=True))
+                f.write('\n')
+
+
+def trace_path(trace_dir, agent_name, operation_name):
+    """the file the trace of an operation on an agent is dumped to"""
+    return os.path.join(trace_dir, '{0}.{1}.jsonl'.format(
+        agent_name, operation_name or 'operation'))
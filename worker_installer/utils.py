@@ -14,18 +14,42 @@
 #  * limitations under the License.
 
 
+import errno
 import os
+import posixpath
+import re
+import shutil
+import uuid
+import subprocess
 import tempfile
+from contextlib import contextmanager
 from StringIO import StringIO
 
-import fabric.network
-from fabric.api import run, put, get, local, sudo
-from fabric.context_managers import settings
-from fabric.contrib.files import exists
-
 from cloudify import context
 from cloudify.exceptions import NonRecoverableError
 
+from worker_installer.connection_pool import connection_pool
+from worker_installer.output import CapturedOutput
+from worker_installer.output import DEFAULT_TAIL_BYTES
+from worker_installer.output import LineOutput
+from worker_installer.output import TailOutput
+
+# remote commands run the same way fabric used to run them
+REMOTE_SHELL = '/bin/bash -l -c'
+# local commands run in bash as well when available, so that both accept
+# the same syntax (e.g. set -o pipefail)
+LOCAL_SHELL = '/bin/bash' if os.path.exists('/bin/bash') else None
+RECV_BUFFER_SIZE = 32768
+# exit code of a put command finding one of its files already in place
+PUT_EXISTS_CODE = 17
+# puts whose command would be longer are done over sftp. a command is
+# passed to the remote shell as a single argument, and linux limits these
+# to 128KB
+MAX_PUT_COMMAND_SIZE = 100 * 1024
+DEFAULT_PUT_MODE = 0644
+# bytes written as is by printf, others are written as octal escapes
+_PRINTF_UNSAFE = re.compile(r"[^A-Za-z0-9 \n,./:=@+^~#(){}<>|;&*?_\[\]-]")
+
 
 def is_on_management_worker(ctx):
     """
@@ -34,14 +58,52 @@ def is_on_management_worker(ctx):
     return ctx.type == context.DEPLOYMENT
 
 
-def download_resource_on_host(logger, runner, url, destination_path):
+def is_local_agent(ctx, agent_config):
+    """
+    Gets whether the agent is installed on the management worker's own
+    machine. Agents of bulk operations carry their own host even when the
+    operation was invoked for a deployment.
+    """
+    return is_on_management_worker(ctx) and 'host' not in agent_config
+
+
+def download_resource_command(url, destination_path, tools=None):
+    """a single shell command downloading a resource with wget or curl
+
+    When the tools available on the host are known (see `HostFacts`), the
+    command uses them directly. Otherwise the choice is made on the host,
+    which is useful for queueing a download in a `CommandBatch`.
+    """
+    wget = 'wget -T 30 {0} -O {1}'.format(url, destination_path)
+    curl = 'curl {0} -o {1}'.format(url, destination_path)
+    if tools is not None:
+        if 'wget' in tools:
+            return wget
+        if 'curl' in tools:
+            return curl
+        raise NonRecoverableError(
+            'could not download resource ({0}), wget and curl not found'
+            .format(url))
+    return ('if which wget > /dev/null 2>&1; then {0}; '
+            'elif which curl > /dev/null 2>&1; then {1}; '
+            'else echo "could not download resource ({2}), '
+            'wget and curl not found"; exit 127; fi'
+            .format(wget, curl, url))
+
+
+def download_resource_on_host(logger, runner, url, destination_path,
+                              host_facts=None):
     """downloads a resource from the fileserver on the agent's host
 
     Will try to get the resource. If it fails, will try to curl.
     If both fail, will return the state of the last fabric action.
+    When the host facts are given, no probing for wget and curl is done.
     """
     logger.debug('attempting to download {0} to {1}'.format(
         url, destination_path))
+    if host_facts is not None:
+        return runner.run(download_resource_command(
+            url, destination_path, host_facts.tools))
     logger.debug('checking whether wget exists on the host machine')
     try:
         runner.run('which wget')
@@ -65,105 +127,858 @@ def download_resource_on_host(logger, runner, url, destination_path):
             url))
 
 
-class FabricRunner(object):
+def create_runner(ctx, agent_config):
+    """a `LocalRunner` for local agents, a `FabricRunner` for the rest"""
+    if is_local_agent(ctx, agent_config):
+        return LocalRunner(ctx, agent_config)
+    return FabricRunner(ctx, agent_config)
 
-    def __init__(self, ctx, agent_config=None):
+
+class Runner(object):
+    """
+    What `FabricRunner` and `LocalRunner` share: the operations recorded
+    as steps when the runner is traced, and batches. How commands are run
+    and files are moved is up to each of them.
+    """
+
+    def __init__(self, ctx):
         self.ctx = ctx
+        # a `CommandTrace` recording every step, when tracing is enabled
+        self.trace = None
+        # a `PhaseTimer` timing the phases of the operation, when metrics
+        # are enabled
+        self.phases = None
+
+    def ping(self):
+        self.run('echo "ping!"')
+
+    @contextmanager
+    def batch(self):
+        """
+        Queues commands and runs all of them in a single remote shell
+        when the block exits.
+
+        Usage:
+          with runner.batch() as batch:
+              batch.run('mkdir -p {0}'.format(base_dir))
+              batch.run('unlink {0}'.format(link), ignore_errors=True)
+
+        If the block raises, the queued commands are discarded.
+        """
+        batch = CommandBatch(self)
+        yield batch
+        batch.flush()
+
+    def run(self, command, shell_escape=None, output=None):
+        """
+        Runs ``command`` and returns its output. Given an ``output``
+        policy (see `worker_installer.output`), returns what the policy
+        kept of it instead.
+        """
+        if output is None:
+            output = CapturedOutput()
+        with self._step('run', command) as step:
+            result = self._run(command, shell_escape, output)
+            step['bytes_out'] = len(command)
+            step['bytes_in'] = output.size
+            return result
+
+    def put(self, file_path, content, use_sudo=False, mode=None):
+        """
+        Creates ``file_path``, and its directory if needed, unless it
+        already exists. The content is written to a temporary file which
+        is then renamed into place, so the file is never seen partially
+        written. ``mode`` defaults to 0644.
+
+        On remote hosts, all of this takes a single command.
+        """
+        self.put_many([(file_path, content, use_sudo, mode)])
+
+    def put_many(self, files):
+        """
+        Puts every ``(file_path, content, use_sudo[, mode])`` of ``files``
+        the way `put` does, all in a single command on remote hosts.
+        Unless the files are too large for a single command, nothing is
+        written when any of them already exists.
+        """
+        files = [put_spec(*f) for f in files]
+        with self._step('put', ' '.join(f[0] for f in files)) as step:
+            step['bytes_out'] = sum(len(f[1]) for f in files)
+            self._put_many(files)
+
+    def put_file(self, file_path, source, use_sudo=False, mode=None):
+        """
+        Creates ``file_path`` the way `put` does, streaming its content
+        from ``source``, a file object or the path of a local file, in
+        chunks. Returns the number of bytes written.
+        """
+        mode = DEFAULT_PUT_MODE if mode is None else mode
+        with self._step('put', file_path) as step:
+            with _opened(source, 'rb') as f:
+                size = self._put_file(file_path, f, use_sudo, mode)
+            step['bytes_out'] = size
+            return size
+
+    def get_file(self, file_path, target, max_bytes=None, tail=False):
+        """
+        Streams ``file_path`` into ``target``, a file object or the path
+        of a local file, in chunks, and returns the number of bytes
+        written. See `iter_file` for ``max_bytes`` and ``tail``.
+        """
+        with self._step('get', file_path) as step:
+            size = 0
+            with _opened(target, 'wb') as f:
+                for chunk in self.iter_file(file_path, max_bytes, tail):
+                    f.write(chunk)
+                    size += len(chunk)
+            step['bytes_in'] = size
+            return size
+
+    def close(self):
+        # the connections of remote runners are owned by the pool and are
+        # kept open for the next operation on their host. nothing is
+        # process wide anymore, so closing one runner never affects
+        # another (see CFY-1741). every channel gives its connection back
+        # to the pool once closed
+        pass
+
+    def _step(self, kind, command):
+        if self.trace is None:
+            return _untraced()
+        return self.trace.step(kind, command)
+
+
+class FabricRunner(Runner):
+
+    def __init__(self, ctx, agent_config=None):
+        Runner.__init__(self, ctx)
         config = agent_config or {}
-        self.local = is_on_management_worker(ctx)
+        self.local = is_local_agent(ctx, config)
+        # runners created directly for local agents hand everything to a
+        # `LocalRunner`
+        self._local_runner = LocalRunner(ctx, config) if self.local \
+            else None
         if not self.local:
+            self.user = config['user']
+            self.host = config['host']
+            self.port = config['port']
             self.host_string = '%(user)s@%(host)s:%(port)s' % config
             self.key_filename = config.get('key')
             self.password = config.get('password')
 
-    def ping(self):
-        self.run('echo "ping!"')
-
-    def run(self, command, shell_escape=None):
+    def _run(self, command, shell_escape, output):
+        if self.local:
+            return self._local_runner._run(command, shell_escape, output)
         self.ctx.logger.debug('Running command: {0}'.format(command))
+        code, result = self._exec(command, shell_escape=shell_escape,
+                                  output=output)
+        if code != 0:
+            raise FabricRunnerException(command, code, result)
+        return result
+
+    def exists(self, file_path):
+        with self._step('exists', file_path) as step:
+            if self.local:
+                return self._local_runner.exists(file_path)
+            code, _ = self._exec('test -e "$(echo {0})"'.format(file_path))
+            step['exit_code'] = code
+            return code == 0
+
+    def _put_many(self, files):
+        if self.local:
+            return self._local_runner._put_many(files)
+        for file_path, _, use_sudo, mode in files:
+            self.ctx.logger.debug(
+                'Putting file: {0} [use_sudo={1}, mode={2:o}]'.format(
+                    file_path, use_sudo, mode))
+        command = put_command(files)
+        if len(command) > MAX_PUT_COMMAND_SIZE:
+            for file_path, content, use_sudo, mode in files:
+                self._put_sftp(file_path, StringIO(content), use_sudo, mode)
+            return
+        code, output = self._exec(command)
+        check_put_result(command, code, output)
+
+    def _put_sftp(self, file_path, source, use_sudo, mode):
+        if self.exists(file_path):
+            raise NonRecoverableError('Cannot put file, file already '
+                                      'exists: {0}'.format(file_path))
+        directory = posixpath.dirname(file_path) or '.'
+        self.run('{0}mkdir -p {1}'.format('sudo ' if use_sudo else '',
+                                          directory))
+        upload_path = put_upload_path(file_path, use_sudo)
+        size = self._upload(upload_path, source)
+        self.run(put_rename_command(upload_path, file_path, use_sudo, mode))
+        return size
+
+    def _put_file(self, file_path, source, use_sudo, mode):
+        if self.local:
+            return self._local_runner._put_file(file_path, source, use_sudo,
+                                                mode)
+        self.ctx.logger.debug(
+            'Streaming file: {0} [use_sudo={1}, mode={2:o}]'.format(
+                file_path, use_sudo, mode))
+        return self._put_sftp(file_path, source, use_sudo, mode)
+
+    def get(self, file_path):
+        with self._step('get', file_path) as step:
+            if self.local:
+                content = self._local_runner.get(file_path)
+            else:
+                content = self.download(file_path)
+            step['bytes_in'] = len(content)
+            return content
+
+    def iter_file(self, file_path, max_bytes=None, tail=False):
+        """
+        Iterates over the content of ``file_path`` in chunks, up to
+        ``max_bytes`` of it from its start or, with ``tail``, from
+        ``max_bytes`` before its end.
+        """
         if self.local:
+            for chunk in self._local_runner.iter_file(file_path, max_bytes,
+                                                      tail):
+                yield chunk
+            return
+        command = 'get {0}'.format(file_path)
+        sftp = self._open_sftp(command)
+        try:
+            try:
+                f = sftp.open(file_path, 'rb')
+            except IOError as e:
+                raise FabricRunnerException(command, -1, str(e))
+            with f:
+                for chunk in read_chunks(f, max_bytes, tail):
+                    yield chunk
+        finally:
+            sftp.close()
+
+    def tail(self, file_path, max_bytes=DEFAULT_TAIL_BYTES, max_lines=None):
+        """
+        The last ``max_bytes`` of ``file_path``, or of its last
+        ``max_lines`` lines when fewer, read in a single command. Empty
+        when the file does not exist.
+        """
+        if self.local:
+            return self._local_runner.tail(file_path, max_bytes, max_lines)
+        return self.run(tail_command(file_path, max_bytes, max_lines),
+                        output=TailOutput(max_bytes))
+
+    def upload(self, file_path, content):
+        """
+        Writes ``content`` to a remote file over sftp, without any of the
+        checks and preparations done by `put`.
+        """
+        self._upload(file_path, StringIO(content))
+
+    def _upload(self, file_path, source):
+        sftp = self._open_sftp('put {0}'.format(file_path))
+        try:
+            return sftp.putfo(source, file_path).st_size
+        finally:
+            sftp.close()
+
+    def download(self, file_path):
+        """reads the content of a remote file over sftp"""
+        output = StringIO()
+        sftp = self._open_sftp('get {0}'.format(file_path))
+        try:
+            sftp.getfo(file_path, output)
+        finally:
+            sftp.close()
+        return output.getvalue()
+
+    def _client(self, command):
+        # imported on first use, see `connection_pool.connect`
+        import paramiko
+        try:
+            client, reused = connection_pool.acquire_connection(
+                self.user,
+                self.host,
+                self.port,
+                key_filename=self.key_filename,
+                password=self.password)
+        except (paramiko.AuthenticationException,
+                paramiko.BadHostKeyException) as e:
+            connection_pool.invalidate_host(self.host, self.port)
+            raise FabricRunnerException(command, -1, str(e))
+        except Exception as e:
+            raise FabricRunnerException(command, -1, str(e))
+        if self.trace is not None:
+            self.trace.connection(reused)
+        return client
+
+    def _open_sftp(self, command):
+        client = self._client(command)
+        try:
+            return _Released(client.open_sftp(), client)
+        except Exception as e:
+            connection_pool.release(client)
+            raise FabricRunnerException(command, -1, str(e))
+
+    def start_command(self, command, shell_escape=None):
+        """
+        Starts a command on its own channel of the pooled connection and
+        returns the channel without waiting for the command to finish.
+
+        Like fabric's run, the command is wrapped in a login shell and
+        given a pty, so that sudo works on hosts with requiretty.
+        """
+        escaped_command = command
+        if shell_escape is not False:
+            for char in ('"', '$', '`'):
+                escaped_command = escaped_command.replace(char, '\\' + char)
+        wrapped_command = '{0} "{1}"'.format(REMOTE_SHELL, escaped_command)
+        client = self._client(command)
+        try:
+            channel = client.get_transport().open_session()
             try:
-                with settings(warn_only=True):
-                    r = local(command, capture=True)
-                    if r.return_code != 0:
-                        raise FabricRunnerException(command,
-                                                    r.return_code,
-                                                    r.stderr)
-                    return r.stdout
+                channel.get_pty()
+                channel.exec_command(wrapped_command)
+            except Exception:
+                channel.close()
+                raise
+        except Exception as e:
+            connection_pool.release(client)
+            raise FabricRunnerException(command, -1, str(e))
+        return _Released(channel, client)
+
+    def _exec(self, command, shell_escape=None, output=None):
+        """
+        Runs a remote command and returns its exit code and combined
+        output, or what the ``output`` policy kept of it.
+        """
+        if output is None:
+            output = CapturedOutput()
+        channel = self.start_command(command, shell_escape=shell_escape)
+        try:
+            while True:
+                data = channel.recv(RECV_BUFFER_SIZE)
+                if not data:
+                    break
+                output.feed(data)
+            code = channel.recv_exit_status()
+        except Exception as e:
+            raise FabricRunnerException(command, -1, str(e))
+        finally:
+            channel.close()
+        output.close()
+        return code, output.getvalue()
+
+
+class LocalRunner(Runner):
+    """
+    Runs the commands of agents installed on the management worker's own
+    machine.
+
+    Whatever can be done in process is: files are checked, read and
+    written directly, and host facts are gathered without a probe (see
+    `facts.local_facts`). Everything else is spawned directly with
+    argument lists, a single process per privileged write or read, and a
+    shell only for the commands given as shell commands.
+    """
+
+    def __init__(self, ctx, agent_config=None):
+        Runner.__init__(self, ctx)
+        self.local = True
+
+    def _run(self, command, shell_escape, output):
+        self.ctx.logger.debug('Running command: {0}'.format(command))
+        # stdout goes to the output policy as it is read, and stderr to a
+        # file whose tail describes failures
+        with tempfile.TemporaryFile() as stderr:
+            try:
+                p = subprocess.Popen(command, shell=True,
+                                     executable=LOCAL_SHELL,
+                                     stdout=subprocess.PIPE,
+                                     stderr=stderr)
+                while True:
+                    data = os.read(p.stdout.fileno(), RECV_BUFFER_SIZE)
+                    if not data:
+                        break
+                    output.feed(data)
+                p.stdout.close()
+                p.wait()
             except Exception as e:
                 raise FabricRunnerException(command, -1, str(e))
-        out = StringIO()
-        with settings(host_string=self.host_string,
-                      key_filename=self.key_filename,
-                      password=self.password,
-                      disable_known_hosts=True):
+            output.close()
+            if p.returncode != 0:
+                raise FabricRunnerException(command,
+                                            p.returncode,
+                                            _read_tail(stderr).strip())
+        return output.getvalue()
+
+    def execute(self, args, stdin=None):
+        """
+        Runs the ``args`` argument list without a shell, feeding it
+        ``stdin``, and returns its output.
+        """
+        command = ' '.join(args)
+        self.ctx.logger.debug('Executing: {0}'.format(command))
+        with self._step('run', command):
             try:
-                return run(command, stdout=out, stderr=out,
-                           shell_escape=shell_escape)
-            except SystemExit, e:
-                raise FabricRunnerException(command, e.code, out.getvalue())
+                if hasattr(stdin, 'read'):
+                    returncode, stdout, stderr = _communicate_file(args,
+                                                                   stdin)
+                else:
+                    p = subprocess.Popen(args,
+                                         stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE,
+                                         stderr=subprocess.PIPE)
+                    stdout, stderr = p.communicate(stdin)
+                    returncode = p.returncode
+            except Exception as e:
+                raise FabricRunnerException(command, -1, str(e))
+            if returncode != 0:
+                raise FabricRunnerException(command, returncode,
+                                            stderr.strip())
+            return stdout
 
     def exists(self, file_path):
-        if self.local:
+        with self._step('exists', file_path):
             return os.path.exists(file_path)
-        with settings(host_string=self.host_string,
-                      key_filename=self.key_filename,
-                      password=self.password,
-                      disable_known_hosts=True):
-            return exists(file_path)
 
-    def put(self, file_path, content, use_sudo=False):
-        self.ctx.logger.debug(
-            'Putting file: {0} [use_sudo={1}]'.format(file_path, use_sudo))
-        directory = "/".join(file_path.split("/")[:-1])
-        if self.local:
+    def _put_many(self, files):
+        for file_path, _, _, _ in files:
             if os.path.exists(file_path):
                 raise NonRecoverableError('Cannot put file, file already '
                                           'exists: {0}'.format(file_path))
+        for file_path, content, use_sudo, mode in files:
+            self.ctx.logger.debug(
+                'Putting file: {0} [use_sudo={1}, mode={2:o}]'.format(
+                    file_path, use_sudo, mode))
             if use_sudo:
-                # we need to write a string to a file locally with sudo
-                # use echo for now
-                if not os.path.exists(directory):
-                    self.run("sudo mkdir -p {0}".format(directory))
-                temp_file = tempfile.mktemp()
-                with open(temp_file, 'w') as f:
-                    f.write(content)
-                self.run('sudo cp {0} {1}'.format(temp_file, file_path))
-                self.run('sudo rm {0}'.format(temp_file))
+                self._put_with_sudo(file_path, content, mode)
             else:
-                # no sudo needed. just use python for this
-                if not os.path.exists(directory):
-                    os.makedirs(directory)
-                with open(file_path, 'w') as f:
-                    f.write(content)
+                self._put_atomically(file_path, StringIO(content), mode)
+
+    def _put_file(self, file_path, source, use_sudo, mode):
+        if os.path.exists(file_path):
+            raise NonRecoverableError('Cannot put file, file already '
+                                      'exists: {0}'.format(file_path))
+        self.ctx.logger.debug(
+            'Streaming file: {0} [use_sudo={1}, mode={2:o}]'.format(
+                file_path, use_sudo, mode))
+        if use_sudo:
+            self._put_with_sudo(file_path, source, mode)
         else:
-            with settings(host_string=self.host_string,
-                          key_filename=self.key_filename,
-                          password=self.password,
-                          disable_known_hosts=True):
-                if exists(file_path):
-                    raise NonRecoverableError('Cannot put file, file already '
-                                              'exists: {0}'.format(file_path))
-                mkdir_command = 'mkdir -p {0}'.format(directory)
-                sudo(mkdir_command) if use_sudo else run(mkdir_command)
-                put(StringIO(content), file_path, use_sudo=use_sudo)
+            self._put_atomically(file_path, source, mode)
+        return os.path.getsize(file_path)
+
+    def _put_with_sudo(self, file_path, content, mode):
+        directory = os.path.dirname(file_path)
+        if directory and not os.path.exists(directory):
+            self.execute(['sudo', 'mkdir', '-p', directory])
+        # the content is written by a single privileged process, no
+        # temporary copy is made
+        self.execute(['sudo', 'install', '-m', '{0:o}'.format(mode),
+                      '/dev/stdin', file_path], stdin=content)
+
+    def _put_atomically(self, file_path, source, mode):
+        directory = os.path.dirname(file_path) or '.'
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        fd, temp_path = tempfile.mkstemp(dir=directory,
+                                         prefix='.cloudify-put.')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                shutil.copyfileobj(source, f, RECV_BUFFER_SIZE)
+            os.chmod(temp_path, mode)
+            os.rename(temp_path, file_path)
+        except Exception:
+            os.remove(temp_path)
+            raise
 
     def get(self, file_path):
-        if self.local:
-            return self.run('sudo cat {0}'.format(file_path))
+        with self._step('get', file_path) as step:
+            try:
+                content = self.download(file_path)
+            except IOError as e:
+                if e.errno != errno.EACCES:
+                    raise FabricRunnerException('get {0}'.format(file_path),
+                                                -1, str(e))
+                content = self.execute(['sudo', 'cat', file_path])
+            step['bytes_in'] = len(content)
+            return content
+
+    def iter_file(self, file_path, max_bytes=None, tail=False):
+        try:
+            f = open(file_path, 'rb')
+        except IOError as e:
+            if e.errno != errno.EACCES:
+                raise FabricRunnerException('get {0}'.format(file_path),
+                                            -1, str(e))
+            for chunk in self._iter_with_sudo(file_path, max_bytes, tail):
+                yield chunk
+            return
+        with f:
+            for chunk in read_chunks(f, max_bytes, tail):
+                yield chunk
+
+    def tail(self, file_path, max_bytes=DEFAULT_TAIL_BYTES, max_lines=None):
+        if not os.path.exists(file_path):
+            return ''
+        with self._step('get', file_path) as step:
+            content = ''.join(self.iter_file(file_path, max_bytes, tail=True))
+            step['bytes_in'] = len(content)
+        return last_lines(content, max_lines).strip()
+
+    def _iter_with_sudo(self, file_path, max_bytes, tail):
+        if max_bytes is None:
+            args = ['sudo', 'cat', file_path]
         else:
-            output = StringIO()
-            with settings(host_string=self.host_string,
-                          key_filename=self.key_filename,
-                          password=self.password,
-                          disable_known_hosts=True):
-                get(file_path, output)
-                return output.getvalue()
+            args = ['sudo', 'tail' if tail else 'head', '-c',
+                    str(max_bytes), file_path]
+        command = ' '.join(args)
+        self.ctx.logger.debug('Executing: {0}'.format(command))
+        with tempfile.TemporaryFile() as stderr:
+            try:
+                p = subprocess.Popen(args, stdout=subprocess.PIPE,
+                                     stderr=stderr)
+            except Exception as e:
+                raise FabricRunnerException(command, -1, str(e))
+            try:
+                for chunk in read_chunks(p.stdout):
+                    yield chunk
+            finally:
+                if p.poll() is None:
+                    # the reader stopped early
+                    p.kill()
+                p.stdout.close()
+                p.wait()
+            if p.returncode != 0:
+                raise FabricRunnerException(command, p.returncode,
+                                            _read_tail(stderr).strip())
+
+    def upload(self, file_path, content):
+        directory = os.path.dirname(file_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(file_path, 'w') as f:
+            f.write(content)
+
+    def download(self, file_path):
+        with open(file_path) as f:
+            return f.read()
+
+
+def put_spec(file_path, content, use_sudo=False, mode=None):
+    """a file given to `FabricRunner.put_many`, with the defaults applied"""
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    return (file_path, content, use_sudo,
+            DEFAULT_PUT_MODE if mode is None else mode)
+
+
+def put_command(files):
+    """
+    A single shell command putting every ``(file_path, content, use_sudo,
+    mode)`` of ``files`` in place. It writes nothing, and exits with
+    `PUT_EXISTS_CODE`, when any of the files already exists.
+
+    The content is given to printf with the bytes the shells on the way
+    could alter (quotes, $, backslashes...) escaped, so it needs no
+    escaping of its own.
+    """
+    lines = ['set -e']
+    for file_path, _, _, _ in files:
+        lines.append('if [ -e {0} ]; then echo "Cannot put file, file '
+                     'already exists: "{0}; exit {1}; fi'.format(
+                         _quote(file_path), PUT_EXISTS_CODE))
+    for file_path, content, use_sudo, mode in files:
+        sudo = 'sudo ' if use_sudo else ''
+        directory = posixpath.dirname(file_path) or '.'
+        escaped = _PRINTF_UNSAFE.sub(
+            lambda match: '\\{0:03o}'.format(ord(match.group())), content)
+        lines.extend([
+            '{0}mkdir -p {1}'.format(sudo, _quote(directory)),
+            'tmp=$({0}mktemp {1})'.format(
+                sudo, _quote(posixpath.join(directory,
+                                            '.cloudify-put.XXXXXX'))),
+            "printf '{0}' | {1}tee \"$tmp\" > /dev/null".format(
+                escaped, sudo),
+            '{0}chmod {1:o} "$tmp"'.format(sudo, mode),
+            '{0}mv -f "$tmp" {1}'.format(sudo, _quote(file_path))
+        ])
+    return '\n'.join(lines)
+
+
+def check_put_result(command, code, output):
+    if code == PUT_EXISTS_CODE:
+        raise NonRecoverableError(output)
+    if code != 0:
+        raise FabricRunnerException(command, code, output)
+
+
+def put_upload_path(file_path, use_sudo):
+    """where a file put over sftp is uploaded to before being renamed"""
+    if use_sudo:
+        # next to the user's home, the way fabric does it
+        return '.cloudify-upload-{0}'.format(uuid.uuid4())
+    return posixpath.join(posixpath.dirname(file_path),
+                          '.cloudify-upload-{0}'.format(uuid.uuid4()))
+
+
+def put_rename_command(upload_path, file_path, use_sudo, mode):
+    sudo = 'sudo ' if use_sudo else ''
+    return '{0}chmod {1:o} {2} && {0}mv -f {2} {3}'.format(
+        sudo, mode, _quote(upload_path), _quote(file_path))
+
+
+def tail_command(file_path, max_bytes, max_lines=None):
+    """
+    A shell command printing the end of ``file_path`` (see
+    `FabricRunner.tail`), and nothing when the file does not exist.
+    """
+    command = 'tail -c {0} {1} 2> /dev/null'.format(max_bytes,
+                                                    _quote(file_path))
+    if max_lines is not None:
+        command = '{0} | tail -n {1}'.format(command, max_lines)
+    return '{0}; true'.format(command)
+
+
+def last_lines(content, max_lines=None):
+    """the last ``max_lines`` lines of ``content``, all of them by default"""
+    if max_lines is None:
+        return content
+    lines = content.splitlines(True)
+    return ''.join(lines[-max_lines:]) if max_lines > 0 else ''
+
+
+def read_chunks(f, max_bytes=None, tail=False, chunk_size=RECV_BUFFER_SIZE):
+    """
+    Iterates over file object ``f`` in chunks, up to ``max_bytes`` of it
+    from its current position or, with ``tail``, from ``max_bytes``
+    before its end.
+    """
+    if tail and max_bytes is not None:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell() - max_bytes))
+    remaining = max_bytes
+    while remaining is None or remaining > 0:
+        size = chunk_size if remaining is None else min(chunk_size,
+                                                        remaining)
+        chunk = f.read(size)
+        if not chunk:
+            break
+        if remaining is not None:
+            remaining -= len(chunk)
+        yield chunk
+
+
+@contextmanager
+def _opened(file_or_path, mode):
+    """a file object as is, or the local file at a path opened in mode"""
+    if isinstance(file_or_path, basestring):
+        with open(file_or_path, mode) as f:
+            yield f
+    else:
+        yield file_or_path
+
+
+def _communicate_file(args, stdin):
+    """
+    Runs ``args`` fed with the ``stdin`` file object in chunks, and
+    returns its exit code, output and error output.
+    """
+    with tempfile.TemporaryFile() as stdout, \
+            tempfile.TemporaryFile() as stderr:
+        # the output goes to files, so the process never blocks on it
+        # while it is being fed
+        p = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=stdout,
+                             stderr=stderr)
+        try:
+            shutil.copyfileobj(stdin, p.stdin, RECV_BUFFER_SIZE)
+        except IOError as e:
+            # the process exited without reading all of its input, its
+            # exit code tells why
+            if e.errno != errno.EPIPE:
+                raise
+        finally:
+            p.stdin.close()
+        p.wait()
+        stdout.seek(0)
+        return p.returncode, stdout.read(), _read_tail(stderr)
+
+
+def _read_tail(f, max_bytes=DEFAULT_TAIL_BYTES):
+    f.seek(0, os.SEEK_END)
+    f.seek(max(0, f.tell() - max_bytes))
+    return f.read()
+
+
+def _quote(value):
+    return "'{0}'".format(value.replace("'", "'\\''"))
+
+
+class _Released(object):
+    """
+    A channel or sftp client of a pooled connection, which gives the
+    connection back to the pool once closed.
+    """
+
+    def __init__(self, target, client):
+        self._target = target
+        self._client = client
+
+    def __getattr__(self, name):
+        return getattr(self._target, name)
 
     def close(self):
-        if self.local:
+        try:
+            self._target.close()
+        finally:
+            if self._client is not None:
+                connection_pool.release(self._client)
+                self._client = None
+
+
+@contextmanager
+def _untraced():
+    # the steps of a runner that is not traced are recorded nowhere
+    yield {}
+
+
+class BatchStep(object):
+
+    def __init__(self, command, ignore_errors=False):
+        self.command = command
+        self.ignore_errors = ignore_errors
+        self.code = None
+        self.output = None
+
+    @property
+    def executed(self):
+        return self.code is not None
+
+    @property
+    def failed(self):
+        return self.executed and self.code != 0
+
+
+class CommandBatch(object):
+    """
+    Commands queued for execution in a single remote shell.
+
+    Each step runs in its own subshell, surrounded by markers carrying its
+    index and exit code so that the output of every step can be recovered.
+    The script stops at the first failing step unless that step was queued
+    with ``ignore_errors=True``.
+    """
+
+    STEP_START = '###CLOUDIFYSTEPSTART'
+    STEP_END = '###CLOUDIFYSTEPEND'
+
+    def __init__(self, runner):
+        self.runner = runner
+        self.steps = []
+        self.results = []
+        self.output = None
+
+    def run(self, command, ignore_errors=False):
+        self.steps.append(BatchStep(command, ignore_errors))
+
+    def compile(self):
+        lines = []
+        for index, step in enumerate(self.steps):
+            lines.append("echo '{0}{1}'".format(self.STEP_START, index))
+            lines.append('( {0} ) 2>&1'.format(step.command))
+            lines.append('rc=$?')
+            lines.append('echo "{0}{1} $rc"'.format(self.STEP_END, index))
+            if not step.ignore_errors:
+                # the script itself always succeeds, failures are
+                # reported through the step markers
+                lines.append('[ $rc -eq 0 ] || exit 0')
+        return '\n'.join(lines)
+
+    def flush(self):
+        """
+        Runs the queued steps and returns them with their exit codes and
+        output. Raises `FabricRunnerException` for the first failing step
+        that does not ignore errors.
+        """
+        if not self.steps:
+            return []
+        script = self.begin()
+        self.runner.run(script, output=self.output)
+        return self.complete()
+
+    def begin(self):
+        """
+        Returns the script running the queued steps, which from now on
+        are the results of the batch. The script is to be run with
+        ``output``, collecting the output of every step as it is read.
+        """
+        script = self.compile()
+        self.results = self.steps
+        self.steps = []
+        self.output = BatchOutput(self.results)
+        return script
+
+    def complete(self):
+        """
+        Checks the exit code of every step, once the script returned by
+        `begin` ran.
+        """
+        steps = self.results
+        total = len(steps)
+        for index, step in enumerate(steps):
+            if step.failed and not step.ignore_errors:
+                raise FabricRunnerException(
+                    step.command, step.code,
+                    'step {0} of {1} failed: {2}'.format(
+                        index + 1, total, step.output))
+            if not step.executed:
+                raise FabricRunnerException(
+                    step.command, -1,
+                    'step {0} of {1} did not complete: {2}'.format(
+                        index + 1, total, self.output.getvalue()))
+        return steps
+
+
+class BatchOutput(LineOutput):
+    """
+    The output of a `CommandBatch` script, split into the output of its
+    steps as it is read. Only the last ``max_bytes`` of the output of
+    every step, and of the whole script, are kept.
+    """
+
+    def __init__(self, steps, max_bytes=DEFAULT_TAIL_BYTES):
+        LineOutput.__init__(self)
+        self.steps = steps
+        self.max_bytes = max_bytes
+        self._tail = TailOutput(max_bytes)
+        self._index = None
+        self._step_output = None
+
+    def feed(self, data):
+        LineOutput.feed(self, data)
+        self._tail.feed(data)
+
+    def line(self, line):
+        if self._index is None:
+            if line.startswith(CommandBatch.STEP_START):
+                index = line[len(CommandBatch.STEP_START):]
+                if index.isdigit() and int(index) < len(self.steps):
+                    self._index = int(index)
+                    self._step_output = TailOutput(self.max_bytes)
             return
-        fabric.network.disconnect_all()
+        # the end marker follows the output of steps not ending with a
+        # new line on the same line
+        marker = '{0}{1} '.format(CommandBatch.STEP_END, self._index)
+        position = line.find(marker)
+        if position == -1:
+            self._step_output.feed(line + '\n')
+            return
+        self._step_output.feed(line[:position])
+        step = self.steps[self._index]
+        step.output = self._step_output.getvalue()
+        step.code = int(line[position + len(marker):])
+        self._index = None
+        self._step_output = None
+
+    def getvalue(self):
+        return self._tail.getvalue()
 
 
 class FabricRunnerException(Exception):